@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+###################################################################################
+
+ALERT functions for managing the index of the ASCAT raw archive (daily zip archives of 0_RAW) :
+zip path, members of products, size/modification time and integrity status of each day
+
+###################################################################################
+"""
+
+import os
+import fnmatch
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import BadZipFile, ZipFile
+import pandas as pd
+
+import logging
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S', level=logging.INFO)
+
+
+# Products of daily ASCAT zip archives (members patterns)
+ASCAT_MEMBERS = {'SWI-020': '*_SWI-SWI-020*.tiff', 'QFLAG': '*_SWI-QFLAG-020*.tiff', 'SSF': '*_SWI-SSF_*.tiff'}
+
+ASCAT_ARCHIVE = 1       # default persistent indexing of the ASCAT raw archive (see getIndexASCAT)
+ARCHIVE_NAME = 'ARCHIVE_ASCAT.sqlite'
+ARCHIVE_THREADS = 4     # number of threads validating new/changed zip archives
+ARCHIVE_COLUMNS = ['folder', 'date', 'zip', 'size', 'mtime', 'dir_mtime', 'swi', 'qflag', 'ssf', 'status']
+ARCHIVE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS days (folder TEXT PRIMARY KEY, date TEXT, zip TEXT, size INTEGER, mtime INTEGER, dir_mtime INTEGER,
+                                     swi TEXT, qflag TEXT, ssf TEXT, status TEXT);
+"""
+# Status of a day : VALID (all products found, CRC checked), CORRUPT (bad zip or CRC error), INCOMPLETE (missing product), MISSING (no zip)
+
+
+
+def getIndexASCAT(CONFIG):
+    """
+    Read indexing option of the ASCAT raw archive from CONFIG['ASCAT_ARCHIVE'] (default ASCAT_ARCHIVE) :
+    if 1, day folders of 0_RAW are listed from a persistent index (see refreshArchive).
+    """
+
+    if (CONFIG.get('ASCAT_ARCHIVE') is None) or (CONFIG['ASCAT_ARCHIVE']==''): go_index = ASCAT_ARCHIVE
+    else: go_index = int(CONFIG['ASCAT_ARCHIVE'])
+
+    return go_index
+
+
+
+def getArchive(CONFIG):
+    """
+    Path of the index of the ASCAT raw archive of the territory (None if CONFIG['ASCAT_ARCHIVE']=0, see getIndexASCAT).
+    """
+
+    if getIndexASCAT(CONFIG)==0:
+        return None
+
+    TERRITORY_str = CONFIG['TERRITORY'].replace('"', '').replace(' ', '_').replace('(', '').replace(')', '')
+
+    return os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, '0_INDICES', 'ASCAT', ARCHIVE_NAME)
+
+
+
+def validateZip(zip_file, go_check=1):
+    """
+    Read the listing of a daily zip archive : members of products (see ASCAT_MEMBERS), and integrity status.
+    IF go_check=1, CRC of all members are checked (whole archive is decompressed once).
+    Returns members (dict SWI-020/QFLAG/SSF -> member name or None) and status.
+    """
+
+    MEMBERS = dict.fromkeys(ASCAT_MEMBERS)
+    try:
+        with ZipFile(zip_file) as zf:
+            file_list = zf.namelist()
+            for name, pattern in ASCAT_MEMBERS.items():
+                members = [el for el in file_list if fnmatch.fnmatch(el, pattern)]
+                if len(members)>0: MEMBERS[name] = members[0]
+            if (go_check==1) and (zf.testzip() is not None):
+                return MEMBERS, 'CORRUPT'
+    except (BadZipFile, OSError, EOFError) as e:
+        logging.info(f"!! BadZipFile !! :\n  {zip_file} ({str(e)})\n")
+        return MEMBERS, 'CORRUPT'
+
+    if any(member is None for member in MEMBERS.values()):
+        return MEMBERS, 'INCOMPLETE'
+
+    return MEMBERS, 'VALID'
+
+
+
+def rowArchive(raw_dir, folder, dir_mtime, STORED=None, go_check=1):
+    """
+    Index row of a day folder of raw_dir (folder name SWI_YYYYMMDD...) : its zip archive is only validated (see validateZip)
+    if new or changed (size, modification time) compared to STORED row.
+    """
+
+    date = folder.split('_')[1][:8] if '_' in folder else None
+    ZIPS = sorted(entry for entry in os.listdir(os.path.join(raw_dir, folder)) if entry.endswith('.zip'))
+    if len(ZIPS)==0:
+        return (folder, date, None, None, None, dir_mtime, None, None, None, 'MISSING')
+
+    zip_path = os.path.join(folder, ZIPS[0])
+    z_stat = os.stat(os.path.join(raw_dir, zip_path))
+    if (STORED is not None) and (STORED[2:5]==(zip_path, int(z_stat.st_size), int(z_stat.st_mtime))):
+        return (*STORED[:5], dir_mtime, *STORED[6:])
+
+    MEMBERS, status = validateZip(os.path.join(raw_dir, zip_path), go_check)
+
+    return (folder, date, zip_path, int(z_stat.st_size), int(z_stat.st_mtime), dir_mtime,
+            MEMBERS['SWI-020'], MEMBERS['QFLAG'], MEMBERS['SSF'], status)
+
+
+
+def refreshArchive(archive_file, raw_dir, n_threads=ARCHIVE_THREADS):
+    """
+    Refresh the index of the ASCAT raw archive with the day folders of raw_dir (SWI_*), and return it (DataFrame, absolute paths) :
+        - a day folder is only listed again if its modification time changed (zip downloaded, replaced or removed)
+        - only new or changed zip archives (size, modification time) are validated (listing of members, CRC), on n_threads threads
+        - rows of removed folders are deleted
+    IF archive_file is None (or its directory does not exist), folders are listed without persistent index (members listed, CRC not checked).
+    """
+
+    raw_dir = os.path.normpath(os.path.abspath(raw_dir))
+    FOLDERS = {entry.name: entry.stat().st_mtime_ns for entry in os.scandir(raw_dir)
+               if entry.is_dir() and fnmatch.fnmatch(entry.name, 'SWI_*')} if os.path.isdir(raw_dir) else {}
+
+    # --- Without persistent index ---
+    if (archive_file is None) or (not os.path.isdir(os.path.dirname(archive_file))):
+        ROWS = [rowArchive(raw_dir, folder, dir_mtime, None, 0) for folder, dir_mtime in sorted(FOLDERS.items())]
+        return absolutePaths(pd.DataFrame(ROWS, columns=ARCHIVE_COLUMNS), raw_dir)
+
+    # --- Incremental refresh of persistent index ---
+    con = sqlite3.connect(archive_file, timeout=60)
+    try:
+        con.executescript(ARCHIVE_SCHEMA)
+        STORED = {row[0]: row for row in con.execute(f'SELECT {",".join(ARCHIVE_COLUMNS)} FROM days')}
+        FOLDERS_new = [folder for folder, dir_mtime in sorted(FOLDERS.items())
+                       if (folder not in STORED) or (STORED[folder][5]!=dir_mtime)]
+
+        if len(FOLDERS_new)>0:
+            DIR_MTIMES = [FOLDERS[folder] for folder in FOLDERS_new]
+            STORED_new = [STORED.get(folder) for folder in FOLDERS_new]
+            if n_threads<=1:
+                ROWS = list(map(rowArchive, [raw_dir]*len(FOLDERS_new), FOLDERS_new, DIR_MTIMES, STORED_new))
+            else:
+                with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                    ROWS = list(executor.map(rowArchive, [raw_dir]*len(FOLDERS_new), FOLDERS_new, DIR_MTIMES, STORED_new))
+            del DIR_MTIMES, STORED_new
+            con.executemany(f'INSERT OR REPLACE INTO days VALUES ({",".join("?"*len(ARCHIVE_COLUMNS))})', ROWS)
+            for row in ROWS:
+                if row[-1]!='VALID': logging.warning(f'ASCAT raw archive : {row[0]} is {row[-1]}')
+        else:
+            ROWS = []
+        FOLDERS_del = [(folder,) for folder in set(STORED) - set(FOLDERS)]
+        con.executemany('DELETE FROM days WHERE folder=?', FOLDERS_del)
+        con.commit()
+        if len(ROWS)>0 or len(FOLDERS_del)>0:
+            logging.info(f'ASCAT raw archive index refreshed : {len(ROWS)} day(s) added/updated, {len(FOLDERS_del)} removed')
+        del STORED, ROWS, FOLDERS_del
+
+        ARCHIVE = pd.read_sql_query('SELECT * FROM days ORDER BY folder', con)
+    finally:
+        con.close()
+
+    return absolutePaths(ARCHIVE, raw_dir)
+
+
+
+def absolutePaths(ARCHIVE, raw_dir):
+    """
+    Index with absolute paths of day folders and zip archives (stored relative to raw_dir), and integer sizes/times (null if no zip).
+    """
+
+    ARCHIVE['folder'] = [os.path.join(raw_dir, f) for f in ARCHIVE['folder']]
+    ARCHIVE['zip'] = [os.path.join(raw_dir, z) if isinstance(z, str) else None for z in ARCHIVE['zip']]
+    ARCHIVE[['size', 'mtime', 'dir_mtime']] = ARCHIVE[['size', 'mtime', 'dir_mtime']].astype('Int64')
+
+    return ARCHIVE
+
+
+
+def selectArchive(ARCHIVE, status=None, folders=None):
+    """
+    Select days of the index (list of rows as dicts, sorted by folder) : with status if given (e.g. 'VALID'), among folders if given.
+    """
+
+    mask = pd.Series(True, index=ARCHIVE.index)
+    if status is not None:
+        mask &= (ARCHIVE['status']==status)
+    if folders is not None:
+        mask &= ARCHIVE['folder'].isin([os.path.normpath(os.path.abspath(f)) for f in folders])
+
+    return ARCHIVE.loc[mask].sort_values(by='folder').to_dict('records')
@@ -10,7 +10,10 @@ ALERT Functions for accessing/collecting complementary data involved in alert ch
 import os
 import glob
 import json
-from ftplib import FTP
+import posixpath
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from ftplib import FTP, error_perm
 from tqdm import tqdm
 import dmpipeline.ALERT_Processing.ftp_accounts as alertauth
 
@@ -18,6 +21,13 @@ import logging
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S', level=logging.INFO)
 
 
+FTP_THREADS = 4                         # number of parallel ftp connections downloading files
+FTP_STATE = '.ftpsync'                  # suffix of the state directory of a local directory (sibling, outside scanned data directories)
+FTP_MANIFEST = 'FTP_MANIFEST.json'      # manifest of the last synchronization (remote files/dirs facts), in state directory
+FTP_PART = '.part'                      # suffix of files being downloaded, in state directory (moved to local directory once complete)
+FTP_PART_FACTS = '.json'                # suffix of remote facts (size/modify) of a file being downloaded, next to its partial file
+FTP_RECENT_DAYS = 10                    # sub-directories modified within these last days are always listed again (immutable trees)
+
 
 def read_credentials(credentials_file):
     """
@@ -29,59 +39,341 @@ def read_credentials(credentials_file):
 
 
 
+def connectFTP(credentials):
+    """
+    Open a connection to ftp server (credentials : ftp_server, ftp_user, ftp_password, and optional ftp_port, default 21)
+    """
+
+    ftp = FTP()
+    ftp.connect(credentials["ftp_server"], int(credentials.get("ftp_port", 21)))
+    ftp.login(user=credentials["ftp_user"], passwd=credentials["ftp_password"])
+
+    return ftp
+
+
+
+def closeFTP(ftp):
+    """
+    Close a connection to ftp server (politely if possible)
+    """
+
+    try:
+        ftp.quit()
+    except Exception:
+        ftp.close()
+
+
+
+def stateDirectory(local_dir):
+    """
+    State directory of the synchronization of local_dir (manifest and partial downloads) : sibling of local_dir (local_dir + FTP_STATE),
+    so that local_dir only holds complete products (scanned by processing chains), and partial files are renamed within the same filesystem.
+    """
+
+    return f'{os.path.normpath(local_dir)}{FTP_STATE}'
+
+
+
+def readManifest(state_dir):
+    """
+    Read manifest of the last synchronization (remote FILES and DIRS already synchronized, with their size/modify facts),
+    in state directory (see stateDirectory). Empty manifest if missing or unreadable.
+    """
+
+    manifest_file = os.path.join(state_dir, FTP_MANIFEST)
+    if os.path.exists(manifest_file):
+        try:
+            with open(manifest_file, "r") as json_file:
+                MANIFEST = json.load(json_file)
+            return {'FILES': MANIFEST.get('FILES', {}), 'DIRS': MANIFEST.get('DIRS', {})}
+        except ValueError:
+            logging.warning(f'Unreadable ftp manifest {manifest_file} : all files are checked again')
+
+    return {'FILES': {}, 'DIRS': {}}
+
+
+
+def writeManifest(MANIFEST, state_dir):
+    """
+    Write manifest of synchronization in state directory (json, atomic replace)
+    """
+
+    manifest_file = os.path.join(state_dir, FTP_MANIFEST)
+    with open(f'{manifest_file}.{os.getpid()}.tmp', "w") as json_file:
+        json.dump(MANIFEST, json_file, indent=1, sort_keys=True)
+    os.replace(f'{manifest_file}.{os.getpid()}.tmp', manifest_file)
+
+
+
+def listRemote(ftp, remote_path=''):
+    """
+    List a remote directory (relative to current remote directory) : name -> {'type' ('file' or 'dir'), 'size', 'modify'}
+        - from MLSD facts if supported by server
+        - from NLST, SIZE and MDTM otherwise (entries without SIZE which can be entered are directories)
+    Unknown facts are None.
+    """
+
+    ENTRIES = {}
+    try:
+        for name, facts in ftp.mlsd(remote_path, facts=['type', 'size', 'modify']):
+            if facts.get('type')=='file':
+                ENTRIES[name] = {'type': 'file', 'size': int(facts['size']) if 'size' in facts else None, 'modify': facts.get('modify')}
+            elif facts.get('type')=='dir':
+                ENTRIES[name] = {'type': 'dir', 'size': None, 'modify': facts.get('modify')}
+        return ENTRIES
+    except error_perm:
+        pass
+
+    # --- Server without MLSD ---
+    names = ftp.nlst(remote_path) if remote_path!='' else ftp.nlst()
+    cwd = ftp.pwd()
+    ftp.voidcmd('TYPE I')
+    for name in names:
+        name = posixpath.basename(name)
+        path = posixpath.join(remote_path, name)
+        try:
+            size = ftp.size(path)
+        except error_perm:
+            size = None
+            try:
+                ftp.cwd(path)
+                ftp.cwd(cwd)
+                ENTRIES[name] = {'type': 'dir', 'size': None, 'modify': None}
+                continue
+            except error_perm:
+                pass
+        try:
+            modify = ftp.sendcmd(f'MDTM {path}').split()[-1]
+        except error_perm:
+            modify = None
+        ENTRIES[name] = {'type': 'file', 'size': size, 'modify': modify}
+
+    return ENTRIES
+
+
+
+def recentRemote(modify, days=FTP_RECENT_DAYS):
+    """
+    Check if a remote modify fact (YYYYMMDDHHMMSS[.sss], UTC) is within the last days (True if unknown or unreadable).
+    """
+
+    try:
+        return datetime.now(timezone.utc) - datetime.strptime(modify[:14], '%Y%m%d%H%M%S').replace(tzinfo=timezone.utc) < timedelta(days=days)
+    except (TypeError, ValueError):
+        return True
+
+
+
+def listRemoteTree(ftp, MANIFEST, depth=0, immutable=0):
+    """
+    List remote files (relative paths -> facts) of the current remote directory and of its sub-directories up to depth.
+    All sub-directories are listed, unless immutable=1 (trees whose files are never replaced in place, e.g. daily folders of
+    copernicus archive) : then sub-directories whose modify fact is unchanged since the last synchronization (MANIFEST),
+    and older than FTP_RECENT_DAYS, are not listed again and their files are taken from MANIFEST
+    (a file replaced in place does not change the modify fact of its directory).
+    Returns remote FILES and DIRS.
+    """
+
+    FILES = {}
+    DIRS = {}
+    PATHS = [('', 0)]
+    while PATHS:
+        path, level = PATHS.pop()
+        for name, entry in listRemote(ftp, path).items():
+            rel = posixpath.join(path, name)
+            if entry['type']=='file':
+                FILES[rel] = entry
+                continue
+            if level>=depth:
+                continue
+            DIRS[rel] = entry
+            DIR_old = MANIFEST['DIRS'].get(rel)
+            if (immutable==1) and (DIR_old is not None) and (DIR_old['modify']==entry['modify']) and (not recentRemote(entry['modify'])):
+                FILES.update({f: e for f, e in MANIFEST['FILES'].items() if f.startswith(f'{rel}/')})
+            else:
+                PATHS.append((rel, level+1))
+
+    return FILES, DIRS
+
+
+
+def selectDownloads(FILES, local_dir, MANIFEST):
+    """
+    Select remote files to download (list of (relative path, facts)) :
+        - missing in local directory
+        - with local size different from remote size
+        - with remote modify changed since the last synchronization (MANIFEST)
+        - with unknown remote size and modify (cannot be compared)
+    """
+
+    DOWNLOADS = []
+    for rel, entry in sorted(FILES.items()):
+        local_file = os.path.join(local_dir, *rel.split('/'))
+        FILE_old = MANIFEST['FILES'].get(rel)
+        if not os.path.exists(local_file):
+            DOWNLOADS.append((rel, entry))
+        elif (entry['size'] is not None) and (os.path.getsize(local_file)!=entry['size']):
+            DOWNLOADS.append((rel, entry))
+        elif (FILE_old is not None) and (FILE_old['modify']!=entry['modify']):
+            DOWNLOADS.append((rel, entry))
+        elif (entry['size'] is None) and (entry['modify'] is None):
+            DOWNLOADS.append((rel, entry))
+
+    return DOWNLOADS
+
+
+
+def downloadFile(ftp, remote_path, local_file, part_file, size=None, modify=None):
+    """
+    Download one remote file into a temporary file (part_file, in state directory), renamed to local_file once complete (atomic) :
+        - a partial temporary file of a previous transfer is resumed (REST), only if remote size and modify are known
+          and unchanged since it was started (facts kept next to it, FTP_PART_FACTS), otherwise it is downloaded again
+        - the size of the downloaded file is checked against remote size
+    """
+
+    facts_file = f'{part_file}{FTP_PART_FACTS}'
+    FACTS = {'size': size, 'modify': modify}
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    if offset>0:
+        try:
+            with open(facts_file, "r") as json_file:
+                FACTS_part = json.load(json_file)
+        except (OSError, ValueError):
+            FACTS_part = None
+        if (size is None) or (modify is None) or (offset>size) or (FACTS_part!=FACTS):
+            logging.info(f'{remote_path} : partial download of another version of the file, downloaded again')
+            offset = 0
+    if offset==0:
+        with open(facts_file, "w") as json_file:
+            json.dump(FACTS, json_file)
+
+    if (offset==0) or (offset<size):
+        try:
+            with open(part_file, 'ab' if offset>0 else 'wb') as f:
+                ftp.retrbinary(f'RETR {remote_path}', f.write, rest=(offset if offset>0 else None))
+        except error_perm as e:
+            if offset==0: raise
+            logging.info(f'{remote_path} : transfer cannot be resumed ({str(e).strip()}), downloaded again')
+            with open(part_file, 'wb') as f:
+                ftp.retrbinary(f'RETR {remote_path}', f.write)
+
+    if (size is not None) and (os.path.getsize(part_file)!=size):
+        raise Exception(f'Incomplete download ({os.path.getsize(part_file)}/{size} bytes)')
+
+    try:
+        os.replace(part_file, local_file)
+    except PermissionError:
+        os.remove(local_file)
+        os.replace(part_file, local_file)
+    os.remove(facts_file)
+
+
+
+def downloadFiles(credentials, remote_dir, DOWNLOADS, local_dir, state_dir, progress=None):
+    """
+    Download remote files (list of (relative path, facts)) into local directory, sequentially on one ftp connection.
+    Errors of a file are logged (its partial download is kept in state directory, to be resumed), and next files are downloaded.
+    Returns the list of files downloaded (relative paths).
+    """
+
+    done = []
+    ftp = connectFTP(credentials)
+    try:
+        if remote_dir is not None: ftp.cwd(remote_dir)
+        for rel, entry in DOWNLOADS:
+            local_file = os.path.join(local_dir, *rel.split('/'))
+            part_file = os.path.join(state_dir, *rel.split('/')) + FTP_PART
+            os.makedirs(os.path.dirname(local_file), exist_ok=True)
+            os.makedirs(os.path.dirname(part_file), exist_ok=True)
+            try:
+                downloadFile(ftp, rel, local_file, part_file, entry['size'], entry['modify'])
+                done.append(rel)
+                logging.info(f"{rel} Downloaded with success")
+            except Exception as e:
+                if '[Errno 13] Permission denied' in str(e):
+                    logging.info(f"{rel} File already exists : not replaced (permission denied)")
+                else:
+                    logging.critical(f"An unknown error has occured : {rel} : {str(e)}")
+            if progress is not None: progress.update(1)
+    finally:
+        closeFTP(ftp)
+
+    return done
+
+
+
+def syncFTP(credentials, local_dir, remote_dir=None, depth=0, immutable=0, n_threads=FTP_THREADS, desc=None):
+    """
+    Incremental synchronization of remote files (remote_dir, and its sub-directories up to depth) into local directory :
+        - remote listing (MLSD size/modify, or NLST/SIZE/MDTM) is compared to local files and to the manifest
+          of the last synchronization (FTP_MANIFEST in state directory, see stateDirectory/listRemoteTree/selectDownloads),
+          unchanged old sub-directories not being listed again if immutable=1
+        - only new or changed files are downloaded, into temporary files of state directory moved to local directory once complete,
+          partial transfers being resumed (REST)
+        - files are downloaded over n_threads parallel ftp connections
+    The manifest is then updated with all remote files synchronized (failed downloads are checked again at next synchronization).
+    Returns the list of files downloaded (relative paths), None if remote_dir is not found on server.
+    """
+
+    state_dir = stateDirectory(local_dir)
+    os.makedirs(local_dir, exist_ok=True)
+    os.makedirs(state_dir, exist_ok=True)
+    MANIFEST = readManifest(state_dir)
+
+    # --- Listing remote files and selecting new/changed ones ---
+    ftp = connectFTP(credentials)
+    try:
+        if remote_dir is not None:
+            try:
+                ftp.cwd(remote_dir)
+            except error_perm:
+                logging.info(f'{remote_dir} was not found on server')
+                return None
+        FILES, DIRS = listRemoteTree(ftp, MANIFEST, depth, immutable)
+    finally:
+        closeFTP(ftp)
+    DOWNLOADS = selectDownloads(FILES, local_dir, MANIFEST)
+    logging.info(f'{len(FILES)} remote files, {len(DOWNLOADS)} new/changed files to download')
+
+    # --- Downloading on parallel connections (files dealt round-robin) ---
+    n_threads = max(1, min(n_threads, len(DOWNLOADS)))
+    CHUNKS = [DOWNLOADS[i::n_threads] for i in range(n_threads)]
+    done = []
+    with tqdm(total=len(DOWNLOADS), desc=desc) as progress:
+        if n_threads==1:
+            done = downloadFiles(credentials, remote_dir, CHUNKS[0], local_dir, state_dir, progress)
+        else:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                FUTURES = [executor.submit(downloadFiles, credentials, remote_dir, CHUNK, local_dir, state_dir, progress) for CHUNK in CHUNKS]
+                for future in FUTURES:
+                    done += future.result()
+
+    # --- Updating manifest (without failed downloads, nor their directories) ---
+    failed = set(rel for rel, _ in DOWNLOADS) - set(done)
+    MANIFEST = {'FILES': {rel: entry for rel, entry in FILES.items() if rel not in failed},
+                'DIRS': {rel: entry for rel, entry in DIRS.items() if not any(f.startswith(f'{rel}/') for f in failed)}}
+    writeManifest(MANIFEST, state_dir)
+    if len(failed)>0:
+        logging.warning(f'{len(failed)} files not downloaded : checked again at next synchronization')
+
+    return done
+
+
+
 def download_copernicus_ftp(credentials_file, local_coper_dir):
     """
     Function for downloading directories/files from copernicus-vito ftp server to local directory
+    (incremental synchronization of daily directories, see syncFTP).
+    Daily directories are immutable (products are never replaced in place) : old directories unchanged since
+    the last synchronization are not listed again (directories of the last FTP_RECENT_DAYS days always are).
     """
     # Identification to ftp server
     credentials = read_credentials(credentials_file)
-    ftp = FTP(credentials["ftp_server"])
-    ftp.login(user=credentials["ftp_user"], passwd=credentials["ftp_password"])
     remote_dir = credentials["ftp_directory"]
 
-    # List directories on server
-    dir_list = ftp.nlst()
-    for dir in dir_list:
-        # logging.info(dir)
-        if dir!=remote_dir: continue
-        else: break
-    
-    # Missing remote_dir -> STOP
-    if dir!=remote_dir:
-        logging.info(f'{remote_dir} was not found on server')
-    
-    # OR go to remote_dir and list dir -> CONTINUE
-    else:
-        os.makedirs(local_coper_dir, exist_ok=True)
-        ftp.cwd(remote_dir)
-        remotedir_path = ftp.pwd()
-        new_dir_list = ftp.nlst()
-
-        # Go to new_remote_dir list
-        for new_dir in tqdm(new_dir_list, desc='COPERNICUS DOWNLOADING'):
-            # logging.info(f'Directory {new_dir}')
-            new_local_dir = os.path.join(local_coper_dir, new_dir)
-            os.makedirs(new_local_dir, exist_ok=True)
-            os.chdir(new_local_dir)
-            ftp.cwd(new_dir)
-
-            # Local files downloading
-            files_list = ftp.nlst()
-            for file in files_list:
-                try:
-                    with open(file, "wb") as f:
-                        ftp.retrbinary("RETR " + file, f.write)
-                        logging.info(f"{file} Downloaded with success")
-                except Exception as e:
-                    if '[Errno 13] Permission denied' in str(e):
-                        logging.info(f"{file} File already exists : not downloaded")
-                    else:
-                        logging.critical(f"An unknown error has occured : {str(e)}")
-            
-            ftp.cwd(remotedir_path)
-            os.chdir(local_coper_dir)
-        
-        ftp.quit()
+    # Synchronize remote_dir (daily directories) into local directory
+    done = syncFTP(credentials, local_coper_dir, remote_dir, depth=1, immutable=1, desc='COPERNICUS DOWNLOADING')
+    if done is not None:
         logging.info("Downloading Copernicus completed")
 
 
@@ -89,34 +381,14 @@ def download_copernicus_ftp(credentials_file, local_coper_dir):
 def download_meteo_ftp(credentials_file, local_meteo_dir):
     """
     Function for downloading (csv) files from meteo-france ftp server to local directory
+    (incremental synchronization, files changed on server replace local ones, see syncFTP)
     """
 
     # Identification to ftp server
     credentials = read_credentials(credentials_file)
-    ftp = FTP(credentials["ftp_server"])
-    ftp.login(user=credentials["ftp_user"], passwd=credentials["ftp_password"])
 
-    # List files on server
-    files_list = ftp.nlst()
-
-    # Local downloading
-    os.makedirs(local_meteo_dir, exist_ok=True)
-    os.chdir(local_meteo_dir)
-    for file in tqdm(files_list, desc='METEO DOWNLOADING'):
-        try:
-            with open(file, "wb") as f:
-                ftp.retrbinary("RETR " + file, f.write)
-                logging.info(f"{file} Downloaded with success")
-        except Exception as e:
-            if '[Errno 13] Permission denied' in str(e):
-                os.remove(file)
-                with open(file, "wb") as f:
-                    ftp.retrbinary("RETR " + file, f.write)
-                    logging.info(f'{file} File already exists: replaced by new version')
-            else:
-                logging.critical(f"An unknown error has occured : {str(e)}")
-    
-    ftp.quit()
+    # Synchronize files of server into local directory
+    syncFTP(credentials, local_meteo_dir, None, depth=0, desc='METEO DOWNLOADING')
     logging.info("Downloading Meteo completed")
 
 
@@ -13,14 +13,25 @@ import glob
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
+import geopandas as gpd
 import rasterio
 import rasterio.mask
+import rasterio.windows
 import copy
+import zlib
+import functools
 from zipfile import BadZipFile, ZipFile
 from pathlib import Path
 import fnmatch
 from tqdm import tqdm
 import dmpipeline.GEOSTATS_Processing.GEOSTATS_processing_functions as geostats
+import dmpipeline.GEOSTATS_Processing.GEOSTATS_store_functions as gstore
+import dmpipeline.DROUGHT_Processing.DROUGHT_blocks_functions as blocks
+import dmpipeline.DROUGHT_Processing.DROUGHT_anomaly_functions as anomaly
+import dmpipeline.DROUGHT_Processing.DROUGHT_io_functions as rasters_io
+import dmpipeline.DROUGHT_Processing.DROUGHT_datacube_functions as cubes
+import dmpipeline.DROUGHT_Processing.DROUGHT_catalog_functions as catalog
+import dmpipeline.ALERT_Processing.ALERT_archive_functions as archive
 
 import warnings
 warnings.simplefilter(action='ignore', category=RuntimeWarning)
@@ -29,30 +40,30 @@ import logging
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S', level=logging.INFO)
 
 
+ASCAT_THREADS = 4   # number of threads decoding/preprocessing daily ASCAT products of a month
+ASCAT_CROP = 0      # default territory-window cropping of ASCAT products (see getCropASCAT)
+ASCAT_MARGIN = 5    # margin (pixels) around the territory window of ASCAT products
+
 
 def filterPERIOD_DATA(DATAfiles, DATAType, period_start, period_end):
     """
     Filter list of DATA files acccording to input period start and period end
+    (dates of all files are parsed at once)
     """
 
-    DATAfiles_filt = []
-    dates_filt = []
-
-    for f in DATAfiles:
+    if DATAType=='ASCAT': DATES_str = [os.path.basename(f).split('_')[1][:8] for f in DATAfiles]
+    elif DATAType=='VHI': DATES_str = [os.path.basename(f).split('_')[1][:-5]+'01' for f in DATAfiles]
+    else:
+        logging.critical('Wrong inptu data type in filtering period function')
+        raise Exception('Wrong DATA type')
 
-        if DATAType=='ASCAT': date_str = os.path.basename(f).split('_')[1][:8]
-        elif DATAType=='VHI': date_str = os.path.basename(f).split('_')[1][:-5]+'01'
-        else: logging.critical('Wrong inptu data type in filtering period function')
-        
-        try:
-            date = pd.to_datetime(date_str, format='%Y%m%d')
-        except ValueError:
-            logging.info(f'Filtering period DATA : Wrong date format for {date_str}, then not considered')
-            continue
+    DATES = pd.to_datetime(pd.Series(DATES_str, dtype=object), format='%Y%m%d', errors='coerce')
+    for date_str in pd.Series(DATES_str)[DATES.isna()]:
+        logging.info(f'Filtering period DATA : Wrong date format for {date_str}, then not considered')
 
-        if period_start <= date <= period_end:
-            DATAfiles_filt.append(f)
-            dates_filt.append(date)
+    mask = ((DATES >= period_start) & (DATES <= period_end)).values
+    DATAfiles_filt = [f for f, m in zip(DATAfiles, mask) if m]
+    dates_filt = list(DATES[mask])
 
     return DATAfiles_filt, dates_filt
 
@@ -110,7 +121,8 @@ def auto_processingPERIOD(CONFIG):
 
     TERRITORY_str = CONFIG['TERRITORY'].replace('"', '').replace(' ', '_').replace('(', '').replace(')', '')
     DATA_HISTO = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, '0_INDICES', 'ASCAT', 'MONTH')
-    histo_files = glob.glob(os.path.join(DATA_HISTO, '*.tif'))
+    CATALOG = catalog.refreshCatalog(catalog.getCatalog(CONFIG), [DATA_HISTO])
+    histo_files = catalog.selectCatalog(CATALOG, DATA_HISTO)
 
     # Set new PERIOD END = end of the previous month (PERIOD_END is exclusive)
     date_now = pd.Timestamp.now()
@@ -120,8 +132,7 @@ def auto_processingPERIOD(CONFIG):
 
     # IF HISTO PRODUCTS : Set new PERIOD START according to last histo product processed
     if len(histo_files)>0:
-        dates_list = [os.path.basename(f).split('_')[2] for f in histo_files]
-        dates = np.unique(dates_list)
+        dates = np.unique(CATALOG['date'].dropna())
         dates = pd.to_datetime(dates, format='%Y%m')
         period_start_histo = pd.Series(dates).min()
         period_end_histo = pd.Series(dates).max()
@@ -181,8 +192,11 @@ def Check_Products_ASCAT(CONFIG):
     PERIOD_START = CONFIG['PERIOD_START']
     PERIOD_END = CONFIG['PERIOD_END']
 
-    # --- Extracts ASCAT on the specific PERIOD and CHECK IF PRODUCTS ARE AVAILABLE ---
-    ASCATdataset = glob.glob(os.path.join(DATA_RAW,'SWI_*'))
+    # --- Extracts ASCAT on the specific PERIOD and CHECK IF PRODUCTS ARE AVAILABLE (valid days of the index of raw archive) ---
+    ARCHIVE = archive.refreshArchive(archive.getArchive(CONFIG), DATA_RAW)
+    ASCATdataset = [DAY['folder'] for DAY in archive.selectArchive(ARCHIVE, 'VALID')]
+    if len(ASCATdataset)<len(ARCHIVE):
+        logging.info(f'{len(ARCHIVE)-len(ASCATdataset)} days of ASCAT raw archive are corrupt, incomplete or without zip : not considered')
     if len(ASCATdataset)==0:
         logging.critical('\nNO ASCAT PRODUCTS AVAILABLE\n')
         raise Exception('NO ASCAT PRODUCTS AVAILABLE')
@@ -532,6 +546,7 @@ def prepare_DATAFolders(CONFIG):
     TREE_DIR = [os.path.join(HISTO_DIR, '0_INDICES', 'ASCAT', '0_RAW'),
                 os.path.join(HISTO_DIR, '0_INDICES', 'ASCAT', 'DAY'),
                 os.path.join(HISTO_DIR, '0_INDICES', 'ASCAT', 'MONTH'),
+                os.path.join(HISTO_DIR, '0_INDICES', 'ASCAT', 'ACCUM'),
                 os.path.join(HISTO_DIR, '1_INDICATEURS', 'ALERT', 'MAI', 'MONTH'),
                 os.path.join(HISTO_DIR, '1_INDICATEURS', 'ALERT', 'MAI', 'STATS'),
                 os.path.join(HISTO_DIR, '1_INDICATEURS', 'ALERT', 'METEO')]
@@ -721,9 +736,33 @@ def getMaskFilesFromInput(path):
 
 
 
-def extractSWI(file):
+def decodeASCAT(src_ds, name, window=None):
+    """
+    Decoding one ASCAT product (opened dataset) into physical values, on window if given (e.g. territory window) :
+        - SWI-020 : rescaling (x0.005), no data (255) set to NaN
+        - QFLAG : rescaling (x0.005), no data kept to 255
+        - SSF : flags, as read
     """
-    Extracting ASCAT Soil Water Index :
+
+    if name=='SSF':
+        return src_ds.read(1, window=window)
+
+    # Rescaling
+    dn = src_ds.read(1, window=window).astype(np.float32)
+    phys = dn * 0.005
+
+    # Setting no data
+    nodata_dn = 255
+    if name=='SWI-020': phys[dn==nodata_dn] = np.nan
+    else: phys[dn==nodata_dn] = nodata_dn
+
+    return phys
+
+
+
+def extractSWI(file, window=None):
+    """
+    Extracting ASCAT Soil Water Index (on window if given, profile of the window grid) :
         - rescaling
         - setting no data
     """
@@ -735,17 +774,10 @@ def extractSWI(file):
         with zf.open(tf_path) as tf:
             with rasterio.open(tf, GEOREF_SOURCES='INTERNAL') as swi_ds:
                 profile_out = swi_ds.profile
-                
-                # Rescaling
-                swi_dn = swi_ds.read(1).astype(np.float32)
-                swi_phys = swi_dn * 0.005
-                    
-                # Setting no data
-                nodata_dn = 255
-                nodata_phys = np.nan
-                swi_phys[swi_dn==nodata_dn] = nodata_phys
-                
-                profile_out.update(dtype=rasterio.float32, count=1, nodata=nodata_phys)
+                swi_phys = decodeASCAT(swi_ds, 'SWI-020', window)
+                profile_out.update(dtype=rasterio.float32, count=1, nodata=np.nan)
+                if window is not None:
+                    profile_out.update(height=swi_phys.shape[0], width=swi_phys.shape[1], transform=swi_ds.window_transform(window))
     
     return swi_phys, profile_out
 
@@ -758,60 +790,245 @@ def extractMask(masks, maskName):
         - setting no data
     """
      
-    if maskName == "QFLAG":
-        if masks is not None:
-            qflag = masks['QFLAG']
-            zf_path = qflag.split('!')[0][6:]
-            tf_path = qflag.split('!')[1]
-            with ZipFile(zf_path) as zf:
-                with zf.open(tf_path) as tf:
-                    with rasterio.open(tf) as mask_ds:
-                        profile_out = mask_ds.profile
-                        # Rescaling
-                        m_dn = mask_ds.read(1).astype(np.float32)
-                        m = m_dn * 0.005
-                        # Setting no data
-                        nodata = 255
-                        m[m_dn==nodata] = nodata
-        else:
-            logging.info("QFLAG extraction needs mask param.")
-            raise Exception()
-    
-    elif maskName == "SSF":
-        if masks is not None:
-            ssf = masks['SSF']
-            zf_path = ssf.split('!')[0][6:]
-            tf_path = ssf.split('!')[1]
-            with ZipFile(zf_path) as zf:
-                with zf.open(tf_path) as tf:
-                    with rasterio.open(tf) as mask_ds:
-                        profile_out = mask_ds.profile
-                        m = mask_ds.read(1)
-        else:
-            logging.info("SSF extraction needs masks param.")
-            raise Exception()
-    
-    else:
+    if maskName not in ['QFLAG', 'SSF']:
         logging.info(f"Mask name ({maskName}) not valid.")
         raise Exception()
+    if masks is None:
+        logging.info(f"{maskName} extraction needs masks param.")
+        raise Exception()
+
+    zf_path = masks[maskName].split('!')[0][6:]
+    tf_path = masks[maskName].split('!')[1]
+    with ZipFile(zf_path) as zf:
+        with zf.open(tf_path) as tf:
+            with rasterio.open(tf) as mask_ds:
+                profile_out = mask_ds.profile
+                m = decodeASCAT(mask_ds, maskName)
 
     return m, profile_out
 
 
 
-def extractComposite(mat_in):
+def readASCAT_Day(SWIFile, window=None, MEMBERS=None):
     """
-    Temporal compositing on the different images in mat_in:
-        - average is computed (MEAN_comp)
-        - count is also computed to count number of valid data used per pixel (COUNT_comp)
+    Reading one daily ASCAT zip archive, opened once : SWI-020, QFLAG-020 and SSF products are given by MEMBERS
+    (from the index of the raw archive) or found in the listing of members (see archive.ASCAT_MEMBERS),
+    and decoded from the same archive handle (see decodeASCAT), only on window if given (territory window, see windowASCAT).
+    Returns a dict with arrays (SWI-020, QFLAG, SSF), 'profile' of SWI-020 (float32, nodata NaN) and 'names' of members,
+    or "BadZipFileError"/"FileNotFoundError" (as getSWI020FileFromInput).
     """
-    
-    COUNT = np.zeros_like(mat_in, dtype='uint8')
-    COUNT = ~np.isnan(mat_in)
-    
-    MEAN_comp = np.nanmean(mat_in,axis=2)
-    COUNT_comp = np.sum(COUNT,axis=2)
-    
+
+    path = Path(SWIFile)
+    if not (path.is_file() and path.suffix == ".zip"):
+        logging.info(f"Error file {path} does not exists")
+        return "FileNotFoundError"
+
+    DAY = {'names': {}}
+    try:
+        with ZipFile(path) as zf:
+            file_list = zf.namelist() if MEMBERS is None else None
+            for name, pattern in archive.ASCAT_MEMBERS.items():
+                if MEMBERS is None: members = [el for el in file_list if fnmatch.fnmatch(el, pattern)]
+                else: members = [MEMBERS[name]] if MEMBERS.get(name) is not None else []
+                if len(members)==0:
+                    logging.critical(f'Missing {name} product in ASCAT archive : {path}')
+                    raise Exception('Missing ASCAT product')
+                with zf.open(members[0]) as tf:
+                    with rasterio.open(tf, GEOREF_SOURCES='INTERNAL') as src_ds:
+                        DAY[name] = decodeASCAT(src_ds, name, window)
+                        if name=='SWI-020':
+                            DAY['profile'] = src_ds.profile
+                            DAY['profile'].update(dtype=rasterio.float32, count=1, nodata=np.nan)
+                            if window is not None:
+                                DAY['profile'].update(height=DAY[name].shape[0], width=DAY[name].shape[1], transform=src_ds.window_transform(window))
+                DAY["names"][name] = f"zip://{path}!{members[0]}"
+    except BadZipFile:
+        logging.info(f"!! BadZipFile !! :\n  {path}\n")
+        return "BadZipFileError"
+
+    return DAY
+
+
+
+def preprocessASCAT_Day(DAY_ARCHIVE, mask, LAND, outdir_preproc, window=None):
+    """
+    Preprocessing of one daily ASCAT product (DAY_ARCHIVE : row of the index of the raw archive, see archive.refreshArchive),
+    run in worker threads (see processingASCAT) :
+        - reading SWI-020 and masks from the zip archive opened once (see readASCAT_Day), on territory window if given
+        - estimating scores over land (qflag, ssflag), quality masking and land masking of SWI
+        - saving preprocessed SWI (*_PREPROC.tif) IF NANSCORE < 100 %
+    Returns a dict with in_file_name, date, error (None, "BadZipFileError" or "FileNotFoundError"),
+    masked SWI and QA row (None if not saved).
+    """
+
+    # Days without zip archive, or with a corrupt/incomplete archive (integrity status of the index)
+    if DAY_ARCHIVE['status']=='MISSING':
+        return {'in_file_name': os.path.basename(DAY_ARCHIVE['folder']), 'date': DAY_ARCHIVE['date'], 'error': "FileNotFoundError", 'SWI': None, 'QA': None}
+
+    SWIFile = DAY_ARCHIVE['zip']
+    in_file_name = os.path.basename(SWIFile).split('.zip')[0]
+    date = in_file_name.split('_')[3][:8]
+    RESULT = {'in_file_name': in_file_name, 'date': date, 'error': None, 'SWI': None, 'QA': None}
+    if DAY_ARCHIVE['status']!='VALID':
+        RESULT['error'] = "BadZipFileError"
+        return RESULT
+
+    DAY = readASCAT_Day(SWIFile, window, {'SWI-020': DAY_ARCHIVE['swi'], 'QFLAG': DAY_ARCHIVE['qflag'], 'SSF': DAY_ARCHIVE['ssf']})
+    if isinstance(DAY, str):
+        RESULT['error'] = DAY
+        return RESULT
+    Nb_ALLDATA_land = LAND.size
+
+    # QFLAG mask : 50 % of threshold for ssm
+    QFmask = (DAY['QFLAG'] <= 0.5)
+    Qf_score = np.sum(QFmask.ravel()[LAND]==1) / Nb_ALLDATA_land
+
+    # SSF mask : Unknown=0, Frozen=2, Water=3, NotDetermined=255
+    SSF_data = DAY['SSF']
+    SSFmask = (SSF_data==0) | (SSF_data==2) | (SSF_data==3) | (SSF_data==255)
+    ssf_score = np.sum(SSFmask.ravel()[LAND]==1) / Nb_ALLDATA_land
+
+    # --- Applying Quality Masks and Land Mask on SWI ---
+    QMask = (QFmask==1) | (SSFmask==1)
+    SWI_Qmasked = DAY['SWI-020']
+    SWI_Qmasked[(QMask==1) | (mask==0)] = np.nan
+    del QMask, QFmask, SSFmask, SSF_data
+
+    # --- Estimating Percentage of No Data AFTER Quality Masking (only on LAND) ---
+    Nb_NODATA = np.sum(np.isnan(SWI_Qmasked.ravel()[LAND]))
+    NAN_score = Nb_NODATA / Nb_ALLDATA_land
+
+    # --- Saving Preprocessed SWI and Quality scores IF NANSCORE < 100 % ---
+    if NAN_score<1 :
+        swi_file_name = os.path.basename(DAY['names']['SWI-020']).split('.tiff')[0]
+        date_old = swi_file_name.split('_')[3]
+        out_file_name = os.path.join(outdir_preproc, f'{swi_file_name.replace(date_old,date)}_PREPROC.tif')
+        with rasterio.open(out_file_name, 'w', **DAY['profile']) as out_ds:
+            out_ds.write(SWI_Qmasked, 1)
+
+        RESULT['SWI'] = SWI_Qmasked
+        RESULT['QA'] = {'FILE NAME':in_file_name,'DATE':pd.to_datetime(date, format='%Y%m%d'),
+                        'NAN SCORE SWI-020':NAN_score,'QFLAG-020':Qf_score, 'SSFLAG':ssf_score}
+
+    return RESULT
+
+
+
+def getCropASCAT(CONFIG):
+    """
+    Read territory-window cropping option of ASCAT products from CONFIG['ASCAT_CROP'] (default ASCAT_CROP) :
+    if 1, ASCAT products are only read on the territory window (see windowASCAT).
+    """
+
+    if (CONFIG.get('ASCAT_CROP') is None) or (CONFIG['ASCAT_CROP']==''): go_crop = ASCAT_CROP
+    else: go_crop = int(CONFIG['ASCAT_CROP'])
+
+    return go_crop
+
+
+
+def windowASCAT(profile_like, file_areas, margin=ASCAT_MARGIN):
+    """
+    Territory window on the grid of ASCAT products (profile_like) :
+        - bounds of areas (shapefile, reprojected to the crs of the grid), extended by a margin (pixels)
+        - rounded outwards to whole pixels, and clipped to the grid
+    Returns the window and the profile of the cropped grid.
+    """
+
+    areas_gdf = gpd.read_file(file_areas).to_crs(profile_like['crs'])
+    window = rasterio.windows.from_bounds(*areas_gdf.total_bounds, transform=profile_like['transform'])
+    row_start = max(int(np.floor(window.row_off)) - margin, 0)
+    col_start = max(int(np.floor(window.col_off)) - margin, 0)
+    row_stop = min(int(np.ceil(window.row_off + window.height)) + margin, profile_like['height'])
+    col_stop = min(int(np.ceil(window.col_off + window.width)) + margin, profile_like['width'])
+    if (row_stop<=row_start) or (col_stop<=col_start):
+        logging.critical('Territory areas do not intersect grid of ASCAT products')
+        raise Exception('Territory areas outside ASCAT grid')
+    window = rasterio.windows.Window(col_start, row_start, col_stop-col_start, row_stop-row_start)
+
+    profile_out = copy.deepcopy(profile_like)
+    profile_out.update(height=int(window.height), width=int(window.width),
+                       transform=rasterio.windows.transform(window, profile_like['transform']))
+
+    return window, profile_out
+
+
+
+def keyASCAT_Day(DAY_ARCHIVE):
+    """
+    Key identifying one daily ASCAT product (row of the index of the raw archive) in compositing accumulators :
+    name and size of its zip archive (a re-downloaded archive of different size is a new product). None if folder has no zip archive.
+    """
+
+    if DAY_ARCHIVE['zip'] is None:
+        return None
+
+    return f'{os.path.basename(DAY_ARCHIVE["zip"])}:{int(DAY_ARCHIVE["size"])}'
+
+
+
+def loadAccumulators(accum_file, profile, mask, DAYS_keys):
+    """
+    Load the persisted compositing accumulators of a month (running SUM of data, COUNT of valid days, keys of DAYS merged),
+    IF they were computed on the same grid (profile) and land mask, and all days merged are still in DAYS_keys (days to composite).
+    Otherwise (or if missing), new empty accumulators are returned (month is rebuilt).
+    """
+
+    SUM = np.zeros((profile['height'],profile['width']), 'float64')
+    COUNT = np.zeros((profile['height'],profile['width']), 'uint8')
+    if not os.path.exists(accum_file):
+        return SUM, COUNT, []
+
+    with np.load(accum_file) as f_accum:
+        ACCUM = dict(f_accum)
+    DAYS = list(ACCUM['DAYS'])
+    if (ACCUM['SUM'].shape!=SUM.shape) or (tuple(ACCUM['TRANSFORM'])!=tuple(profile['transform'])[:6]) \
+       or (int(ACCUM['MASK_CRC'])!=zlib.crc32(np.ascontiguousarray(mask))):
+        logging.info(f'Compositing accumulators of another grid/mask : month is rebuilt ({os.path.basename(accum_file)})')
+        return SUM, COUNT, []
+    if not set(DAYS).issubset(DAYS_keys):
+        logging.info(f'Days merged in compositing accumulators are changed or not to composite : month is rebuilt ({os.path.basename(accum_file)})')
+        return SUM, COUNT, []
+
+    return ACCUM['SUM'], ACCUM['COUNT'], DAYS
+
+
+
+def saveAccumulators(accum_file, SUM, COUNT, DAYS, profile, mask):
+    """
+    Save the compositing accumulators of a month (npz, atomic replace), with keys of days merged, grid and land mask checksum.
+    """
+
+    with open(f'{accum_file}.{os.getpid()}.tmp', 'wb') as f:
+        np.savez_compressed(f, SUM=SUM, COUNT=COUNT, DAYS=np.array(DAYS, dtype=str),
+                            TRANSFORM=np.array(tuple(profile['transform'])[:6]), MASK_CRC=zlib.crc32(np.ascontiguousarray(mask)))
+    os.replace(f'{accum_file}.{os.getpid()}.tmp', accum_file)
+
+
+
+def accumulateComposite(SUM, COUNT, DATA):
+    """
+    Add one image (DATA) to running compositing accumulators (in place) :
+    SUM of valid data (float64), COUNT of valid data per pixel (uint8).
+    """
+
+    valid = ~np.isnan(DATA)
+    SUM[valid] += DATA[valid]
+    COUNT += valid
+
+
+
+def extractComposite(SUM, COUNT):
+    """
+    Temporal compositing from running accumulators (see accumulateComposite) :
+        - average is computed (MEAN_comp, NaN where no valid data)
+        - count of valid data used per pixel (COUNT_comp)
+    """
+
+    MEAN_comp = np.full(SUM.shape, np.nan, 'float32')
+    np.divide(SUM, COUNT, out=MEAN_comp, where=(COUNT>0), casting='unsafe')
+    COUNT_comp = COUNT
+
     return MEAN_comp, COUNT_comp
 
 
@@ -833,6 +1050,18 @@ def processingASCAT(CONFIG, OUTDIR_PATHS, COLLECTION):
          - Composited ASCAT SWI product (*_COMPM.tif)
     
     Note: Output composite product have 2 bands (b1=average data, b2=count)
+
+    Note 2: Each daily zip archive is opened once (see readASCAT_Day), days of a month are preprocessed
+            by ASCAT_THREADS worker threads, and the QA table is appended once per month.
+            Zip paths, members and integrity status of days are read from the index of the raw archive (see archive.refreshArchive).
+
+    Note 3: Month compositing streams over days (running sum/count accumulators). Accumulators of a partial month
+            are persisted in data_histo (ASCAT/ACCUM), so that a next run only decodes the new days of the month
+            (QA table and preprocessed products of a run are only those of the decoded days).
+
+    Note 4: IF CONFIG['ASCAT_CROP']=1, products are only read on the territory window (areas bounds plus margin),
+            and preprocessed/composited products and mask_Areas_MAI are on this cropped grid
+            (ASCAT composites of data_histo need to be on the same grid to compute MAI).
     """
     
     logging.info('\n\n--- PREPROCESSING and COMPOSITING ASCAT ---\n')
@@ -844,14 +1073,40 @@ def processingASCAT(CONFIG, OUTDIR_PATHS, COLLECTION):
 
     TERRITORY_str = CONFIG['TERRITORY'].replace('"', '').replace(' ', '_').replace('(', '').replace(')', '')
     ANNEX_DIR = os.path.join(CONFIG['ANNEX_DIR'], TERRITORY_str)
-    SWIFolders = COLLECTION
-
-    QA_dict = pd.DataFrame(columns=['FILE NAME','DATE','NAN SCORE SWI-020','QFLAG-020','SSFLAG'])
+    ACCUM_DIR = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, '0_INDICES', 'ASCAT', 'ACCUM')
+    os.makedirs(ACCUM_DIR, exist_ok=True)
+    DATA_RAW = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, '0_INDICES', 'ASCAT', '0_RAW')
+
+    # --- Days to process from the index of the raw archive (zip path, members, integrity status) ---
+    ARCHIVE = archive.refreshArchive(archive.getArchive(CONFIG), DATA_RAW)
+    DAYS = archive.selectArchive(ARCHIVE, folders=COLLECTION)
+    if len(DAYS)<len(COLLECTION):
+        logging.warning(f'{len(COLLECTION)-len(DAYS)} ASCAT folders not found in raw archive {DATA_RAW} : not processed')
+    DAYS_like = [DAY for DAY in DAYS if DAY['status']=='VALID']
+    if len(DAYS_like)==0:
+        logging.critical('No valid ASCAT products in raw archive')
+        raise Exception('No valid ASCAT products')
+    SWIFolders = [DAY['folder'] for DAY in DAYS]
+
+    QA_columns = ['FILE NAME','DATE','NAN SCORE SWI-020','QFLAG-020','SSFLAG']
+    QA_written = False
     QAtable_filename = f'PREPROC_ASCAT_{TERRITORY_str}_{date_start_str}_{date_end_str}.csv'
     
-    SWIFile_like = glob.glob(os.path.join(SWIFolders[0],'*.zip'))[0]
-    swi_like = getSWI020FileFromInput(SWIFile_like)
+    go_crop = getCropASCAT(CONFIG)
+    file_areas = glob.glob(os.path.join(ANNEX_DIR, 'Areas', '*.shp'))
+    
+    swi_like = {'SWI-020': f"zip://{DAYS_like[0]['zip']}!{DAYS_like[0]['swi']}"}
     SWI_data, profile_like = extractSWI(swi_like)
+
+    # --- Territory window (areas bounds plus margin) : products are only read/written on this cropped grid ---
+    window = None
+    if go_crop==1:
+        if len(file_areas)==0:
+            logging.critical('Missing input landmask shapefile for territory window of ASCAT products')
+            raise Exception ('Missing input landmask shapefile for territory window of ASCAT products')
+        window, profile_like = windowASCAT(profile_like, file_areas[0])
+        SWI_data = SWI_data[window.toslices()]
+        logging.info(f'ASCAT products cropped to territory window : {profile_like["height"]} x {profile_like["width"]} pixels')
     profile_out = copy.deepcopy(profile_like)
     profile_out.update(count=2)
 
@@ -860,20 +1115,27 @@ def processingASCAT(CONFIG, OUTDIR_PATHS, COLLECTION):
     m_list = [os.path.basename(f).split('_')[1][4:6] for f in SWIFolders]
     m_str = np.unique(m_list)
 
-    # --- Prepare input mask (for estimating nanscores on land) ---
+    # --- Prepare input mask (for estimating nanscores on land), on the grid of products ---
     mask_ok = len(glob.glob(os.path.join(OUTDIR_PATHS[-1],'mask_Areas_MAI.tif')))>0
+    if mask_ok==1:
+        with rasterio.open(os.path.join(OUTDIR_PATHS[-1],'mask_Areas_MAI.tif')) as area_ds:
+            if area_ds.shape!=(profile_like['height'],profile_like['width']):
+                logging.info('Grid of mask_Areas_MAI differs from grid of ASCAT products : masks are re-created')
+                mask_ok = 0
     if mask_ok==0:
-        file_areas = glob.glob(os.path.join(ANNEX_DIR, 'Areas', '*.shp'))
         if len(file_areas)==0:
             logging.critical('Missing input landmask shapefile for nanscores estimation')
             raise Exception ('Missing input landmask shapefile for nanscores estimation')
-        file_areas = file_areas[0]
-        geostats.prepareGeoStatsMasks(swi_like['SWI-020'], file_areas, OUTDIR_PATHS[-1], suffix='MAI', areas_key=KEY_STATS)
+        with rasterio.MemoryFile() as like_mf:
+            with like_mf.open(**profile_like) as like_ds:
+                like_ds.write(SWI_data, 1)
+            geostats.prepareGeoStatsMasks(like_mf.name, file_areas[0], OUTDIR_PATHS[-1], suffix='MAI', areas_key=KEY_STATS)
+    del SWI_data
 
     with rasterio.open(glob.glob(os.path.join(OUTDIR_PATHS[-1],'mask_Areas_MAI.tif'))[0]) as area_ds:
         maskAREA = area_ds.read(1)
         mask = (maskAREA != 0)
-    Nb_ALLDATA_land = np.sum(mask)
+    LAND = geostats.readGeoStatsMasks(OUTDIR_PATHS[-1], 'MAI')[0]['TERRITORY']
 
 
     # ========================================== LOOP OVER YEARS/MONTHS =================================
@@ -883,100 +1145,75 @@ def processingASCAT(CONFIG, OUTDIR_PATHS, COLLECTION):
             month2find = f'{year}{month}'
             logging.info(f'MONTH TO FIND : {month2find}')
 
-            SWIFolders_m = [el for el in SWIFolders if fnmatch.fnmatch(el, f'*SWI_{month2find}*')]
-            NFolders_m = len(SWIFolders_m)
+            DAYS_m = [DAY for DAY in DAYS if fnmatch.fnmatch(os.path.basename(DAY['folder']), f'SWI_{month2find}*')]
+            NFolders_m = len(DAYS_m)
 
             if NFolders_m==0:
                 logging.info('NO PRODUCTS')
                 continue
 
-            # Preparing matrices for compositing
-            MEAN_swi = np.full((profile_like['height'],profile_like['width']), np.nan, 'float32')
-            DATA = np.full((profile_like['height'],profile_like['width'],NFolders_m), np.nan,'float32')
+            # Preparing running accumulators for compositing (persisted ones if days were already merged by a previous run)
+            DAYS_keys = [keyASCAT_Day(DAY) for DAY in DAYS_m]
+            accum_file = os.path.join(ACCUM_DIR, f'ACCUM_SWI_{month2find}.npz')
+            SUM, COUNT, DAYS_merged = loadAccumulators(accum_file, profile_like, mask, DAYS_keys)
+            DAYS_new = [DAY for DAY, k in zip(DAYS_m, DAYS_keys) if (k is None) or (k not in DAYS_merged)]
+            if len(DAYS_merged)>0:
+                logging.info(f'{len(DAYS_merged)} days already composited (persisted accumulators), {len(DAYS_new)} days to add')
 
 
             # ===================================== LOOP OVER DAILY PRODUCTS ============================
+            # (days are read/preprocessed by worker threads, results are accumulated in order of days)
 
-            for i in tqdm(range(NFolders_m)):
-                
-                SWIFile = glob.glob(os.path.join(SWIFolders_m[i],'*.zip'))[0]
-                in_file_name = os.path.basename(SWIFile).split('.zip')[0]
-                date = in_file_name.split('_')[3][:8]
-                swi = getSWI020FileFromInput(SWIFile)
-                
-                # If error : Save file name and go to next iteration    
-                if swi=="BadZipFileError":
+            preprocessDay = functools.partial(preprocessASCAT_Day, mask=mask, LAND=LAND, outdir_preproc=OUTDIR_PATHS[2], window=window)
+            QA_rows = []
+            for DAY_ARCHIVE, DAY in tqdm(rasters_io.prefetchRasters(DAYS_new, preprocessDay, ASCAT_THREADS), total=len(DAYS_new)):
+
+                # If error : Save file name and go to next iteration
+                if DAY['error']=="BadZipFileError":
                     with open(os.path.join(OUTDIR_PATHS[3],f'Badzipfiles_error_ASCAT_{date_start_str}_{date_end_str}.txt'), 'a') as f:
-                        f.write(f'{in_file_name}\n')
+                        f.write(f'{DAY["in_file_name"]}\n')
                     continue
-                if swi=="FileNotFoundError":
+                if DAY['error']=="FileNotFoundError":
                     with open(os.path.join(OUTDIR_PATHS[3],f'FileNotFound_error_ASCAT_{date_start_str}_{date_end_str}.txt'), 'a') as f:
-                        f.write(f'{in_file_name}\n')
+                        f.write(f'{DAY["in_file_name"]}\n')
                     continue
-                Qmasks = getMaskFilesFromInput(SWIFile)
-            
-                # --- Reading SWI and Masks, and Estimating scores (land) ---
-                SWI_data, profile_swi = extractSWI(swi)
-                QF_data, _ = extractMask(Qmasks, "QFLAG")
-                SSF_data, _ = extractMask(Qmasks, "SSF")
-                
-                # QFLAG mask : 50 % of threshold for ssm
-                QFmask = (QF_data <= 0.5)
-                Qf_score = np.sum(QFmask[mask==1]==1) / Nb_ALLDATA_land
-                
-                # SSF mask : Unknown=0, Frozen=2, Water=3, NotDetermined=255
-                SSFmask = (SSF_data==0) | (SSF_data==2) | (SSF_data==3) | (SSF_data==255)
-                ssf_score = np.sum(SSFmask[mask==1]==1) / Nb_ALLDATA_land
-            
-                # --- Applying Quality Masks and Land Mask on SWI ---
-                QMask = (QFmask==1) | (SSFmask==1)
-                SWI_Qmasked = SWI_data
-                SWI_Qmasked[(QMask==1) | (mask==0)] = np.nan
-                del SWI_data,QMask,QFmask,SSFmask
-                
-                # --- Estimating Percentage of No Data AFTER Quality Masking (only on LAND) ---
-                Nb_NODATA = np.sum(np.isnan(SWI_Qmasked[mask==1]))
-                NAN_score = Nb_NODATA / Nb_ALLDATA_land
-                
-                # --- Saving Preprocessed SWI and Quality scores IF NANSCORE < 100 % ---
-                if NAN_score<1 :
-                    
-                    # Saving files
-                    swi_file_name = os.path.basename(swi['SWI-020']).split('.tiff')[0]
-                    date_old = swi_file_name.split('_')[3]
-                    out_file_name = os.path.join(OUTDIR_PATHS[2], f'{swi_file_name.replace(date_old,date)}_PREPROC.tif')
-                    with rasterio.open(out_file_name, 'w', **profile_swi) as out_ds:
-                        out_ds.write(SWI_Qmasked, 1)
-                    del out_file_name, swi_file_name, date_old
-                    
-                    d = {'FILE NAME':in_file_name,'DATE':pd.to_datetime(date, format='%Y%m%d'),
-                         'NAN SCORE SWI-020':NAN_score,'QFLAG-020':Qf_score, 'SSFLAG':ssf_score}
-                    QA_dict = pd.concat([QA_dict, pd.DataFrame([d])], ignore_index=True)
-                    del d
-                    
-                    # Concatenating matrices
-                    DATA[:,:,i] = SWI_Qmasked
-                    del SWI_Qmasked
-                
-                del in_file_name, date, NAN_score, Qf_score, ssf_score
-            
-            QA_dict.to_csv(
+
+                # Accumulating saved products (and quality scores)
+                if DAY['QA'] is not None:
+                    QA_rows.append(DAY['QA'])
+                    accumulateComposite(SUM, COUNT, DAY['SWI'])
+                DAYS_merged.append(keyASCAT_Day(DAY_ARCHIVE))
+                del DAY
+
+            # --- Writing quality scores of the month (appended to the QA table of the run) ---
+            pd.DataFrame(QA_rows, columns=QA_columns).to_csv(
                 os.path.join(OUTDIR_PATHS[3], QAtable_filename),
+                mode = 'a' if QA_written else 'w',
+                header = not QA_written,
                 index = False,
                 float_format='%.2f',
                 decimal = '.',
                 sep = ',')
+            QA_written = True
+            del QA_rows
         
             # --- Compositing SWI and computing Geostatistics ---
-            MEAN_swi, COUNT_swi = extractComposite(DATA)
+            MEAN_swi, COUNT_swi = extractComposite(SUM, COUNT)
             outputcomp_swi_file = os.path.join(OUTDIR_PATHS[5], f'ASCAT_SWI_{month2find}_COMPM.tif')
             with rasterio.open(outputcomp_swi_file, 'w', **profile_out) as out_ds:
                 out_ds.write(MEAN_swi, 1)
                 out_ds.write(COUNT_swi, 2)
 
+            # --- Persisting accumulators of a partial month (removed once all days of the month are merged) ---
+            if len(DAYS_merged) < pd.Period(month2find, freq='M').days_in_month:
+                saveAccumulators(accum_file, SUM, COUNT, DAYS_merged, profile_like, mask)
+            elif os.path.exists(accum_file):
+                os.remove(accum_file)
+            del SUM, COUNT, MEAN_swi, COUNT_swi, DAYS_merged
+
 
 
-def extractMAI(files, profile_like, ndays_max, outdir_mai, period_indic='', go_stats=0, mask_dir=None, outdir_droughtstats=None, annex_dir=None, territory=None, areas_key=None):
+def extractMAI(files, profile_like, ndays_max, outdir_mai, period_indic='', go_stats=0, mask_dir=None, outdir_droughtstats=None, annex_dir=None, territory=None, areas_key=None, climato_file=None, mem_budget=None, levels=None, compact=0):
     """
     Computing Moisture Anomaly Index from Amri (2012):
         - MAI = (SWIi - SWImean) / SWIstd
@@ -988,6 +1225,15 @@ def extractMAI(files, profile_like, ndays_max, outdir_mai, period_indic='', go_s
             number of days possibly observed on the period (here 1 image/day).
             A FINAL MAI Quality Score (QSCORE_mai) is computed taking into account the composite score
             QSCORE_comp and the seasonal QSCORES mean on the period observed (QSCORE_histo)
+
+    Note 2 : IF climato_file is given, SWImean,SWIstd,QSCORE_histo are read from this climatology store,
+             which is only updated with the SWI not merged yet.
+
+    Note 3 : Rasters are processed by blocks of rows, fitting into the memory budget (mem_budget in MB).
+
+    Note 4 : IF levels are given (fields of areas shapefile), stats of coarser areas are rolled up from sub-areas stats.
+
+    Note 5 : IF compact=1, only pixels with SWI data (on sub-areas if go_stats=1) are computed (land-pixel compaction).
     """
 
     logging.info('Apply MAI equation')
@@ -1009,51 +1255,33 @@ def extractMAI(files, profile_like, ndays_max, outdir_mai, period_indic='', go_s
     if go_stats==1:
         logging.info('MAI spatial stats will be estimated')
 
-        with rasterio.open(glob.glob(os.path.join(mask_dir,'mask_Areas_MAI.tif'))[0]) as area_ds:
-            maskAREA = area_ds.read(1)
-            mask = (maskAREA != 0)
-        area_lut = pd.read_csv(glob.glob(os.path.join(mask_dir,'ID_Name_Areas-lookup_MAI.csv'))[0], sep=';')
+        INDEX, area_lut = geostats.readGeoStatsMasks(mask_dir, 'MAI')
 
         # --- AND Verify if output stats dataframes already exist (yes -> do not add hearder in csv file) ---
         stats_ok = len(glob.glob(os.path.join(outdir_droughtstats,'MAI_STATS_M*.csv')))>0
     count_head = 0
 
-    # --- COMPUTING HISTORICAL MEAN/STD and QSCORE ---
-    N_files = len(files)
-    SWI_MEAN = np.full((profile_like['height'],profile_like['width'],N_files), np.nan, 'float32')
-    SWI_COUNT = np.full_like(SWI_MEAN, np.nan, 'float32')
-
-    for i in range(N_files):
-        with rasterio.open(files[i]) as d_ds:
-            SWI_MEAN[:,:,i] = d_ds.read(1)
-            SWI_COUNT[:,:,i] = d_ds.read(2)
-
-    SWI_QSCORE = SWI_COUNT/ndays_max
-    MEAN_histo = np.nanmean(SWI_MEAN,axis=2)
-    STD_histo = np.nanstd(SWI_MEAN,axis=2)
-    QSCORE_histo = np.mean(SWI_QSCORE,axis=2)
+    # --- LAND MASK (land-pixel compaction on sub-areas pixels) ---
+    landmask = None
+    if compact==1 and go_stats==1:
+        landmask = geostats.landmaskAreas(mask_dir, 'MAI')
+        if landmask.shape!=(profile_like['height'], profile_like['width']):
+            logging.warning('Land mask not used for compaction : grid of geostats masks differs from SWI grid')
+            landmask = None
+
+    # --- APPLY MAI EQUATION TO EACH IMAGE ON THE PERIOD (by blocks, see anomaly.computeAnomaly) ---
+    files_out = anomaly.computeAnomaly(files, 'MAI', profile_like, ndays_max, outdir_mai, period_indic, climato_file,
+                                       mem_budget=mem_budget, compact=compact, landmask=landmask)
+    dates_out = [catalog.parseName_DATAfile(f)['date'] for f in files_out]
+    out_files = [os.path.join(outdir_mai, anomaly.nameAnomaly(f, 'MAI', period_indic)) for f in files_out]
+
+    # --- IF go_stats=1, Estimate spatial stats ---
+    if go_stats==1:
+        MAI_FILES = rasters_io.prefetchRasters(out_files)   # next files prefetched while stats of current file are estimated
+        for full_date, (_, (MAI, MAI_QSCORE)) in tqdm(zip(dates_out, MAI_FILES), total=len(out_files)):
 
-    # --- APPLY MAI EQUATION TO EACH IMAGE ON THE PERIOD ---
-    for i in tqdm(range(N_files)):
-        
-        # Compute MAI
-        MAI = (SWI_MEAN[:,:,i] - MEAN_histo)/STD_histo
-        MAI[(STD_histo == 0)] = np.nan
-        MAI_QSCORE = np.mean(np.stack((QSCORE_histo,SWI_QSCORE[:,:,i]),axis=2),axis=2)
-        MAI_QSCORE[SWI_QSCORE[:,:,i]==0] = 0
-        
-        # Save file
-        in_file_name = os.path.basename(files[i]).split('.tif')[0]
-        full_date = in_file_name.split('_')[2]
-        out_file_name = os.path.join(outdir_mai, f'MAI_{full_date}{period_indic}.tif')
-        with rasterio.open(out_file_name, 'w', **profile_like) as out_ds:
-            out_ds.write(MAI, 1)
-            out_ds.write(MAI_QSCORE, 2)
-        
-        # IF go_stats=1, Estimate spatial stats
-        if go_stats==1:
             date_df = pd.to_datetime(full_date, format='%Y%m')
-            GeoStats_df, _, _ = geostats.extractGeoStats(MAI, MAI_QSCORE, date_df, mask, maskAREA, area_lut, territory)
+            GeoStats_df, _, _ = geostats.extractGeoStats(MAI, MAI_QSCORE, date_df, None, None, area_lut, territory, INDEX=INDEX, levels=levels)
             GeoStats_df = GeoStats_df.sort_values(by=['LOCATION','DATE'])
             
             GeoStats_df.to_csv(os.path.join(outdir_droughtstats, f'MAI_STATS_{period_indic}.csv'),
@@ -1065,9 +1293,7 @@ def extractMAI(files, profile_like, ndays_max, outdir_mai, period_indic='', go_s
                 header = (count_head==0 and stats_ok==0))
 
             count_head += 1
-            del GeoStats_df, date_df
-
-        del MAI, MAI_QSCORE, out_file_name, full_date
+            del MAI, MAI_QSCORE, GeoStats_df, date_df
 
 
 
@@ -1078,6 +1304,7 @@ def process_MoistureDeficit_MAI(CONFIG, OUTDIR_PATHS):
         - Qscore = mean(Qscore_i,Qscore_histo)
     A quality score is given (Qscore) according to the number valid pixels,
     and the maximum number of days possibly oberved on the compositing period (NDAYS_MAX_M=30)
+    IF CONFIG['DATACUBE']=1, SWI stacks are read from a datacube of indices (synchronized with data_histo GeoTIFF).
         
     Final products and statistics are saved (updated) into date_histo directory.
     
@@ -1096,6 +1323,11 @@ def process_MoistureDeficit_MAI(CONFIG, OUTDIR_PATHS):
     MODE = CONFIG['MODE']
     if (CONFIG['DROUGHT_STATS'] is None) or (CONFIG['DROUGHT_STATS']==''): go_stats = 0
     else: go_stats = int(CONFIG['DROUGHT_STATS'])
+    mem_budget = blocks.getMemoryBudget(CONFIG)
+    compact = blocks.getCompactLand(CONFIG)
+    go_datacube = cubes.getDatacube(CONFIG)
+    go_store, go_csv = gstore.getStatsStore(CONFIG)
+    levels = geostats.getLevels(CONFIG)
     
     # --- AUTOMATIC/MANUAL/INDICES MODE -> copy the new indices composite file(s) to data histo directory and extract the new months to process ---
     if ('AUTO' in MODE) or ('MANUAL' in MODE) or ('INDICES' in MODE):
@@ -1158,9 +1390,14 @@ def process_MoistureDeficit_MAI(CONFIG, OUTDIR_PATHS):
         logging.critical(f'Wrong imput for processing mode : {MODE}')
         raise Exception('Wrong PROCESSING MODE')
 
-    swi_like = glob.glob(os.path.join(DATA_HISTO, 'MONTH', f'*SWI*.tif'))[0]
-    with rasterio.open(swi_like) as swi_ds:
-        profile_like = swi_ds.profile
+    CATALOG = catalog.refreshCatalog(catalog.getCatalog(CONFIG), [os.path.join(DATA_HISTO, 'MONTH')])
+    swi_like = catalog.selectCatalog(CATALOG, os.path.join(DATA_HISTO, 'MONTH'), product='*SWI*')[-1]   # last composite (grid of current run)
+    profile_like = catalog.profileCatalog(CATALOG, swi_like)
+
+    # --- Synchronize datacube of indices ---
+    if go_datacube==1:
+        logging.info('Synchronize datacube of indices')
+        cubes.syncDatacubes(catalog.selectCatalog(CATALOG))
 
 
     # ========================================== LOOP OVER MONTHS =================================
@@ -1168,7 +1405,7 @@ def process_MoistureDeficit_MAI(CONFIG, OUTDIR_PATHS):
     for month in m_str:
         logging.info(f'MONTH : {month}')
 
-        swi_files_m = glob.glob(os.path.join(DATA_HISTO, 'MONTH', f'*SWI_*{month}_COMPM.tif'))
+        swi_files_m = catalog.selectCatalog(CATALOG, os.path.join(DATA_HISTO, 'MONTH'), product='*SWI', month=month, period='COMPM')
 
         # --- MISSING INDICES ---
         if swi_files_m==[]:
@@ -1180,8 +1417,20 @@ def process_MoistureDeficit_MAI(CONFIG, OUTDIR_PATHS):
             logging.warning('SINGLE YEAR -> PASS')
             continue
 
+        # --- DIFFERENT GRIDS (e.g. ASCAT_CROP changed over existing composites) ---
+        for f in swi_files_m:
+            profile_f = catalog.profileCatalog(CATALOG, f)
+            if (profile_f['height'], profile_f['width'], profile_f['transform'])!=(profile_like['height'], profile_like['width'], profile_like['transform']):
+                logging.critical(f'ASCAT composite {os.path.basename(f)} ({profile_f["height"]}x{profile_f["width"]}) not on the grid of {os.path.basename(swi_like)} '
+                                 f'({profile_like["height"]}x{profile_like["width"]}) : ASCAT_CROP changed, rebuild history of ASCAT composites (data_histo MONTH) on cropped grid')
+                raise Exception('ASCAT composites on different grids : rebuild history on cropped grid')
+        del profile_f
+
         # --- COMPUTING MONTH MAI ---
-        extractMAI(swi_files_m, profile_like, NDAYS_MAX_M, outdirmoisture_mai, 'M', go_stats, outdir_maskareas, outdirmoisture_droughtstats, ANNEX_DIR, CONFIG['TERRITORY'], CONFIG['KEY_STATS'])
+        # No climatology store : MAI history includes the composite of the month being accumulated, rewritten at each run,
+        # so a store would be rebuilt at each run (the few SWI composites of a month are merged in memory instead)
+        extractMAI(swi_files_m, profile_like, NDAYS_MAX_M, outdirmoisture_mai, 'M', go_stats, outdir_maskareas, outdirmoisture_droughtstats, ANNEX_DIR, CONFIG['TERRITORY'], CONFIG['KEY_STATS'],
+                   mem_budget=mem_budget, levels=levels, compact=compact)
 
         del swi_files_m
     
@@ -1209,53 +1458,7 @@ def process_MoistureDeficit_MAI(CONFIG, OUTDIR_PATHS):
         logging.info('Copy/Update MAI Geo Statistics to data histo directory')
         DATA_STATS = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, '1_INDICATEURS', 'ALERT', 'MAI', 'STATS')
         geostats_df = glob.glob(os.path.join(outdirmoisture_droughtstats,'MAI_STATS_M.csv'))[0]
-        f_datahisto = os.path.join(DATA_STATS, os.path.basename(geostats_df))
-
-        if os.path.exists(f_datahisto):
-            # Update : replace new stats to histo stats
-            df_new = pd.read_csv(geostats_df, sep=';')
-            try:
-                df_new['DATE'] = pd.to_datetime(df_new.DATE, format='%Y-%m-%d')
-            except ValueError:
-                df_new['DATE'] = pd.to_datetime(df_new.DATE, format='%d/%m/%Y')
-            df_histo = pd.read_csv(f_datahisto, sep=';')
-            try:
-                df_histo['DATE'] = pd.to_datetime(df_histo.DATE, format='%Y-%m-%d')
-            except ValueError:
-                df_histo['DATE'] = pd.to_datetime(df_histo.DATE, format='%d/%m/%Y')
-
-            for i in tqdm(range(df_new.shape[0])):
-                location = df_new['LOCATION'][i]
-                date = df_new['DATE'][i]
-                mask_histo = (df_histo['LOCATION']==location) & (df_histo['DATE']==date)
-                mask_new = (df_new['LOCATION']==location) & (df_new['DATE']==date)
-                if mask_histo.any():
-                    df_tmp = df_new.loc[mask_new].copy()
-                    df_histo.loc[mask_histo] = df_tmp.values
-                    del df_tmp
-                else:
-                    df_histo = pd.concat([df_histo, df_new.loc[mask_new]], ignore_index=True)
-                del mask_histo, mask_new, location, date
-
-            try:
-                df_histo.to_csv(f_datahisto,
-                                index = False,
-                                float_format='%.2f',
-                                decimal = '.',
-                                sep = ';')
-            except PermissionError:
-                os.remove(f_datahisto)
-                df_histo.to_csv(f_datahisto,
-                                index = False,
-                                float_format='%.2f',
-                                decimal = '.',
-                                sep = ';')
-
-            del df_histo, df_new
-
-        else:
-            # Copy stats to data histo :
-            shutil.copyfile(geostats_df, f_datahisto)
+        gstore.updateStats(geostats_df, DATA_STATS, go_store, go_csv)
 
 
 
@@ -1516,7 +1719,7 @@ def updateRScore(meteo_df, sat_df):
 
 
 
-def extractAreasDroughtCat(spi_c, spei_c, MAI_t, MAIbf_t, VHI_t, maskMAI_c, maskVHI_c, drought_cat):
+def extractAreasDroughtCat(spi_c, spei_c, MAI_t, MAIbf_t, VHI_t, pxlMAI_c, pxlVHI_c, drought_cat):
     '''
     Extracting Drought Category on sub-areas for each product :
         DCat = -1 -> No data
@@ -1527,6 +1730,8 @@ def extractAreasDroughtCat(spi_c, spei_c, MAI_t, MAIbf_t, VHI_t, maskMAI_c, mask
             considered on current month, and then on month before if no drought was detected
             
     Note 2: the actual status is saved (strCatnow_) considering only the current month
+
+    Note 3: mai/vhi pixels of the sub-area are gathered from their flat offsets (pxlMAI_c, pxlVHI_c, see geostats.pixelsArea)
     '''
     
     # --- SPI ---
@@ -1638,12 +1843,11 @@ def extractAreasDroughtCat(spi_c, spei_c, MAI_t, MAIbf_t, VHI_t, maskMAI_c, mask
     # logging.info(f'{strCatnow_spei} (cat={DCatnow_spei})')
     
     # --- MAI ---
-    Nb_ALLDATA_c = np.sum(maskMAI_c)
+    Nb_ALLDATA_c = pxlMAI_c.size
     
     # Look at pixel values on the current month in priority
-    MAI_tc = np.full(MAI_t.shape,np.nan)
-    MAI_tc[maskMAI_c==1] = MAI_t[maskMAI_c==1]
-    NANScore_c = np.sum(np.isnan(MAI_tc[maskMAI_c==1]))
+    MAI_tc = MAI_t.ravel()[pxlMAI_c].astype('float64')
+    NANScore_c = np.sum(np.isnan(MAI_tc))
     if NANScore_c != Nb_ALLDATA_c:
         allCatnow_mai = np.unique(MAI_tc[~np.isnan(MAI_tc)])
         allCatnow_mai = allCatnow_mai[::-1] # reverse to get drought cat first when applying np.max (if same nb pixels in 2 cat: see below)
@@ -1658,9 +1862,8 @@ def extractAreasDroughtCat(spi_c, spei_c, MAI_t, MAIbf_t, VHI_t, maskMAI_c, mask
     
     # If no "Drought" was detected on current month, check the month before
     if DCatnow_mai!=1:
-        MAIbf_tc = np.full(MAIbf_t.shape,np.nan)
-        MAIbf_tc[maskMAI_c==1] = MAIbf_t[maskMAI_c==1]
-        NANScorebf_c = np.sum(np.isnan(MAIbf_tc[maskMAI_c==1]))
+        MAIbf_tc = MAIbf_t.ravel()[pxlMAI_c].astype('float64')
+        NANScorebf_c = np.sum(np.isnan(MAIbf_tc))
         if NANScorebf_c != Nb_ALLDATA_c:
             allCatbf_mai = np.unique(MAIbf_tc[~np.isnan(MAIbf_tc)])
             allCatbf_mai = allCatbf_mai[::-1]
@@ -1675,7 +1878,7 @@ def extractAreasDroughtCat(spi_c, spei_c, MAI_t, MAIbf_t, VHI_t, maskMAI_c, mask
         
         # If still no "Drought" detected : check the proportion P of "Drought" pxls on the two-months period
         if DCatbf_mai!=1 and (1 in allCatnow_mai or 1 in allCatbf_mai):
-            MAI_MAT =  np.stack((MAI_tc, MAIbf_tc), axis=2)
+            MAI_MAT =  np.stack((MAI_tc, MAIbf_tc), axis=-1)
             allCat_MAT = np.unique(MAI_MAT[~np.isnan(MAI_MAT)])
             allCat_MAT = allCat_MAT[::-1]
             nCat = len(np.unique(allCat_MAT))
@@ -1704,10 +1907,9 @@ def extractAreasDroughtCat(spi_c, spei_c, MAI_t, MAIbf_t, VHI_t, maskMAI_c, mask
     # logging.info(f'\n{strCatnow_mai} (cat={DCatnow_mai})')
     
     # --- VHI ---
-    Nb_ALLDATA_c = np.sum(maskVHI_c)
-    VHI_tc = np.full(VHI_t.shape,np.nan)
-    VHI_tc[maskVHI_c==1] = VHI_t[maskVHI_c==1]
-    NANScore_c = np.sum(np.isnan(VHI_tc[maskVHI_c==1]))
+    Nb_ALLDATA_c = pxlVHI_c.size
+    VHI_tc = VHI_t.ravel()[pxlVHI_c].astype('float64')
+    NANScore_c = np.sum(np.isnan(VHI_tc))
     
     if NANScore_c != Nb_ALLDATA_c:
         allCat = np.unique(VHI_tc[~np.isnan(VHI_tc)])
@@ -1810,8 +2012,7 @@ def process_DroughtAlert(CONFIG, OUTDIR_PATHS):
             raise Exception ('Missing input shapefile for sub-areas delimitation')
         file_areas = file_areas[0]
         geostats.prepareGeoStatsMasks(mai_like, file_areas, outdir_maskareas, suffix='MAI', areas_key=KEY_STATS)
-    with rasterio.open(glob.glob(os.path.join(outdir_maskareas, maskmai_name))[0]) as area_ds:
-        maskAREA_mai = area_ds.read(1)
+    INDEX_mai, _ = geostats.readGeoStatsMasks(outdir_maskareas, 'MAI')
     
     vhi_like = glob.glob(os.path.join(DATA_HISTO_VHI, 'MONTH', f'VHI*.tif'))[0]
     maskvhi_name = 'mask_Areas_VHI.tif'
@@ -1823,10 +2024,8 @@ def process_DroughtAlert(CONFIG, OUTDIR_PATHS):
             raise Exception ('Missing input shapefile for sub-areas delimitation')
         file_areas = file_areas[0]
         geostats.prepareGeoStatsMasks(vhi_like, file_areas, outdir_maskareas, suffix='VHI', areas_key=KEY_STATS)
-    with rasterio.open(glob.glob(os.path.join(outdir_maskareas, maskvhi_name))[0]) as area_ds:
-        maskAREA_vhi = area_ds.read(1)
+    INDEX_vhi, area_lut = geostats.readGeoStatsMasks(outdir_maskareas, 'VHI')
 
-    area_lut = pd.read_csv(glob.glob(os.path.join(outdir_maskareas,'ID_Name_Areas-lookup_VHI.csv'))[0], sep=';')
     head_alert = 1 # the first time, add header to alert data frame
 
     # --- Prepare/Read input data frames ---
@@ -1840,13 +2039,8 @@ def process_DroughtAlert(CONFIG, OUTDIR_PATHS):
     speiHISTO_df = spei_df[['NOM','DATE','SPEI_3']].copy()
     speiHISTO_df['DATE'] = pd.to_datetime(speiHISTO_df.DATE, format='%Y%m')
 
-    vhistats_csv = os.path.join(DATA_HISTO_VHI, 'STATS','VHI_STATS_M_NoTrees_NoBuild.csv')
-    vhistats_df = pd.read_csv(vhistats_csv,sep=';')
-    try:
-        vhistats_df['DATE'] = pd.to_datetime(vhistats_df.DATE, format='%Y-%m-%d')
-    except ValueError:
-        vhistats_df['DATE'] = pd.to_datetime(vhistats_df.DATE, format='%d/%m/%Y')
-    vhiHISTO_df = vhistats_df[['LOCATION','DATE','MEAN','QSCORE']].copy()
+    # (only needed columns are read, from stats store if it exists)
+    vhiHISTO_df = gstore.readStats(os.path.join(DATA_HISTO_VHI, 'STATS'), 'VHI_STATS_M_NoTrees_NoBuild.csv', columns=['LOCATION','DATE','MEAN','QSCORE'])
 
     stations_spi_csv = os.path.join(DATA_ANNEX, 'Stations', 'SPI_communes_stations.csv')
     stations_spi_df = pd.read_csv(stations_spi_csv,sep=';')
@@ -1916,13 +2110,13 @@ def process_DroughtAlert(CONFIG, OUTDIR_PATHS):
             # --- SUB-AREA SYNTHESIS : Counting the majority category ---
             spi_a = extractStation(spiMDATES_df, stations_spi_df, a)
             spei_a = extractStation(speiMDATES_df, stations_spei_df, a)
-            maskMAI_a = (maskAREA_mai==int(DroughtAlert_df['OBJECTID'][DroughtAlert_df['LOCATION']==a]))
-            maskVHI_a = (maskAREA_vhi==int(DroughtAlert_df['OBJECTID'][DroughtAlert_df['LOCATION']==a]))
+            pxlMAI_a = geostats.pixelsArea(INDEX_mai, int(DroughtAlert_df['OBJECTID'][DroughtAlert_df['LOCATION']==a]))
+            pxlVHI_a = geostats.pixelsArea(INDEX_vhi, int(DroughtAlert_df['OBJECTID'][DroughtAlert_df['LOCATION']==a]))
             
             (DCat_spi, DCat_spei, DCat_mai, DCat_vhi, strCatnow_spi, strCatnow_spei,
              strCatnow_mai, strCatnow_vhi) = extractAreasDroughtCat(spi_a, spei_a,
                                                                     MAI_t, MAIbf_t, VHI_t,
-                                                                    maskMAI_a, maskVHI_a,
+                                                                    pxlMAI_a, pxlVHI_a,
                                                                     drought_cat)
             
             DroughtAlert_df.loc[DroughtAlert_df['LOCATION']==a,'PRECIPITATION'] = strCatnow_spi     
@@ -1931,7 +2125,7 @@ def process_DroughtAlert(CONFIG, OUTDIR_PATHS):
             DroughtAlert_df.loc[DroughtAlert_df['LOCATION']==a,'VEGETATION'] = strCatnow_vhi
             
             del strCatnow_spi, strCatnow_spei, strCatnow_mai, strCatnow_vhi
-            del spi_a, spei_a, maskMAI_a, maskVHI_a
+            del spi_a, spei_a, pxlMAI_a, pxlVHI_a
             
             # --- ALERT CLASSIFICATION ---
             AlertCat = applyAlertClassif(DCat_spi, DCat_spei, DCat_mai, DCat_vhi)
@@ -1966,48 +2160,11 @@ def process_DroughtAlert(CONFIG, OUTDIR_PATHS):
     f_datahisto = os.path.join(DATA_HISTO_ALERT, 'ALERT_DROUGHT.csv')
     f = os.path.join(outdir_alert, 'ALERT_DROUGHT.csv')
     if os.path.exists(f_datahisto):
-        # Concatenate : add new alerts at the end of histo alerts
-        df_histo = pd.read_csv(f_datahisto, sep=';')
-        df_new = pd.read_csv(f, sep=';')
-        try:
-            df_histo['DATE'] = pd.to_datetime(df_histo.DATE, format='%Y-%m-%d')
-        except ValueError:
-            df_histo['DATE'] = pd.to_datetime(df_histo.DATE, format='%d/%m/%Y')
-        try:
-            df_new['DATE'] = pd.to_datetime(df_new.DATE, format='%Y-%m-%d')
-        except ValueError:
-            df_new['DATE'] = pd.to_datetime(df_new.DATE, format='%d/%m/%Y')
-
-        for i in tqdm(range(df_new.shape[0])):
-            location = df_new['LOCATION'][i]
-            date = df_new['DATE'][i]
-            mask_histo = (df_histo['LOCATION']==location) & (df_histo['DATE']==date)
-            mask_new = (df_new['LOCATION']==location) & (df_new['DATE']==date)
-            if mask_histo.any():
-                df_tmp = df_new.loc[mask_new].copy()
-                df_histo.loc[mask_histo] = df_tmp.values
-                del df_tmp
-            else:
-                df_histo = pd.concat([df_histo, df_new.loc[mask_new]], ignore_index=True)
-            del mask_histo, mask_new, location, date
-        # df_histo = pd.concat([df_histo, df_new], ignore_index=True)
+        # Update : replace new alerts to histo alerts (new dates added)
+        df_histo = gstore.upsertStats(gstore.readStats_CSV(f_datahisto), gstore.readStats_CSV(f))
         df_histo = df_histo.sort_values(by=['LOCATION','DATE']).reset_index(drop=True)
-
-        try:
-            df_histo.to_csv(f_datahisto,
-                            index = False,
-                            float_format='%.2f',
-                            decimal = '.',
-                            sep = ';')
-        except PermissionError:
-            os.remove(f_datahisto)
-            df_histo.to_csv(f_datahisto,
-                            index = False,
-                            float_format='%.2f',
-                            decimal = '.',
-                            sep = ';')
-
-        del df_histo, df_new
+        gstore.writeStats_CSV(df_histo, f_datahisto)
+        del df_histo
 
     else:
         # Copy stats to data histo :
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+##############################################################################
+
+DROUGHT generic engine for anomaly indicators (TCI, VCI, VAI, MAI, ...) :
+selection of historical files and outputs, climatology store, block processing and writing, for any anomaly method
+
+##############################################################################
+"""
+
+import os
+import functools
+import pandas as pd
+import dmpipeline.DROUGHT_Processing.DROUGHT_climatology_functions as climato
+import dmpipeline.DROUGHT_Processing.DROUGHT_blocks_functions as blocks
+import dmpipeline.DROUGHT_Processing.DROUGHT_kernels_functions as kernels
+import dmpipeline.DROUGHT_Processing.DROUGHT_catalog_functions as catalog
+
+import logging
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S', level=logging.INFO)
+
+
+# Anomaly indicators : method of kernels.anomalyIndex, quality score set to 0 where index input is NaN (zero_nan),
+# and historical files of climatology ('past' : all years before current year, 'all' : all files)
+ANOMALY_INDICATORS = {
+    'TCI': {'method': 'minmax_inv', 'zero_nan': False, 'histo': 'past'},
+    'VCI': {'method': 'minmax', 'zero_nan': False, 'histo': 'past'},
+    'VAI': {'method': 'zscore', 'zero_nan': True, 'histo': 'past'},
+    'MAI': {'method': 'zscore', 'zero_nan': False, 'histo': 'all'},
+}
+
+# Combined indicators : anomaly indicators combined on their common dates (alpha * first + (1-alpha) * second, see kernels.combineIndex)
+COMBINED_INDICATORS = {
+    'VHI': {'indicators': ('VCI', 'TCI'), 'alpha': 0.5},
+}
+
+
+
+def removeCurrentYear_DATAList(DATAfiles):
+    """
+    In list of DATA files, remove file corresponding to the current year.
+    Used to remove the current indices (modis lst/ndwi, landsat/s2 ndwi) before computing their historical statistics (climatology).
+    """
+
+    curr_year = pd.Timestamp.now().year
+    DATAfiles_histo = []
+    DATAfiles_current = []
+
+    for f in DATAfiles:
+
+        PARSE = catalog.parseName_DATAfile(f)
+        if PARSE is None:
+            logging.info(f'Extracting date in Data files list : Wrong date format for {os.path.basename(f)}, then not considered')
+            continue
+        if PARSE['year'] < curr_year:
+            DATAfiles_histo.append(f)
+        else:
+            DATAfiles_current.append(f)
+
+    return DATAfiles_histo, DATAfiles_current
+
+
+
+def selectNewDates_DATAList(files_new, files):
+    """
+    Select the files whose tile, date and period are new (those of any file of files_new, e.g. new LST or new NDWI),
+    so that indicators combined together (e.g. TCI/VCI for VHI) are written for a same set of new dates.
+    Returns basenames (None if files_new is None -> all dates).
+    """
+
+    if files_new is None:
+        return None
+
+    DATES_NEW = [catalog.parseName_DATAfile(f) for f in files_new]
+    dates_new = [(PARSE['tile'], PARSE['date'], PARSE['period']) for PARSE in DATES_NEW if PARSE is not None]
+
+    files_select = []
+    for f in files:
+        PARSE = catalog.parseName_DATAfile(f)
+        if (PARSE is not None) and ((PARSE['tile'], PARSE['date'], PARSE['period']) in dates_new):
+            files_select.append(os.path.basename(f))
+
+    return files_select
+
+
+
+def nameAnomaly(DATAfile, indicator, period_indic=''):
+    """
+    Name of the anomaly indicator file of a DATA file (tile and date of DATA file), e.g. :
+        - MODIS_LST_YYYYMM_COMPD1.tif -> TCI_YYYYMMD1.tif
+        - LANDSAT_SENTINEL2_0<tile>_YYYYMM_NDWI_COMPD1.tif -> VAI_0<tile>_YYYYMMD1.tif
+    """
+
+    PARSE = catalog.parseName_DATAfile(DATAfile)
+    if PARSE['tile']=='':
+        return f'{indicator}_{PARSE["date"]}{period_indic}.tif'
+
+    return f'{indicator}_{PARSE["tile"]}_{PARSE["date"]}{period_indic}.tif'
+
+
+
+def prepareAnomaly(files, indicator, profile_like, climato_file=None, compact=0, landmask=None, method=None):
+    """
+    Stack of DATA files of an anomaly indicator for the block engine (see blocks.processIndicator_Blocks) :
+        - equation : anomaly index with the method of the indicator (see ANOMALY_INDICATORS),
+          or method if given ('minmax', 'minmax_inv' or 'zscore', e.g. for a new indicator)
+        - historical files of climatology (see ANOMALY_INDICATORS 'histo') and status of the climatology store (see climato.checkClimatology)
+    Returns the stack (dictionary), files to read are all files with a valid date.
+    """
+
+    SETTINGS = dict(ANOMALY_INDICATORS.get(indicator, {'method': method, 'zero_nan': False, 'histo': 'past'}))
+    if method is not None:
+        SETTINGS['method'] = method
+    if SETTINGS['method'] not in ['minmax', 'minmax_inv', 'zscore']:
+        logging.critical(f'Wrong anomaly method for {indicator} : {SETTINGS["method"]}')
+        raise Exception('Wrong anomaly method')
+
+    if SETTINGS['histo']=='all':
+        files_histo, files_current = list(files), []
+    else:
+        files_histo, files_current = removeCurrentYear_DATAList(files)
+    status, files_merge = climato.checkClimatology(climato_file, files_histo, profile_like, climato.maskClimatology(landmask, compact))
+
+    return {'equation': functools.partial(kernels.anomalyIndex, method=SETTINGS['method'], zero_nan=SETTINGS['zero_nan']),
+            'files': files_histo + files_current, 'files_histo': files_histo, 'files_merge': files_merge,
+            'status': status, 'climato_file': climato_file}
+
+
+
+def computeAnomaly(files, indicator, profile_like, ndays_max, outdir, period_indic='', climato_file=None, files_new=None,
+                   mem_budget=None, compact=0, landmask=None, method=None):
+    """
+    Computing an anomaly indicator of DATA files (one product, same period over all years), with a single engine :
+        - historical files (see ANOMALY_INDICATORS 'histo') are merged into climatology (store climato_file if given)
+        - anomaly index and quality score of each file to write, with the method of the indicator (see ANOMALY_INDICATORS),
+          or method if given ('minmax', 'minmax_inv' or 'zscore', e.g. for a new indicator) :
+              - QSCORE_comp = count_i/ndays_max
+              - QSCORE_indicator = mean(QSCORE_comp,QSCORE_histo)
+        - files are read, processed and written by blocks of rows, fitting into the memory budget (mem_budget in MB),
+          only on pixels with data if compact=1 (see blocks.processIndicator_Blocks)
+        - IF files_new is given (new DATA basenames), and the climatology is unchanged, only indicators of these new dates are written
+    Outputs are written in outdir (see nameAnomaly), 2 bands b1=indicator, b2=Qscore.
+    Returns the list of DATA files written (empty if no new date).
+    """
+
+    logging.info(f'Apply {indicator} equation')
+
+    # --- SELECTING FILES TO READ (historical files to merge, files to write) ---
+    STACK = prepareAnomaly(files, indicator, profile_like, climato_file, compact, landmask, method)
+    files_out, STACK['files'] = climato.selectOutputs_DATAList(STACK['files'], STACK['status'], STACK['files_merge'], files_new)
+    if files_out==[]:
+        logging.info(f'No new date : {indicator} not processed')
+        return []
+
+    # --- APPLY EQUATION TO EACH IMAGE TO WRITE (by blocks) ---
+    DATES = [([f], [os.path.join(outdir, nameAnomaly(f, indicator, period_indic))], None) for f in files_out]
+    blocks.processIndicator_Blocks([STACK], DATES, profile_like, ndays_max, mem_budget, compact, landmask)
+
+    return files_out
+
+
+
+def computeCombinedAnomaly(FILES, indicator, profile_like, ndays_max, OUTDIRS, outdir, period_indic='', CLIMATO_FILES=None,
+                           files_new=None, write_inputs=1, mem_budget=None, compact=0, landmask=None):
+    """
+    Computing a combined indicator (see COMBINED_INDICATORS, e.g. VHI from VCI and TCI) and its anomaly indicators,
+    in a single pass of the block engine over all their DATA files (see blocks.processIndicator_Blocks) :
+        - FILES, OUTDIRS and CLIMATO_FILES give DATA files, output directory and climatology store of each anomaly indicator
+          (dictionaries, e.g. {'VCI': ndwi_files, 'TCI': lst_files})
+        - anomaly indicators are computed for each date with DATA (see computeAnomaly), and only written if write_inputs=1
+        - combined indicator is computed for each date with DATA of all anomaly indicators :
+              - INDICATOR = alpha * INDICATOR_1 + (1-alpha) * INDICATOR_2
+              - QSCORE_indicator = mean(QSCORE_1,QSCORE_2)
+        - IF files_new is given (new DATA basenames), and all climatologies are unchanged, only new dates are written
+          (dates of any new DATA file, see selectNewDates_DATAList) : a date whose DATA came from different runs is written once all exist
+    Outputs are named from DATA files (see nameAnomaly), 2 bands b1=indicator, b2=Qscore.
+    Returns the list of combined indicator files written (empty if no new date).
+    """
+
+    SETTINGS = COMBINED_INDICATORS[indicator]
+    INDICATORS = SETTINGS['indicators']
+    if CLIMATO_FILES is None: CLIMATO_FILES = {}
+
+    logging.info(f'Apply {"/".join(INDICATORS)}/{indicator} equations')
+
+    # --- SELECTING FILES TO READ (historical files to merge, files to write) ---
+    STACKS = [prepareAnomaly(FILES[indic], indic, profile_like, CLIMATO_FILES.get(indic), compact, landmask) for indic in INDICATORS]
+    if any(STACK['status']!='VALID' for STACK in STACKS):
+        files_new = None    # all dates are rewritten for all indicators
+    else:
+        files_new = selectNewDates_DATAList(files_new, [f for STACK in STACKS for f in STACK['files']])
+    NAMES = []
+    for STACK in STACKS:
+        files_out, STACK['files'] = climato.selectOutputs_DATAList(STACK['files'], STACK['status'], STACK['files_merge'], files_new)
+        NAMES.append({nameAnomaly(f, indicator, period_indic): f for f in files_out})
+
+    # --- MATCHING DATA FILES BY DATE (name of combined indicator) ---
+    names_combined = sorted(set.intersection(*[set(NAMES_k) for NAMES_k in NAMES]))
+    names_out = sorted(set.union(*[set(NAMES_k) for NAMES_k in NAMES])) if write_inputs==1 else names_combined
+    if names_out==[]:
+        logging.info(f'No new date : {indicator} not processed')
+        return []
+
+    # --- APPLY EQUATIONS TO EACH DATE TO WRITE (by blocks) ---
+    DATES = []
+    for name in names_out:
+        files_date = [NAMES_k.get(name) for NAMES_k in NAMES]
+        out_files = [None if (f is None or write_inputs!=1) else os.path.join(OUTDIRS[indic], nameAnomaly(f, indic, period_indic))
+                     for indic, f in zip(INDICATORS, files_date)]
+        DATES.append((files_date, out_files, os.path.join(outdir, name) if name in names_combined else None))
+    combine = functools.partial(kernels.combineIndex, alpha=SETTINGS['alpha'])
+    blocks.processIndicator_Blocks(STACKS, DATES, profile_like, ndays_max, mem_budget, compact, landmask, combine)
+
+    return [os.path.join(outdir, name) for name in names_combined]
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+##############################################################################
+
+DROUGHT functions for processing per-pixel indicators by blocks (out-of-core, under a memory budget),
+and for running independent jobs (months/decades, tiles) in parallel worker processes
+
+##############################################################################
+"""
+
+import math
+import functools
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from tqdm import tqdm
+import dmpipeline.DROUGHT_Processing.DROUGHT_climatology_functions as climato
+import dmpipeline.DROUGHT_Processing.DROUGHT_datacube_functions as cubes
+import dmpipeline.DROUGHT_Processing.DROUGHT_kernels_functions as kernels
+import dmpipeline.DROUGHT_Processing.DROUGHT_io_functions as rasters_io
+
+import warnings
+warnings.simplefilter(action='ignore', category=RuntimeWarning)
+
+import logging
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S', level=logging.INFO)
+
+
+MEM_BUDGET = 2048   # default memory budget (MB) for one block of data
+N_WORKERS = 1       # default number of worker processes
+COMPACT_LAND = 0    # default land-pixel compaction (0 : all pixels of blocks are computed)
+
+
+
+def getMemoryBudget(CONFIG):
+    """
+    Read memory budget (MB) for one block of data from CONFIG['MEM_BUDGET'] (default MEM_BUDGET).
+    """
+
+    if (CONFIG.get('MEM_BUDGET') is None) or (CONFIG['MEM_BUDGET']==''): mem_budget = MEM_BUDGET
+    else: mem_budget = int(CONFIG['MEM_BUDGET'])
+
+    return mem_budget
+
+
+
+def getWorkers(CONFIG):
+    """
+    Read number of worker processes from CONFIG['N_WORKERS'] (default N_WORKERS, i.e. sequential).
+    """
+
+    if (CONFIG.get('N_WORKERS') is None) or (CONFIG['N_WORKERS']==''): n_workers = N_WORKERS
+    else: n_workers = int(CONFIG['N_WORKERS'])
+    if n_workers<1:
+        logging.critical(f'Wrong input for number of workers : {n_workers}')
+        raise Exception('Wrong N_WORKERS')
+
+    return n_workers
+
+
+
+def getCompactLand(CONFIG):
+    """
+    Read land-pixel compaction option from CONFIG['COMPACT_LAND'] (default COMPACT_LAND) :
+    if 1, per-pixel indicators are only computed on pixels with data (and on land if a land mask is given), see processIndicator_Blocks.
+    """
+
+    if (CONFIG.get('COMPACT_LAND') is None) or (CONFIG['COMPACT_LAND']==''): compact = COMPACT_LAND
+    else: compact = int(CONFIG['COMPACT_LAND'])
+
+    return compact
+
+
+
+def runJobs(function, JOBS, n_workers=1):
+    """
+    Run function on each job (tuple of arguments) of JOBS :
+        - sequentially if n_workers=1
+        - in a pool of n_workers processes otherwise (each worker uses its own memory budget)
+    Results are returned in the same order as JOBS (whatever the order of completion),
+    so that all that is written afterwards (e.g. stats) stays deterministic.
+    """
+
+    if n_workers==1 or len(JOBS)<=1:
+        return [function(*job) for job in JOBS]
+
+    n_workers = min(n_workers, len(JOBS))
+    logging.info(f'{len(JOBS)} jobs processed by {n_workers} workers')
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        FUTURES = [executor.submit(function, *job) for job in JOBS]
+        RESULTS = [future.result() for future in FUTURES]
+
+    return RESULTS
+
+
+
+def blockWindows(profile_like, nbytes_pixel, mem_budget=None, align=1):
+    """
+    Divide raster grid (profile_like) into blocks (windows) :
+        - aligned on GDAL-native blocks (blockysize, and blockxsize if tiled) and on align (e.g. climatology tiles),
+          so that each native block is only read/written once
+        - of full rows, as high as possible, so that each block fits into the memory budget (mem_budget in MB),
+          knowing the memory needed per pixel (nbytes_pixel, all layers of cubes and temporaries)
+        - IF a band of native blocks of full rows does not fit (wide grid), this band is divided into blocks of columns
+          (a warning is logged if even one aligned block exceeds the budget)
+    """
+
+    if mem_budget is None: mem_budget = MEM_BUDGET
+    H = profile_like['height']
+    W = profile_like['width']
+    block_h = profile_like.get('blockysize', 1)
+    block_h = min(block_h * align // math.gcd(block_h, align), H)
+
+    n_rows = int(mem_budget * 1024**2 // (W * nbytes_pixel))
+    n_cols = W
+    if n_rows<block_h:
+        block_w = profile_like.get('blockxsize', 1) if profile_like.get('tiled', False) else 1
+        block_w = min(block_w * align // math.gcd(block_w, align), W)
+        n_cols = int(mem_budget * 1024**2 // (block_h * nbytes_pixel)) // block_w * block_w
+        if n_cols<block_w:
+            n_cols = block_w
+            logging.warning(f'Memory budget ({mem_budget} MB) exceeded by blocks of {block_h}x{n_cols} pixels '
+                            f'({block_h*n_cols*nbytes_pixel/1024**2:.0f} MB) : increase MEM_BUDGET')
+    n_rows = max(block_h, n_rows // block_h * block_h)
+
+    WINDOWS = [Window(col_off, row_off, min(n_cols, W-col_off), min(n_rows, H-row_off))
+               for row_off in range(0, H, n_rows) for col_off in range(0, W, n_cols)]
+
+    return WINDOWS
+
+
+
+def readCube(files, window, datacube=None):
+    """
+    Read DATA files on a window, as time-major cubes (N, H, W) :
+        - DATA (band 1, float32)
+        - COUNT (band 2, number of compositing days, uint8), or valid pixels if single band
+    Quality scores (count/ndays_max) are only computed when needed, from COUNT.
+    Files are read concurrently, directly into slices of the cubes (see rasters_io.readStack).
+    IF datacube is given (opened with cubes.openDatacube(files)), cubes are read from it with one slice.
+    """
+
+    if datacube is not None:
+        return cubes.readDatacube(datacube, window)
+
+    DATA = np.full((len(files), window.height, window.width), np.nan, 'float32')
+    COUNT = np.zeros(DATA.shape, 'uint8')
+    rasters_io.readStack(files, window, DATA, COUNT)
+
+    return DATA, COUNT
+
+
+
+def compactPixels(CUBES, landmask=None):
+    """
+    Flat offsets (in block) of the pixels to compute, for land-pixel compaction :
+        - pixels with at least one valid value or compositing count in cubes (list of (DATA, COUNT) cubes (N, H, W))
+        - and on land, if landmask is given (boolean block (H, W))
+    Other pixels have no data to compute : indicators are NaN and quality scores 0.
+    """
+
+    VALID = np.zeros(CUBES[0][0].shape[1:], bool)
+    for DATA, COUNT in CUBES:
+        VALID |= np.any(~np.isnan(DATA), axis=0)
+        VALID |= np.any(COUNT>0, axis=0)
+    if landmask is not None:
+        VALID &= landmask
+
+    return np.flatnonzero(VALID)
+
+
+
+def compactCube(CUBE, PIXELS):
+    """
+    Gather pixels (flat offsets in block) of a cube (N, H, W) into compact vectors (N, P).
+    """
+
+    return CUBE.reshape(CUBE.shape[0], -1)[:, PIXELS]
+
+
+
+def scatterBlock(VALUES, PIXELS, window, fill=np.nan, BLOCK=None):
+    """
+    Scatter compact values (P,) of pixels back to the grid of a block (H, W), other pixels are set to fill value.
+    IF BLOCK is given (already filled, reused for each image of a block), only the pixels are written into it.
+    """
+
+    if BLOCK is None:
+        BLOCK = np.full((window.height, window.width), fill, 'float32')
+    np.put(BLOCK, PIXELS, VALUES)
+
+    return BLOCK
+
+
+
+def readCube_Compact(CUBES_files, window, CUBES_datacube, landmask=None):
+    """
+    Read DATA/COUNT cubes of several lists of files (CUBES_files, e.g. LST and NDWI) on a window (see readCube),
+    and gather the pixels to compute (see compactPixels) into compact cubes (N, P).
+    IF landmask (boolean grid) has no land pixel on the window, nothing is read.
+    Returns (list of compact (DATA, COUNT) cubes, PIXELS).
+    """
+
+    landmask_b = None if landmask is None else landmask[window.toslices()]
+    if (landmask_b is not None) and (not landmask_b.any()):
+        return [(np.full((len(files), 0), np.nan, 'float32'), np.zeros((len(files), 0), 'uint8')) for files in CUBES_files], np.zeros(0, np.intp)
+
+    CUBES = [readCube(files, window, datacube) for files, datacube in zip(CUBES_files, CUBES_datacube)]
+    PIXELS = compactPixels(CUBES, landmask_b)
+    CUBES = [(compactCube(DATA, PIXELS), compactCube(COUNT, PIXELS)) for DATA, COUNT in CUBES]
+
+    return CUBES, PIXELS
+
+
+
+def allocateGrid(window):
+    """
+    Grid buffers (INDIC, QSCORE) of a block, filled with NaN and 0 (see scatterBlock), into which compact pixels are scattered.
+    """
+
+    return scatterBlock([], [], window), scatterBlock([], [], window, 0)
+
+
+
+def processIndicator_Blocks(STACKS, DATES, profile_like, ndays_max, mem_budget=None, compact=0, landmask=None, combine=None):
+    """
+    Compute per-pixel indicators of one or several stacks of DATA files (one stack per product, e.g. LST and NDWI), by blocks of rows,
+    under a memory budget :
+        - read DATA/COUNT cubes (N, H, W) of each stack on the block (from datacube if up to date, GeoTIFF files otherwise)
+        - update climatology of each stack on the block, with its files still missing in the store
+        - for each date to write, apply the equation of each stack equation(DATA_i, COUNT_i, ndays_max, CLIMATO, OUT) -> (INDICATOR, QSCORE_indicator)
+          to its file of the date, into output buffers OUT (see kernels.anomalyIndex)
+        - IF combine is given, combine indicators of the date, combine(INDICATOR_1, QSCORE_1, INDICATOR_2, QSCORE_2, ..., OUT=OUT)
+          (e.g. VHI from VCI and TCI, see kernels.combineIndex), on dates with a file in every stack
+        - write the block into the output files, behind computations (see rasters_io.openWriter)
+    STACKS : list of dictionaries, one per stack : 'equation', 'files' (files to read), 'files_histo' (historical files of climatology),
+             'files_merge' (historical files still missing in the store), 'status' and 'climato_file' (not used if None, see climato.checkClimatology)
+    DATES : list of (files, out_files, combine_file), one per date to write : file of the date in each stack (None if missing),
+            output file of each stack indicator and output file of the combined indicator (None if not written)
+    Output buffers are recycled once written (see rasters_io.takeBuffers) : their number is bounded by the depth of the writer.
+    Climatology stores are committed once all blocks are updated.
+
+    IF compact=1 (land-pixel compaction), only pixels with data (and on land if landmask, boolean grid, is given) are computed :
+    they are gathered into compact vectors (N, P) for climatology and equations, and scattered back to the grid on write
+    (blocks without land are not read). Other pixels are written as NaN (quality score 0).
+    With a landmask, climatology stores only hold statistics of land pixels : they are tagged with the landmask
+    (see climato.maskClimatology), and rebuilt if used without it or with another one.
+    """
+
+    N_stacks = len(STACKS)
+
+    # --- Prepare climatology stores ---
+    CLIMATO_WORK = [None if STACK.get('climato_file') is None else climato.openClimatology(STACK['climato_file'], profile_like, STACK['status'])
+                    for STACK in STACKS]
+    align = 1 if all(climato_work is None for climato_work in CLIMATO_WORK) else climato.CLIMATO_BLOCKSIZE
+
+    # --- Divide into blocks (DATA/COUNT cubes, temporaries of NaN reductions, climatologies and outputs) ---
+    nbytes_pixel = sum(len(STACK['files'])*(4+1) + 2*len(STACK['files'])*4 + climato.CLIMATO_NBYTES_PIXEL for STACK in STACKS)
+    WINDOWS = blockWindows(profile_like, nbytes_pixel, mem_budget, align)
+    logging.info(f'{len(WINDOWS)} block(s) of {WINDOWS[0].height} rows x {WINDOWS[0].width} columns')
+
+    DATACUBES = [cubes.openDatacube(STACK['files']) for STACK in STACKS]
+
+    with ExitStack() as stack:
+        DATES_DS = [[None if f is None else stack.enter_context(rasterio.open(f, 'w', **profile_like)) for f in list(out_files) + [combine_file]]
+                    for _, out_files, combine_file in DATES]
+        WRITER = rasters_io.openWriter()
+        stack.callback(rasters_io.closeWriter, WRITER)   # completion barrier, before outputs are closed
+
+        for window_b in tqdm(WINDOWS, desc='BLOCKS'):
+
+            # --- READING DATA (only pixels to compute if compact=1) ---
+            if compact==1:
+                CUBES, PIXELS = readCube_Compact([STACK['files'] for STACK in STACKS], window_b, DATACUBES, landmask)
+            else:
+                CUBES = [readCube(STACK['files'], window_b, datacube) for STACK, datacube in zip(STACKS, DATACUBES)]
+                PIXELS = None
+
+            # --- HISTORICAL STATISTICS (climatologies) ---
+            CLIMATOS = [climato.updateClimatology(climato_work, STACK['status'], STACK['files_merge'], STACK['files'], DATA, COUNT,
+                                                  ndays_max, window_b, PIXELS)
+                        for STACK, climato_work, (DATA, COUNT) in zip(STACKS, CLIMATO_WORK, CUBES)]
+
+            # --- OUTPUT BUFFERS (one pair per stack and one for combined indicator, recycled once written) ---
+            # IF compact=1, compact outputs of equations are scattered into grid buffers (written), they are reused for each date
+            FREE = [([], []) for _ in range(N_stacks+1)]
+            if compact==1:
+                OUT = [kernels.allocateOutputs(CUBES[0][0].shape[1:]) for _ in range(N_stacks+1)]
+                allocate = functools.partial(allocateGrid, window_b)
+            else:
+                allocate = functools.partial(kernels.allocateOutputs, CUBES[0][0].shape[1:])
+
+            # --- APPLY EQUATIONS TO EACH DATE TO WRITE ---
+            for (files_date, _, _), OUT_DS in zip(DATES, DATES_DS):
+                if compact!=1:
+                    OUT = [rasters_io.takeBuffers(FREE[g], allocate) for g in range(N_stacks+1)]
+                INDICES = []
+                for k in range(N_stacks):
+                    if files_date[k] is None:
+                        INDICES.append(None)
+                        continue
+                    DATA, COUNT = CUBES[k]
+                    i = STACKS[k]['files'].index(files_date[k])
+                    INDICES.append(STACKS[k]['equation'](DATA[i], COUNT[i], ndays_max, CLIMATOS[k], OUT=OUT[k]))
+                if OUT_DS[-1] is not None:
+                    INDICES.append(combine(*[INDIC for INDIC_QSCORE in INDICES for INDIC in INDIC_QSCORE], OUT=OUT[-1]))
+
+                for g, out_ds in enumerate(OUT_DS):
+                    if out_ds is None:
+                        if compact!=1:
+                            FREE[g][0].append(OUT[g][0])   # not written, free at once
+                            FREE[g][1].append(OUT[g][1])
+                        continue
+                    INDIC, INDIC_QSCORE = INDICES[g]
+                    if compact==1:
+                        GRID = rasters_io.takeBuffers(FREE[g], allocate)
+                        INDIC = scatterBlock(INDIC, PIXELS, window_b, BLOCK=GRID[0])
+                        INDIC_QSCORE = scatterBlock(INDIC_QSCORE, PIXELS, window_b, BLOCK=GRID[1])
+                    rasters_io.writeWindow(WRITER, out_ds, INDIC, 1, window_b, FREE[g][0])
+                    rasters_io.writeWindow(WRITER, out_ds, INDIC_QSCORE, 2, window_b, FREE[g][1])
+                    del INDIC, INDIC_QSCORE
+                del INDICES
+
+            del CUBES, CLIMATOS, PIXELS, OUT, FREE
+
+    # --- SAVING CLIMATOLOGIES (once all blocks are updated) ---
+    for STACK, climato_work in zip(STACKS, CLIMATO_WORK):
+        if climato_work is not None:
+            climato.commitClimatology(climato_work, STACK['climato_file'], STACK['files_histo'], climato.maskClimatology(landmask, compact))
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+##############################################################################
+
+DROUGHT functions for managing the catalog of data_histo products (index of files, dates and profiles)
+
+##############################################################################
+"""
+
+import os
+import json
+import fnmatch
+import sqlite3
+import pandas as pd
+import rasterio
+from rasterio.crs import CRS
+from affine import Affine
+
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+import logging
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S', level=logging.INFO)
+
+
+CATALOG_NAME = 'CATALOG.sqlite'
+CATALOG_COLUMNS = ['path', 'folder', 'name', 'sensor', 'product', 'tile', 'date', 'year', 'month', 'period', 'size', 'mtime', 'profile']
+CATALOG_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS products (path TEXT PRIMARY KEY, folder TEXT, name TEXT, sensor TEXT, product TEXT, tile TEXT,
+                                         date TEXT, year INTEGER, month INTEGER, period TEXT, size INTEGER, mtime INTEGER, profile TEXT);
+    CREATE INDEX IF NOT EXISTS products_folder ON products (folder);
+    CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, mtime INTEGER);
+"""
+
+
+
+def getCatalog(CONFIG):
+    """
+    Path of the catalog of data_histo products of the territory (None if CONFIG['CATALOG']=0, default 1).
+    """
+
+    if (CONFIG.get('CATALOG') is None) or (CONFIG['CATALOG']==''): go_catalog = 1
+    else: go_catalog = int(CONFIG['CATALOG'])
+    if go_catalog==0:
+        return None
+
+    TERRITORY_str = CONFIG['TERRITORY'].replace('"', '').replace(' ', '_').replace('(', '').replace(')', '')
+
+    return os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, CATALOG_NAME)
+
+
+
+def parseName_DATAfile(DATAfile):
+    """
+    Parse the name of a DATA file (string operations only), e.g. :
+        - MODIS_LST_YYYYMM_COMPD1.tif -> product MODIS_LST, date YYYYMM, period COMPD1
+        - LANDSAT_SENTINEL2_0<tile>_YYYYMM_NDWI_DAY2e.tif -> product LANDSAT_SENTINEL2_0<tile>_NDWI, tile 0<tile>, period DAY2e
+        - VHI_YYYYMMD1.tif -> product VHI, period D1
+    Date is the last token starting with a YYYYMM date (6 digits exactly).
+    Returns None if no valid date is found.
+    """
+
+    tokens = os.path.basename(DATAfile).split('.tif')[0].split('_')
+    I_DATE = [i for i in range(len(tokens)) if tokens[i][:6].isdigit() and not tokens[i][6:7].isdigit()]
+    if I_DATE==[]:
+        return None
+    i = I_DATE[-1]
+    date = tokens[i][:6]
+    year, month = int(date[:4]), int(date[4:])
+    if month<1 or month>12:
+        return None
+
+    if i<len(tokens)-1:
+        period = tokens[-1]
+        product = '_'.join(tokens[:i] + tokens[i+1:-1])
+    else:
+        period = tokens[i][6:]
+        product = '_'.join(tokens[:i])
+    tile = tokens[i-1] if (i>0 and tokens[i-1].isdigit()) else ''
+
+    return {'product': product, 'tile': tile, 'date': date, 'year': year, 'month': month, 'period': period}
+
+
+
+def profileCatalog(CATALOG, DATAfile):
+    """
+    Raster profile of a DATA file, from the catalog if stored (read from file otherwise).
+    """
+
+    PROFILE = CATALOG.loc[CATALOG['path']==DATAfile, 'profile']
+    if len(PROFILE)==0 or not isinstance(PROFILE.iloc[0], str):
+        with rasterio.open(DATAfile) as f_ds:
+            return f_ds.profile
+
+    profile = json.loads(PROFILE.iloc[0])
+    profile['crs'] = CRS.from_wkt(profile['crs']) if profile['crs'] is not None else None
+    profile['transform'] = Affine(*profile['transform'])
+
+    return profile
+
+
+
+def rowCatalog(DATAfile, path, folder, f_stat, go_profile):
+    """
+    Catalog row of a DATA file (path and folder as stored, relative to catalog or absolute).
+    Sensor is the name of the parent of data_histo directory (e.g. MODIS for MODIS/DECADE).
+    """
+
+    name = os.path.basename(DATAfile)
+    PARSE = parseName_DATAfile(name) or {}
+    profile = None
+    if go_profile==1:
+        with rasterio.open(DATAfile) as f_ds:
+            profile = dict(f_ds.profile)
+        profile['crs'] = profile['crs'].to_wkt() if profile['crs'] is not None else None
+        profile['transform'] = list(profile['transform'])[:6]
+        profile = json.dumps(profile)
+
+    sensor = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(DATAfile))))
+
+    return (path, folder, name, sensor,
+            PARSE.get('product'), PARSE.get('tile'), PARSE.get('date'), PARSE.get('year'), PARSE.get('month'), PARSE.get('period'),
+            int(f_stat.st_size), int(f_stat.st_mtime), profile)
+
+
+
+def refreshCatalog(catalog_file, data_dirs):
+    """
+    Refresh the catalog with the GeoTIFF files of data_histo directories, and return their catalog (DataFrame, absolute paths) :
+        - a directory is only listed again if its modification time changed (files added, removed or renamed),
+          otherwise its catalogued files are only stat'ed (files overwritten in place do not change the directory)
+        - only new or changed files (size, modification time) are parsed and opened (profile)
+        - rows of removed files are deleted
+    IF catalog_file is None (or its directory does not exist), directories are listed without persistent catalog (no profile).
+    Must be called by the main process before parallel jobs (which only use the returned DataFrame).
+    """
+
+    data_dirs = [os.path.normpath(os.path.abspath(d)) for d in data_dirs if os.path.isdir(d)]
+
+    # --- Without persistent catalog ---
+    if (catalog_file is None) or (not os.path.isdir(os.path.dirname(catalog_file))):
+        ROWS = [rowCatalog(entry.path, entry.path, data_dir, entry.stat(), 0)
+                for data_dir in data_dirs for entry in os.scandir(data_dir) if entry.name.endswith('.tif')]
+        return pd.DataFrame(ROWS, columns=CATALOG_COLUMNS)
+
+    # --- Incremental refresh of persistent catalog ---
+    root = os.path.dirname(os.path.abspath(catalog_file))
+    FOLDERS = [os.path.relpath(d, root) for d in data_dirs]
+    con = sqlite3.connect(catalog_file, timeout=60)
+    try:
+        con.executescript(CATALOG_SCHEMA)
+        for data_dir, folder in zip(data_dirs, FOLDERS):
+            dir_mtime = os.stat(data_dir).st_mtime_ns
+            row = con.execute('SELECT mtime FROM folders WHERE folder=?', (folder,)).fetchone()
+            go_list = (row is None) or (row[0]!=dir_mtime)
+
+            STORED = {path: (size, mtime) for path, size, mtime in con.execute('SELECT path, size, mtime FROM products WHERE folder=?', (folder,))}
+            if go_list:
+                ENTRIES = [(entry.path, os.path.join(folder, entry.name)) for entry in os.scandir(data_dir) if entry.name.endswith('.tif')]
+            else:
+                ENTRIES = [(os.path.join(root, path), path) for path in STORED]
+            PATHS = []
+            ROWS = []
+            for file, path in ENTRIES:
+                try:
+                    f_stat = os.stat(file)
+                except FileNotFoundError:
+                    continue
+                PATHS.append(path)
+                if STORED.get(path)==(int(f_stat.st_size), int(f_stat.st_mtime)): continue
+                ROWS.append(rowCatalog(file, path, folder, f_stat, 1))
+            PATHS_DEL = [(path,) for path in set(STORED) - set(PATHS)]
+
+            if go_list or len(ROWS)>0 or len(PATHS_DEL)>0:
+                con.executemany(f'INSERT OR REPLACE INTO products VALUES ({",".join("?"*len(CATALOG_COLUMNS))})', ROWS)
+                con.executemany('DELETE FROM products WHERE path=?', PATHS_DEL)
+                con.execute('INSERT OR REPLACE INTO folders VALUES (?, ?)', (folder, dir_mtime))
+                con.commit()
+                logging.info(f'Catalog refreshed for {folder} : {len(ROWS)} file(s) added/updated, {len(PATHS_DEL)} removed')
+            del STORED, ENTRIES, PATHS, ROWS, PATHS_DEL
+
+        CATALOG = pd.read_sql_query(f'SELECT * FROM products WHERE folder IN ({",".join("?"*len(FOLDERS))})', con, params=FOLDERS)
+    finally:
+        con.close()
+
+    CATALOG['path'] = [os.path.join(root, p) for p in CATALOG['path']]
+    CATALOG['folder'] = [os.path.normpath(os.path.join(root, f)) for f in CATALOG['folder']]
+
+    return CATALOG
+
+
+
+def selectCatalog(CATALOG, data_dir=None, product=None, tile=None, date=None, month=None, period=None):
+    """
+    Select (sorted) paths of DATA files in catalog, from data_histo directory and name fields :
+    product, tile, date and period are patterns (fnmatch, e.g. product='*NDWI', period='COMPD1*'), month is a number.
+    """
+
+    mask = pd.Series(True, index=CATALOG.index)
+    if data_dir is not None:
+        mask &= (CATALOG['folder']==os.path.normpath(os.path.abspath(data_dir)))
+    for column, pattern in (('product', product), ('tile', tile), ('date', date), ('period', period)):
+        if pattern is not None:
+            mask &= CATALOG[column].map(lambda value: isinstance(value, str) and fnmatch.fnmatchcase(value, pattern))
+    if month is not None:
+        mask &= (CATALOG['month']==int(month))
+
+    return sorted(CATALOG.loc[mask, 'path'])
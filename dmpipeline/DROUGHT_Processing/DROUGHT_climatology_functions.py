@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+##############################################################################
+
+DROUGHT functions for managing climatologies (historical reference rasters)
+
+##############################################################################
+"""
+
+import os
+import json
+import zlib
+import shutil
+import numpy as np
+import rasterio
+import dmpipeline.DROUGHT_Processing.DROUGHT_kernels_functions as kernels
+
+import warnings
+warnings.simplefilter(action='ignore', category=RuntimeWarning)
+
+import logging
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S', level=logging.INFO)
+
+
+CLIMATO_BANDS = ['MIN', 'MAX', 'MEAN', 'STD', 'QSCORE', 'COUNT']
+CLIMATO_BLOCKSIZE = 256
+CLIMATO_NBYTES_PIXEL = 160    # memory per pixel (bytes) of one climatology on a block : bands of the store, statistics of merged files,
+                              # combined statistics and outputs of the indicator equation (float32 layers, with margin)
+
+
+
+def signature_DATAList(DATAfiles):
+    """
+    Extract the signature (size, modification time) of each file in list of DATA files.
+    Used to identify the set of historical files already merged into a climatology.
+    """
+
+    SIGNATURE = {}
+    for f in DATAfiles:
+        f_stat = os.stat(f)
+        SIGNATURE[os.path.basename(f)] = [int(f_stat.st_size), int(f_stat.st_mtime)]
+
+    return SIGNATURE
+
+
+
+def maskClimatology(landmask=None, compact=0):
+    """
+    Tag of the pixels whose statistics are merged into a climatology store :
+        - 'ALL' -> all pixels (compact=0, or land-pixel compaction without landmask : pixels without data have no statistics)
+        - 'LAND_<crc32>' -> only pixels of landmask (compact=1 with landmask, see blocks.processIndicator_Blocks)
+    A store is only valid for the same pixels (see checkClimatology).
+    """
+
+    if (compact!=1) or (landmask is None):
+        return 'ALL'
+
+    return f'LAND_{zlib.crc32(np.packbits(landmask)):08x}'
+
+
+
+def checkClimatology(climato_file, files_histo, profile_like, mask_tag='ALL'):
+    """
+    Compare historical files already merged in climatology store (climato_file) to input historical files :
+        - VALID   -> same files, the stored climatology is used as is
+        - MERGE   -> only new files, they are merged into the stored climatology
+        - REBUILD -> no store, different grid or merged pixels (mask_tag, see maskClimatology), removed or modified files :
+                     climatology is recomputed from all files
+    Returns the status and the list of files to merge.
+    """
+
+    if (climato_file is None) or (not os.path.exists(climato_file)):
+        return 'REBUILD', list(files_histo)
+
+    try:
+        with rasterio.open(climato_file) as c_ds:
+            grid_ok = (c_ds.height==profile_like['height']) and (c_ds.width==profile_like['width']) \
+                and (c_ds.transform==profile_like['transform'])
+            files_store = json.loads(c_ds.tags()['CLIMATO_FILES'])
+            mask_store = c_ds.tags().get('CLIMATO_MASK')
+    except (rasterio.errors.RasterioIOError, KeyError, ValueError) as e:
+        logging.warning(f'Climatology {os.path.basename(climato_file)} can not be read ({e}) : recomputed from all historical files')
+        return 'REBUILD', list(files_histo)
+
+    if not grid_ok:
+        logging.info(f'Climatology {os.path.basename(climato_file)} : different grid -> recomputed from all historical files')
+        return 'REBUILD', list(files_histo)
+
+    if mask_store!=mask_tag:
+        logging.info(f'Climatology {os.path.basename(climato_file)} : different merged pixels ({mask_store}) -> recomputed from all historical files')
+        return 'REBUILD', list(files_histo)
+
+    signature_histo = signature_DATAList(files_histo)
+    for f_name in files_store:
+        if signature_histo.get(f_name)!=files_store[f_name]:
+            logging.info(f'Climatology {os.path.basename(climato_file)} : {f_name} removed or modified -> recomputed from all historical files')
+            return 'REBUILD', list(files_histo)
+
+    files_merge = [f for f in files_histo if os.path.basename(f) not in files_store]
+    if files_merge==[]:
+        return 'VALID', files_merge
+    else:
+        logging.info(f'Climatology {os.path.basename(climato_file)} : {len(files_merge)} new historical file(s) to merge')
+        return 'MERGE', files_merge
+
+
+
+def openClimatology(climato_file, profile_like, status):
+    """
+    Prepare the climatology file to work on, according to the status given by checkClimatology :
+        - VALID   -> the climatology store itself (read only)
+        - MERGE   -> a temporary copy of the store (updated, then committed)
+        - REBUILD -> a new temporary store (filled, then committed)
+    Note : the store is only replaced when committing, so that an interrupted run never leaves partially merged statistics.
+    """
+
+    if status=='VALID':
+        return climato_file
+
+    tmp_file = climato_file.replace('.tif', '_tmp.tif')
+
+    if status=='MERGE':
+        shutil.copyfile(climato_file, tmp_file)
+
+    elif status=='REBUILD':
+        profile_climato = profile_like.copy()
+        profile_climato.update(count=len(CLIMATO_BANDS), dtype='float32', nodata=np.nan,
+                               tiled=True, blockxsize=CLIMATO_BLOCKSIZE, blockysize=CLIMATO_BLOCKSIZE, compress='deflate')
+        with rasterio.open(tmp_file, 'w', **profile_climato) as c_ds:
+            c_ds.descriptions = tuple(CLIMATO_BANDS)
+            c_ds.update_tags(CLIMATO_FILES=json.dumps({}), CLIMATO_NFILES=0)
+
+    return tmp_file
+
+
+
+def readClimatology(climato_file, status, shape, window=None):
+    """
+    Read climatology (reference rasters and sufficient statistics) on a window of the store.
+    In case of REBUILD, an empty climatology is returned (no file merged yet).
+    """
+
+    if status=='REBUILD':
+        CLIMATO = {b: np.full(shape, np.nan, 'float32') for b in CLIMATO_BANDS}
+        CLIMATO['COUNT'][:] = 0
+        CLIMATO['NFILES'] = 0
+        return CLIMATO
+
+    CLIMATO = {}
+    with rasterio.open(climato_file) as c_ds:
+        for b in range(len(CLIMATO_BANDS)):
+            CLIMATO[CLIMATO_BANDS[b]] = c_ds.read(b+1, window=window)
+        CLIMATO['NFILES'] = int(c_ds.tags()['CLIMATO_NFILES'])
+
+    return CLIMATO
+
+
+
+def mergeClimatology(CLIMATO, DATA, COUNT, ndays_max):
+    """
+    Merge new historical images into a climatology, from the running sufficient statistics :
+        - COUNT (number of valid values), MIN, MAX
+        - MEAN and STD combined with the parallel variance algorithm (Chan et al., 1979)
+        - QSCORE = mean of the quality scores (count/ndays_max) of all historical files
+    DATA and COUNT (compositing counts) contain the images to merge along the first axis (N_merge, H, W).
+    """
+
+    N_merge = DATA.shape[0]
+    if N_merge==0:
+        return CLIMATO
+
+    # --- Statistics of the new images (single pass, see kernels.nanStats) ---
+    count_b, mean_b, m2_b, min_b, max_b, qsum_b = kernels.nanStats(DATA, COUNT)
+
+    # --- Combination with the stored statistics ---
+    count_a = CLIMATO['COUNT'].astype('float64')
+    mean_a = np.where(count_a>0, CLIMATO['MEAN'], 0).astype('float64')
+    m2_a = np.where(count_a>0, CLIMATO['STD'].astype('float64')**2 * count_a, 0)
+
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = mean_a + delta * count_b / count
+        m2 = m2_a + m2_b + delta**2 * count_a * count_b / count
+        std = np.sqrt(m2 / count)
+
+    CLIMATO['MIN'] = np.fmin(CLIMATO['MIN'], min_b).astype('float32')
+    CLIMATO['MAX'] = np.fmax(CLIMATO['MAX'], max_b).astype('float32')
+    CLIMATO['MEAN'] = np.where(count>0, mean, np.nan).astype('float32')
+    CLIMATO['STD'] = np.where(count>0, std, np.nan).astype('float32')
+    CLIMATO['COUNT'] = count.astype('float32')
+
+    # --- Quality score (mean over all historical files) ---
+    nfiles = CLIMATO['NFILES'] + N_merge
+    qscore_sum = qsum_b / ndays_max
+    if CLIMATO['NFILES']>0:
+        qscore_sum = qscore_sum + CLIMATO['QSCORE'].astype('float64') * CLIMATO['NFILES']
+    CLIMATO['QSCORE'] = (qscore_sum / nfiles).astype('float32')
+    CLIMATO['NFILES'] = nfiles
+
+    return CLIMATO
+
+
+
+def writeClimatology(climato_file, CLIMATO, window=None):
+    """
+    Write climatology (reference rasters and sufficient statistics) on a window of the (temporary) store.
+    """
+
+    with rasterio.open(climato_file, 'r+') as c_ds:
+        for b in range(len(CLIMATO_BANDS)):
+            c_ds.write(CLIMATO[CLIMATO_BANDS[b]], b+1, window=window)
+
+
+
+def commitClimatology(tmp_file, climato_file, files_histo, mask_tag='ALL'):
+    """
+    Save the set of historical files merged into the temporary store (and the tag of merged pixels, see maskClimatology),
+    and replace the climatology store by it.
+    """
+
+    if tmp_file==climato_file:
+        return
+
+    with rasterio.open(tmp_file, 'r+') as c_ds:
+        c_ds.update_tags(CLIMATO_FILES=json.dumps(signature_DATAList(files_histo)),
+                         CLIMATO_NFILES=len(files_histo), CLIMATO_MASK=mask_tag)
+    os.replace(tmp_file, climato_file)
+    logging.info(f'Climatology {os.path.basename(climato_file)} updated ({len(files_histo)} historical files)')
+
+
+
+def updateClimatology(climato_file, status, files_merge, files, DATA, COUNT, ndays_max, window=None, PIXELS=None):
+    """
+    Get the climatology on a window :
+        - read the stored climatology (or an empty one if REBUILD)
+        - merge the historical files still missing in the store (files_merge), taken from DATA/COUNT cubes
+          whose first axis follows the order of files
+        - write the updated climatology (if MERGE/REBUILD)
+    Note : commitClimatology must be called once all windows were updated (no store is written if climato_file is None).
+
+    IF PIXELS is given (flat offsets in the window, see blocks.compactPixels), DATA/COUNT are compact cubes (N, P) of these pixels :
+    the merge is only computed on them, other pixels of the store (no data) only get their quality score updated,
+    and the compact climatology (P,) of the pixels is returned.
+    """
+
+    if PIXELS is None:
+        CLIMATO = readClimatology(climato_file, status, DATA.shape[1:], window)
+    else:
+        CLIMATO = readClimatology(climato_file, status, (window.height, window.width), window)
+        CLIMATO_P = {b: np.take(CLIMATO[b], PIXELS) for b in CLIMATO_BANDS}
+        CLIMATO_P['NFILES'] = CLIMATO['NFILES']
+
+    if status!='VALID':
+        ind_merge = [files.index(f) for f in files_merge]
+        if len(ind_merge)>0 and ind_merge==list(range(ind_merge[0], ind_merge[-1]+1)):
+            ind_merge = slice(ind_merge[0], ind_merge[-1]+1)   # contiguous files -> view of the cubes (no copy)
+
+        if PIXELS is None:
+            CLIMATO = mergeClimatology(CLIMATO, DATA[ind_merge], COUNT[ind_merge], ndays_max)
+        elif len(files_merge)>0:
+            CLIMATO_P = mergeClimatology(CLIMATO_P, DATA[ind_merge], COUNT[ind_merge], ndays_max)
+            # --- Pixels without data : mean quality score with null scores of merged files ---
+            if CLIMATO['NFILES']>0:
+                CLIMATO['QSCORE'] = (CLIMATO['QSCORE'].astype('float64') * CLIMATO['NFILES'] / CLIMATO_P['NFILES']).astype('float32')
+            else:
+                CLIMATO['QSCORE'][:] = 0
+            for b in CLIMATO_BANDS:
+                np.put(CLIMATO[b], PIXELS, CLIMATO_P[b])
+            CLIMATO['NFILES'] = CLIMATO_P['NFILES']
+
+        if climato_file is not None:
+            writeClimatology(climato_file, CLIMATO, window)
+
+    if PIXELS is not None:
+        return CLIMATO_P
+
+    return CLIMATO
+
+
+
+def selectOutputs_DATAList(files, status, files_merge, files_new=None):
+    """
+    Select the DATA files whose indicators need to be (re)written :
+        - IF files_new is None, or climatology is not VALID (year rollover, new or modified historical files) -> all files
+        - IF NOT -> only new files (files_new, basenames), as the indicators of other dates can not change
+    Returns the files to write, and the files to read (historical files to merge into climatology + files to write).
+    """
+
+    if (files_new is None) or (status!='VALID'):
+        files_out = list(files)
+    else:
+        files_out = [f for f in files if os.path.basename(f) in files_new]
+
+    files_read = list(files_merge) + [f for f in files_out if f not in files_merge]
+
+    return files_out, files_read
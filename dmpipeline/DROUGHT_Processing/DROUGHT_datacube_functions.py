@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+##############################################################################
+
+DROUGHT functions for managing datacubes of historical indices (time x y x x, chunked and compressed)
+
+##############################################################################
+"""
+
+import os
+import functools
+import numpy as np
+import rasterio
+from tqdm import tqdm
+import dmpipeline.DROUGHT_Processing.DROUGHT_climatology_functions as climato
+import dmpipeline.DROUGHT_Processing.DROUGHT_catalog_functions as catalog
+import dmpipeline.DROUGHT_Processing.DROUGHT_io_functions as rasters_io
+
+try:
+    import zarr
+    from numcodecs import Blosc
+except ImportError:
+    zarr = None
+
+import warnings
+warnings.simplefilter(action='ignore', category=RuntimeWarning)
+
+import logging
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S', level=logging.INFO)
+
+
+DATACUBE_FOLDER = 'DATACUBE'
+# Chunks of 32 dates x 128 x 128 pixels : one datacube per calendar month holds ~1 to 3 dates per year (month, decades, days),
+# so that the history of a block of pixels (a same period over all years) is read from one or a few chunks
+DATACUBE_CHUNKS = (32, climato.CLIMATO_BLOCKSIZE//2, climato.CLIMATO_BLOCKSIZE//2)
+
+
+
+def getDatacube(CONFIG):
+    """
+    Read datacube option from CONFIG['DATACUBE'] (default 0, indices only read from GeoTIFF files).
+    """
+
+    if (CONFIG.get('DATACUBE') is None) or (CONFIG['DATACUBE']==''): go_datacube = 0
+    else: go_datacube = int(CONFIG['DATACUBE'])
+    if go_datacube==1 and zarr is None:
+        logging.critical('Datacube option needs zarr package (not installed)')
+        raise Exception('Missing zarr package')
+
+    return go_datacube
+
+
+
+def pathDatacube(DATAfile):
+    """
+    Path of the datacube containing a DATA file of data_histo, one datacube per product, calendar month and sensor directory :
+        - MODIS/MONTH/MODIS_LST_YYYYMM_COMPM.tif -> MODIS/DATACUBE/MODIS_LST_MM.zarr
+        - LANDSAT_SENTINEL2/DECADE/LANDSAT_SENTINEL2_0<tile>_YYYYMM_NDWI_COMPD1.tif -> LANDSAT_SENTINEL2/DATACUBE/LANDSAT_SENTINEL2_0<tile>_NDWI_MM.zarr
+    Product is the file name without date and period (see catalog.parseName_DATAfile).
+    Stacks of indicators (a same month/decade over all years) are then read from a single datacube with short time axis.
+    """
+
+    PARSE = catalog.parseName_DATAfile(DATAfile)
+    sensor_dir = os.path.dirname(os.path.dirname(os.path.abspath(DATAfile)))
+
+    return os.path.join(sensor_dir, DATACUBE_FOLDER, f'{PARSE["product"]}_{PARSE["month"]:02d}.zarr')
+
+
+
+def readFile_Datacube(DATAfile, shape):
+    """
+    Read DATA (band 1, float32) and COUNT (band 2 or valid pixels, uint8) arrays of a file to add into a datacube.
+    Returns (None, None) if the grid of the file differs from datacube grid (shape).
+    """
+
+    with rasterio.open(DATAfile) as d_ds:
+        if (d_ds.height, d_ds.width)!=shape:
+            return None, None
+        DATA = d_ds.read(1).astype('float32')
+        if d_ds.count==2: COUNT = np.nan_to_num(d_ds.read(2))
+        else: COUNT = ~np.isnan(DATA)
+
+    return DATA, COUNT
+
+
+
+def updateDatacube(cube_file, DATAfiles):
+    """
+    Add DATA files (GeoTIFF) missing or changed (size, modification time) into the datacube of a product :
+        - DATA (band 1, float32) and COUNT (band 2 or valid pixels, uint8) arrays (T, H, W)
+        - chunks of DATACUBE_CHUNKS (32 dates x 128 x 128 pixels), compressed (zstd) :
+          the time series of a block of pixels (a same period over all years) is read with one slice, from few chunks
+        - time axis follows order of insertion, basenames and signatures are kept in attributes (KEYS, FILES)
+    GeoTIFF files stay the reference (and export for downstream users) : datacube is only a read cache.
+    """
+
+    SIGNATURE = climato.signature_DATAList(DATAfiles)
+    with rasterio.open(DATAfiles[0]) as f_ds:
+        H, W = f_ds.height, f_ds.width
+
+    if os.path.exists(cube_file):
+        cube = zarr.open_group(cube_file, mode='r+')
+        KEYS = list(cube.attrs['KEYS'])
+        FILES = dict(cube.attrs['FILES'])
+    else:
+        cube = zarr.open_group(cube_file, mode='w')
+        compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.SHUFFLE)
+        cube.create_dataset('DATA', shape=(0, H, W), chunks=DATACUBE_CHUNKS, dtype='float32', fill_value=np.nan, compressor=compressor)
+        cube.create_dataset('COUNT', shape=(0, H, W), chunks=DATACUBE_CHUNKS, dtype='uint8', fill_value=0, compressor=compressor)
+        KEYS = []
+        FILES = {}
+
+    files_up = [f for f in DATAfiles if FILES.get(os.path.basename(f))!=SIGNATURE[os.path.basename(f)]]
+    if files_up==[]:
+        return
+    logging.info(f'Datacube {os.path.basename(cube_file)} : {len(files_up)} file(s) to add/update')
+
+    # --- Extend time axis with new files ---
+    KEYS += [os.path.basename(f) for f in files_up if os.path.basename(f) not in KEYS]
+    cube['DATA'].resize(len(KEYS), H, W)
+    cube['COUNT'].resize(len(KEYS), H, W)
+
+    # --- Files read in background threads (prefetched) while previous ones are compressed into datacube ---
+    for f, (DATA, COUNT) in tqdm(rasters_io.prefetchRasters(files_up, functools.partial(readFile_Datacube, shape=(H, W))),
+                                 total=len(files_up), desc='DATACUBE'):
+        if DATA is None:
+            logging.warning(f'{os.path.basename(f)} not added to datacube : different grid (read from GeoTIFF)')
+            continue
+        i = KEYS.index(os.path.basename(f))
+        cube['DATA'][i] = DATA
+        cube['COUNT'][i] = COUNT
+        FILES[os.path.basename(f)] = SIGNATURE[os.path.basename(f)]
+        del DATA, COUNT, i
+
+    cube.attrs['KEYS'] = KEYS
+    cube.attrs['FILES'] = FILES
+
+
+
+def syncDatacubes(DATAfiles):
+    """
+    Synchronize the datacubes of all products of a list of DATA files (data_histo, e.g. selected from catalog).
+    Must be called by the main process before parallel jobs (which only read datacubes).
+    """
+
+    PRODUCTS = {}
+    for f in DATAfiles:
+        PRODUCTS.setdefault(pathDatacube(f), []).append(f)
+
+    for cube_file in PRODUCTS:
+        os.makedirs(os.path.dirname(cube_file), exist_ok=True)
+        updateDatacube(cube_file, PRODUCTS[cube_file])
+
+
+
+def openDatacube(DATAfiles):
+    """
+    Open the datacube containing all DATA files (single product), for reading stacks with readCube.
+    Returns (datacube, time indices of files), or None if there is no up-to-date datacube for all files
+    (zarr not installed, datacube missing, file missing or changed since added) -> files are read from GeoTIFF.
+    """
+
+    if zarr is None:
+        return None
+    cube_files = {pathDatacube(f) for f in DATAfiles}
+    if len(cube_files)!=1:
+        return None
+    cube_file = cube_files.pop()
+    if not os.path.exists(cube_file):
+        return None
+
+    cube = zarr.open_group(cube_file, mode='r')
+    KEYS = {key: i for i, key in enumerate(cube.attrs['KEYS'])}
+    FILES = cube.attrs['FILES']
+    SIGNATURE = climato.signature_DATAList(DATAfiles)
+    if any(FILES.get(key)!=SIGNATURE[key] for key in SIGNATURE):
+        return None
+    logging.info(f'Reading stacks from datacube {os.path.basename(cube_file)}')
+
+    return cube, [KEYS[os.path.basename(f)] for f in DATAfiles]
+
+
+
+def readDatacube(datacube, window):
+    """
+    Read DATA/COUNT cubes (N, H, W) on a window from an opened datacube (see openDatacube), with one slice per array.
+    """
+
+    cube, INDEX = datacube
+    rows = slice(window.row_off, window.row_off + window.height)
+    cols = slice(window.col_off, window.col_off + window.width)
+    DATA = cube['DATA'].get_orthogonal_selection((INDEX, rows, cols))
+    COUNT = cube['COUNT'].get_orthogonal_selection((INDEX, rows, cols))
+
+    return DATA, COUNT
@@ -15,6 +15,12 @@ import pandas as pd
 import rasterio
 from tqdm import tqdm
 import dmpipeline.GEOSTATS_Processing.GEOSTATS_processing_functions as geostats
+import dmpipeline.GEOSTATS_Processing.GEOSTATS_store_functions as gstore
+import dmpipeline.DROUGHT_Processing.DROUGHT_blocks_functions as blocks
+import dmpipeline.DROUGHT_Processing.DROUGHT_anomaly_functions as anomaly
+import dmpipeline.DROUGHT_Processing.DROUGHT_datacube_functions as cubes
+import dmpipeline.DROUGHT_Processing.DROUGHT_catalog_functions as catalog
+import dmpipeline.DROUGHT_Processing.DROUGHT_io_functions as rasters_io
 
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -48,6 +54,7 @@ def prepare_DATAFolders(CONFIG):
     HISTO_DIR = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str)
     TREE_DIR = [os.path.join(HISTO_DIR, '0_INDICES', 'MODIS', 'DECADE'),
                 os.path.join(HISTO_DIR, '0_INDICES', 'MODIS', 'MONTH'),
+                os.path.join(HISTO_DIR, '0_INDICES', 'MODIS', 'CLIMATO'),
                 os.path.join(HISTO_DIR, '1_INDICATEURS', 'GLOBAL', 'DECADE'),
                 os.path.join(HISTO_DIR, '1_INDICATEURS', 'GLOBAL', 'MONTH'),
                 os.path.join(HISTO_DIR, '1_INDICATEURS', 'GLOBAL', 'STATS')]
@@ -263,7 +270,8 @@ def auto_processingPERIOD(CONFIG):
     end_D = [10, 20, 31]
     TERRITORY_str = CONFIG['TERRITORY'].replace('"', '').replace(' ', '_').replace('(', '').replace(')', '')
     DATA_HISTO = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, '0_INDICES', 'MODIS', 'DECADE')
-    histo_files = glob.glob(os.path.join(DATA_HISTO, '*.tif'))
+    CATALOG = catalog.refreshCatalog(catalog.getCatalog(CONFIG), [DATA_HISTO])
+    histo_files = catalog.selectCatalog(CATALOG, DATA_HISTO)
 
     # Set new PERIOD END = end of the last full decade (previous one)
     date_now = pd.Timestamp.now()
@@ -289,15 +297,14 @@ def auto_processingPERIOD(CONFIG):
     
     # IF HISTO PRODUCTS : Set new PERIOD START according to last histo product processed
     if len(histo_files)>0:
-        dates_list = [os.path.basename(f).split('_')[2] for f in histo_files]
-        dates = np.unique(dates_list)
+        dates = np.unique(CATALOG['date'].dropna())
         dates = pd.to_datetime(dates, format='%Y%m')
         period_start_histo = pd.Series(dates).min()
         period_end_histo = pd.Series(dates).max()
         PERIOD_START_HISTO = period_start_histo.strftime('%Y-%m-%d')
         PERIOD_END_HISTO = period_end_histo.strftime('%Y%m')
         
-        list_end_histo =  glob.glob(os.path.join(DATA_HISTO, f'*{PERIOD_END_HISTO}*.tif'))
+        list_end_histo = catalog.selectCatalog(CATALOG, DATA_HISTO, date=PERIOD_END_HISTO)
         D_END_HISTO = np.nanmax(np.unique([int(f.split('_COMPD')[1][0]) for f in list_end_histo]))
         d_number = int(D_END_HISTO)-1
         d_end_histo = end_D[d_number]
@@ -362,7 +369,8 @@ def auto_processingBBOX(CONFIG):
         
         TERRITORY_str = CONFIG['TERRITORY'].replace('"', '').replace(' ', '_').replace('(', '').replace(')', '')
         DATA_HISTO = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, '0_INDICES', 'MODIS', 'DECADE')
-        histo_files = glob.glob(os.path.join(DATA_HISTO, '*.tif'))
+        CATALOG = catalog.refreshCatalog(catalog.getCatalog(CONFIG), [DATA_HISTO])
+        histo_files = catalog.selectCatalog(CATALOG, DATA_HISTO)
 
         if len(histo_files)>0:
             logging.info(f'\n\n --- AUTOMATIC SETTING OF BOUNDING-BOX ---\n')
@@ -390,366 +398,187 @@ def auto_processingBBOX(CONFIG):
 
 
 
-def removeCurrentYear_DATAList(DATAfiles):
-    """
-    In list of DATA files, remove file corresponding to the current year.
-    Used here to remove the current lst and ndwi modis indices before computing historical min/max for VHI calculation.
+def extractVHI(lst_files, ndwi_files, profile_like, ndays_max, outdir_tci, outdir_vci, outdir_vhi, period_indic='',
+               climato_lst=None, climato_ndwi=None, files_new=None, write_tci_vci=1, mem_budget=None, compact=0, landmask=None):
     """
+    Computing Vegetation Health Index from Kogan (1997), in a single pass over LST and NDWI (by blocks of rows, see anomaly.computeCombinedAnomaly) :
+        - TCI = f(LST) and VCI = f(NDWI) (see anomaly.ANOMALY_INDICATORS)
+        - VHI = alpha * VCI + (1-alpha) * TCI
+        - Qscore = mean(Qscore_vci,Qscore_tci)
+    alpha value was set to 0.5 according to literature (see anomaly.COMBINED_INDICATORS).
 
-    curr_year = pd.Timestamp.now().year
-    DATAfiles_histo = []
-    DATAfiles_current = []
+    Note 1 : TCI and VCI are matched by date and kept in memory, they are only written if write_tci_vci=1.
+             TCI (VCI) is computed for each date with LST (NDWI), VHI for each date with both.
 
-    for f in DATAfiles:
+    Note 2 : IF files_new is given (new LST/NDWI basenames), and both climatologies are unchanged,
+             only new dates are written (others can not change). New dates are those of new LST or new NDWI :
+             a date whose LST and NDWI came from different runs is written once both exist.
 
-        date_str = os.path.basename(f).split('_')[2]
-        try:
-            date_year = pd.to_datetime(date_str, format='%Y%m').year
-        except ValueError:
-            logging.info(f'Extracting date in Data files list : Wrong date format for {date_str}, then not considered')
-            continue
-        if date_year < curr_year:
-            DATAfiles_histo.append(f)
-        else:
-            DATAfiles_current.append(f)
+    Note 3 : IF compact=1, only pixels with LST or NDWI data (and on land if landmask is given) are computed,
+             as compact vectors scattered back to the grid on write (see blocks.processIndicator_Blocks).
+
+    Returns the list of VHI files written.
+    """
 
-    return DATAfiles_histo, DATAfiles_current
+    return anomaly.computeCombinedAnomaly({'VCI': ndwi_files, 'TCI': lst_files}, 'VHI', profile_like, ndays_max,
+                                          {'VCI': outdir_vci, 'TCI': outdir_tci}, outdir_vhi, period_indic,
+                                          {'VCI': climato_ndwi, 'TCI': climato_lst}, files_new, write_tci_vci, mem_budget, compact, landmask)
 
 
 
-def copyfile_Errorscontrol(src, dst):
+def prepareVHI_GeoStatsMasks(file_like, outdir_droughtstats, annex_dir=None, areas_key=None):
     """
-    Procedure to copy files and control in case of permission errors.
+    Preparing input masks and look-up table (for estimating VHI geostats), if not already existing.
+    Returns 1 if spatial stats can be estimated, 0 otherwise (missing input shapefile).
+
+    Note :  masks (and their sparse index of areas pixels) are prepared once before processing months/decades (that may run in parallel workers)
     """
 
-    try:
-        shutil.copyfile(src, dst)
-    except PermissionError:
-        if os.path.exists(dst):
-            logging.warning(f'File already exists: {os.path.basename(src)} is replaced by new version')
-            os.remove(dst)
-            shutil.copyfile(src, dst)
-        else:
-            logging.critical(f'Copy PermissionError : {os.path.basename(src)} impossible to paste')
-            raise Exception('Copy PermissionError : impossible to paste')
+    mask_areas_ok = len(glob.glob(os.path.join(outdir_droughtstats,'mask_Areas.tif')))>0
+    if mask_areas_ok==1:
+        geostats.readAreasIndex(outdir_droughtstats)
+        return 1
+
+    file_areas = glob.glob(os.path.join(annex_dir, 'Areas', '*.shp'))
+    if len(file_areas)==0:
+        logging.warning('Drought spatial stats will not be estimated : missing input shapefile containing geometries/areas to identify')
+        return 0
+    file_areas = file_areas[0]
+
+    file_landcover = glob.glob(os.path.join(annex_dir, 'Landcover', '*.tif'))
+    if len(file_landcover)==0:
+        logging.info('Landcover masks will not be applied : missing input landcover file containing classes to mask')
+        file_landcover = []
+    else:
+        file_landcover = file_landcover[0]
 
+    geostats.prepareGeoStatsMasks(file_like, file_areas, outdir_droughtstats, file_landcover=file_landcover, areas_key=areas_key)
+
+    return 1
 
 
-def extractTCI(files, profile_like, ndays_max, outdir, period_indic=''):
-    """
-    Computing Temperature Condition Index from Kogan (1995) :
-        - TCI = (LSTmax - LSTi) / (LSTmax - LSTmin)
-        - QSCORE_comp = count_i/ndays_max 
-        - QSCORE_tci = mean(QSCORE_comp,QSCORE_histo)
-    
-    Note 1 :  The composite Quality Score (QSCORE_comp) is computed for each specific date,
-              from the ratio of valid pixels counted per indice (count_i) divided by the maximum
-              number of days possibly observed on the period (here 1 image/day).
-              A FINAL TCI Quality Score (QSCORE_tci) is computed taking into account the composite score
-              QSCORE_comp and the seasonal QSCORES mean on the period observed (QSCORE_histo).
 
-    Note 2 : LST of current year are not included in the computation of historical LSTmax,LSTmin,QSCORE_histo.
+def extractVHI_GeoStats(vhi_files, period_indic, outdir_droughtstats, territory=None, levels=None):
+    """
+    Estimating VHI spatial statistics on all territory and each sub-area (predefined in input masks).
+    Returns a dictionary of stats dataframes, with name of output csv file as key
+    (appended afterwards with appendVHI_GeoStats, in a deterministic order).
+    IF levels are given (fields of areas shapefile), stats of coarser areas are rolled up from sub-areas stats.
     """
 
-    logging.info('Apply TCI equation')
-
-    # --- COMPUTING HISTORICAL MIN/MAX and QSCORE ---
-
-    # Extracting lst of current year
-    files_histo, files_current = removeCurrentYear_DATAList(files)
-    N_files = len(files)
-    N_files_histo = len(files_histo)
-    LST_MEAN = np.full((profile_like['height'],profile_like['width'],N_files), np.nan, 'float32')
-    LST_COUNT = np.full_like(LST_MEAN, np.nan, 'float32')
-
-    for i in range(N_files_histo):
-        with rasterio.open(files_histo[i]) as d_ds:
-            LST_MEAN[:,:,i] = d_ds.read(1)
-            if d_ds.count==2:
-                LST_COUNT[:,:,i] = d_ds.read(2)
-            elif d_ds.count==1:
-                LST_COUNT[:,:,i] = ~np.isnan(LST_MEAN[:,:,i])
-
-    LST_QSCORE = LST_COUNT[:,:,:i]/ndays_max
-    MIN_histo = np.nanmin(LST_MEAN,axis=2)
-    MAX_histo = np.nanmax(LST_MEAN,axis=2)
-    QSCORE_histo = np.mean(LST_QSCORE,axis=2)
-
-    # Here adding lst of current year
-    for f in files_current:
-        i+=1
-        with rasterio.open(f) as d_ds:
-            LST_MEAN[:,:,i] = d_ds.read(1)
-            if d_ds.count==2:
-                LST_COUNT[:,:,i] = d_ds.read(2)
-            elif d_ds.count==1:
-                LST_COUNT[:,:,i] = ~np.isnan(LST_MEAN[:,:,i])
-    LST_QSCORE = LST_COUNT/ndays_max
-
-    # --- APPLY TCI EQUATION TO EACH IMAGE ON THE PERIOD ---
-    for i in tqdm(range(N_files)):
-        
-        # Compute TCI
-        TCI = (MAX_histo - LST_MEAN[:,:,i])/(MAX_histo - MIN_histo)
-        TCI[(MAX_histo == MIN_histo)] = np.nan
-        TCI_QSCORE = np.mean(np.stack((QSCORE_histo,LST_QSCORE[:,:,i]),axis=2),axis=2)
-        TCI_QSCORE[LST_QSCORE[:,:,i]==0] = 0
-        
-        # Save file
-        in_file_name = os.path.basename(files[i]).split('.tif')[0]
-        date = in_file_name.split('_')[2]
-        out_file_name = os.path.join(outdir, f'TCI_{date}{period_indic}.tif')
-        with rasterio.open(out_file_name, 'w', **profile_like) as out_ds:
-            out_ds.write(TCI, 1)
-            out_ds.write(TCI_QSCORE, 2)
-        
-        del TCI, TCI_QSCORE, out_file_name
+    logging.info('Drought spatial stats will be estimated')
 
+    # --- Read sparse index of areas pixels (from input masks) and look-up table (cached, loaded once per process) ---
+    INDEX, area_lut = geostats.readGeoStatsMasks(outdir_droughtstats)
+    go_landcover = 'PIXELS_Trees' in INDEX
 
+    if period_indic=='M': period_df = period_indic
+    else: period_df = 'D'
+    GEOSTATS = {}
 
-def extractVCI(files, profile_like, ndays_max, outdir, period_indic=''):
-    """
-    Computing Vegetation Condition Index from Kogan (1995, 2000) :
-        - VCI = (NDWIi - NDWImin) / (NDWImax - NDWImin)
-        - QSCORE_comp = count_i/ndays_max 
-        - QSCORE_vci = mean(QSCORE_comp,QSCORE_histo)
-    
-    Note 1 :  The composite Quality Score (QSCORE_comp) is computed for each specific date,
-              from the ratio of valid pixels counted per indice (count_i) divided by the maximum
-              number of days possibly observed on the period (here 1 image/day).
-              A FINAL VCI Quality Score (QSCORE_vci) is computed taking into account the composite score
-              QSCORE_comp and the seasonal QSCORES mean on the period observed (QSCORE_histo).
+    # --- Read VHI files (next files prefetched while stats of current file are estimated) ---
+    for vhi_f, (VHI, VHI_QSCORE) in tqdm(rasters_io.prefetchRasters(vhi_files), total=len(vhi_files)):
 
-    Note 2 : NDWI of current year are not included in the computation of historical NDWImax,NDWImin,QSCORE_histo.
-    """
+        in_file_name = os.path.basename(vhi_f).split('.tif')[0]
+        full_date = in_file_name.split('_')[1]
 
-    logging.info('Apply VCI equation')
-
-    # --- COMPUTING HISTORICAL MIN/MAX and QSCORE ---
-
-    # Extracting ndwi of current year
-    files_histo, files_current = removeCurrentYear_DATAList(files)
-    N_files = len(files)
-    N_files_histo = len(files_histo)
-    NDWI_MEAN = np.full((profile_like['height'],profile_like['width'],N_files), np.nan, 'float32')
-    NDWI_COUNT = np.full_like(NDWI_MEAN, np.nan, 'float32')
-
-    for i in range(N_files_histo):
-        with rasterio.open(files_histo[i]) as d_ds:
-            NDWI_MEAN[:,:,i] = d_ds.read(1)
-            if d_ds.count==2:
-                NDWI_COUNT[:,:,i] = d_ds.read(2)
-            elif d_ds.count==1:
-                NDWI_COUNT[:,:,i] = ~np.isnan(NDWI_MEAN[:,:,i])
-
-    NDWI_QSCORE = NDWI_COUNT[:,:,:i]/ndays_max
-    MIN_histo = np.nanmin(NDWI_MEAN,axis=2)
-    MAX_histo = np.nanmax(NDWI_MEAN,axis=2)
-    QSCORE_histo = np.mean(NDWI_QSCORE,axis=2)
-
-    # Here adding ndwi of current year
-    for f in files_current:
-        i+=1
-        with rasterio.open(f) as d_ds:
-            NDWI_MEAN[:,:,i] = d_ds.read(1)
-            if d_ds.count==2:
-                NDWI_COUNT[:,:,i] = d_ds.read(2)
-            elif d_ds.count==1:
-                NDWI_COUNT[:,:,i] = ~np.isnan(NDWI_MEAN[:,:,i])
-    NDWI_QSCORE = NDWI_COUNT/ndays_max
-
-    # --- APPLY VCI EQUATION TO EACH IMAGE ON THE PERIOD ---
-    for i in tqdm(range(N_files)):
-        
-        # Compute VCI
-        VCI = (NDWI_MEAN[:,:,i] - MIN_histo)/(MAX_histo - MIN_histo)
-        VCI[(MAX_histo == MIN_histo)] = np.nan
-        VCI_QSCORE = np.mean(np.stack((QSCORE_histo,NDWI_QSCORE[:,:,i]),axis=2),axis=2)
-        VCI_QSCORE[NDWI_QSCORE[:,:,i]==0] = 0
+        # --- Estimate spatial stats ---
+        if period_indic=='M': 
+            date_df = pd.to_datetime(full_date[:-1], format='%Y%m')
+        elif period_indic=='D1':
+            date_df = pd.to_datetime(full_date[:-2]+'01', format='%Y%m%d')
+        elif period_indic=='D2':
+            date_df = pd.to_datetime(full_date[:-2]+'11', format='%Y%m%d')
+        elif period_indic=='D3':
+            date_df = pd.to_datetime(full_date[:-2]+'21', format='%Y%m%d')
+
+        if go_landcover==1:
+            GeoStats_df, GeoStats_df_NOTrees_NOBuild, GeoStats_df_Trees = geostats.extractGeoStats(VHI, VHI_QSCORE, date_df, None, None,
+                                                                                                   area_lut, territory, INDEX=INDEX, levels=levels)
+            GEOSTATS.setdefault(f'VHI_STATS_{period_df}_NoTrees_NoBuild.csv', []).append(GeoStats_df_NOTrees_NOBuild.sort_values(by=['LOCATION','DATE']))
+            GEOSTATS.setdefault(f'VHI_STATS_{period_df}_Trees.csv', []).append(GeoStats_df_Trees.sort_values(by=['LOCATION','DATE']))
+            del GeoStats_df_NOTrees_NOBuild, GeoStats_df_Trees
+
+        else:
+            GeoStats_df, _, _ = geostats.extractGeoStats(VHI, VHI_QSCORE, date_df, None, None, area_lut, territory, INDEX=INDEX, levels=levels)
         
-        # Save file
-        in_file_name = os.path.basename(files[i]).split('.tif')[0]
-        date = in_file_name.split('_')[2]
-        out_file_name = os.path.join(outdir, f'VCI_{date}{period_indic}.tif')
-        with rasterio.open(out_file_name, 'w', **profile_like) as out_ds:
-            out_ds.write(VCI, 1)
-            out_ds.write(VCI_QSCORE, 2)
+        GEOSTATS.setdefault(f'VHI_STATS_{period_df}.csv', []).append(GeoStats_df.sort_values(by=['LOCATION','DATE']))
         
-        del VCI, VCI_QSCORE, out_file_name
+        del GeoStats_df, date_df, VHI, VHI_QSCORE, in_file_name, full_date
+
+    GEOSTATS = {name: pd.concat(GEOSTATS[name], ignore_index=True) for name in GEOSTATS}
+
+    return GEOSTATS
 
 
 
-def extractVHI(period_date, period_indic, profile_like, outdir_tci, outdir_vci, outdir_vhi, go_stats=0, outdir_droughtstats=None, annex_dir=None, territory=None, areas_key=None):
+def appendVHI_GeoStats(GEOSTATS, outdir_droughtstats):
     """
-    Computing Vegetation Health Index from Kogan (1997):
-        - VHI = alpha * VCI + (1-alpha) * TCI
-        - Qscore = mean(Qscore_vci,Qscore_tci)
-    alpha value was set to 0.5 according to literature.
-    IF go_stats=1, spatial statistics are also estimated on all territory and each sub-area (predefined in input masks).
+    Appending VHI stats dataframes (from extractVHI_GeoStats) to output stats csv files
+    (header only added if csv file does not exist yet).
     """
-  
-    ALPHA = 0.5
 
-    logging.info('Apply VHI equation')
+    for name in GEOSTATS:
+        f_stats = os.path.join(outdir_droughtstats, name)
+        GEOSTATS[name].to_csv(f_stats,
+            index = False,
+            float_format='%.2f',
+            decimal = '.',
+            sep = ';',
+            mode='a',
+            header = not os.path.exists(f_stats))
+        del f_stats
 
-    vci_files = glob.glob(os.path.join(outdir_vci,f'VCI_*{period_date}{period_indic}.tif'))
-    tci_files = glob.glob(os.path.join(outdir_tci,f'TCI_*{period_date}{period_indic}.tif'))
-    if len(vci_files)==0:
-        logging.critical(f'No input VCI products')
-        raise Exception('No input VCI products')
-    if len(tci_files)==0:
-        logging.critical(f'No input TCI products')
-        raise Exception('No input TCI products')
 
-    # --- IF go_stats=1, Prepare input masks and look-up table (for estimating geostats) ---
-    if go_stats==1:
 
-        mask_areas_ok = len(glob.glob(os.path.join(outdir_droughtstats,'mask_Areas.tif')))>0
-        if mask_areas_ok==0:
-            file_areas = glob.glob(os.path.join(annex_dir, 'Areas', '*.shp'))
-            file_areas_ok = len(file_areas)
-            if file_areas_ok==0:
-                logging.warning('Drought spatial stats will not be estimated : missing input shapefile containing geometries/areas to identify')
-                go_stats=0
-            else:
-                file_areas = file_areas[0]
-        
-        mask_landcover_ok = len(glob.glob(os.path.join(outdir_droughtstats,'mask_Areas_*.tif')))>0    
-        if mask_landcover_ok==0:
-            file_landcover = glob.glob(os.path.join(annex_dir, 'Landcover', '*.tif'))
-            file_landcover_ok = len(file_landcover)
-            if file_landcover_ok==0:
-                logging.info('Landcover masks will not be applied : missing input landcover file containing classes to mask')
-                go_landcover=0
-            else:
-                file_landcover = file_landcover[0]
-                go_landcover=1
-        else:
-            file_landcover=[]
-            go_landcover=1
-        
-        if mask_areas_ok==0 and file_areas_ok==1:
-            geostats.prepareGeoStatsMasks(vci_files[0], file_areas, outdir_droughtstats, file_landcover=file_landcover, areas_key=areas_key)
-    
+def processVHI_Period(month, period_indic, lst_files, ndwi_files, profile_like, ndays_max, OUTDIR_PATHS, DATA_CLIMATO, DATA_DROUGHT,
+                      files_new=None, write_tci_vci=1, mem_budget=None, go_stats=0, territory=None, levels=None, compact=0):
+    """
+    Processing TCI, VCI and VHI of one month (period_indic='M') or one decade (period_indic='D1', 'D2' or 'D3'),
+    then VHI geostats (if go_stats=1), and copying new VHI products to data_histo directory.
+    IF compact=1, only pixels with data are computed (restricted to sub-areas pixels if go_stats=1, see geostats.landmaskAreas).
+    Each (month, period) job is independent (own inputs, climatologies and outputs), so that jobs can run in parallel workers.
+    Returns the dictionary of stats dataframes (empty if no new dates or go_stats=0), appended afterwards by the main process.
+    """
+
+    (_, _, _, _, outdir_tci, outdir_vci, outdir_vhi, outdir_droughtstats) = OUTDIR_PATHS
+    if period_indic=='M':
+        comp = 'COMPM'
+        folder = 'MONTH'
     else:
-        logging.info('Drought spatial stats will not be estimated')
-    
+        comp = f'COMP{period_indic}'
+        folder = 'DECADE'
+    GEOSTATS = {}
+
+    # --- LAND MASK (land-pixel compaction) ---
+    landmask = None
+    if compact==1 and go_stats==1:
+        landmask = geostats.landmaskAreas(outdir_droughtstats)
+        if landmask.shape!=(profile_like['height'], profile_like['width']):
+            logging.warning('Land mask not used for compaction : grid of geostats masks differs from indices grid')
+            landmask = None
+
+    # --- COMPUTING TCI, VCI and VHI ---
+    logging.info(f'MONTH : {month} - PERIOD : {period_indic}')
+    new_vhi = extractVHI(lst_files, ndwi_files, profile_like, ndays_max, outdir_tci, outdir_vci, outdir_vhi, period_indic,
+                         os.path.join(DATA_CLIMATO, f'CLIMATO_LST_{month}_{comp}.tif'),
+                         os.path.join(DATA_CLIMATO, f'CLIMATO_NDWI_{month}_{comp}.tif'),
+                         files_new, write_tci_vci, mem_budget, compact, landmask)
+
+    # --- NO NEW DATES ---
+    if new_vhi==[]:
+        logging.info(f'NO NEW DATES -> VHI {month} {period_indic} not processed')
+        return GEOSTATS
+
+    # --- COMPUTING VHI GEOSTATS ---
     if go_stats==1:
-        logging.info('Drought spatial stats will be estimated')
-
-        with rasterio.open(glob.glob(os.path.join(outdir_droughtstats,'mask_Areas.tif'))[0]) as area_ds:
-            maskAREA = area_ds.read(1)
-            mask = (maskAREA != 0)
-        area_lut = pd.read_csv(glob.glob(os.path.join(outdir_droughtstats,'*.csv'))[0], sep=';')
-        if go_landcover==1:
-            with rasterio.open(glob.glob(os.path.join(outdir_droughtstats,'mask_Areas_NOTrees_NOBuild.tif'))[0]) as NOTrees_ds, \
-                rasterio.open(glob.glob(os.path.join(outdir_droughtstats,'mask_Areas_Trees.tif'))[0]) as Trees_ds :
-                mask_NOTrees_NOBuild = NOTrees_ds.read(1)
-                mask_Trees = Trees_ds.read(1)
-
-        # --- AND Verify if output stats dataframes already exist (yes -> do not add hearder in csv file) ---
-        if period_indic=='M':
-            stats_ok = len(glob.glob(os.path.join(outdir_droughtstats,'VHI_STATS_M*.csv')))>0
-        else:
-            stats_ok = len(glob.glob(os.path.join(outdir_droughtstats,'VHI_STATS_D*.csv')))>0
-    
-    
-    count_head = 0
-
-    for vci_f in tqdm(vci_files):
+        GEOSTATS = extractVHI_GeoStats(new_vhi, period_indic, outdir_droughtstats, territory, levels)
 
-        # --- Read VCI/TCI files ---
-        in_file_name = os.path.basename(vci_f).split('.tif')[0]
-        full_date = in_file_name.split('_')[1]
-        tci_f = glob.glob(os.path.join(outdir_tci,f'TCI_*{full_date}.tif'))
-        
-        if tci_f==[]:
-            logging.warning(f'Missing TCI file for {full_date}')
-            continue
-        else:
-            tci_f = tci_f[0]
-        
-        with rasterio.open(vci_f) as vci_ds, \
-            rasterio.open(tci_f) as tci_ds:
-            
-            VCI = vci_ds.read(1)
-            VCI_QSCORE = vci_ds.read(2)
-            TCI = tci_ds.read(1)
-            TCI_QSCORE = tci_ds.read(2)
-        
-        # --- Compute VHI ---
-        VHI = ALPHA * VCI + (1-ALPHA) * TCI
-        del VCI, TCI
-        
-        # --- Compute combined Qscore ---
-        VHI_QSCORE = np.mean(np.stack((VCI_QSCORE,TCI_QSCORE),axis=2),axis=2)
-        VHI_QSCORE[(VCI_QSCORE==0) | (TCI_QSCORE==0)] = 0
-        del VCI_QSCORE, TCI_QSCORE
-        
-        # --- Save file ---
-        out_file_name = os.path.join(outdir_vhi, f'VHI_{full_date}.tif')
-        with rasterio.open(out_file_name, 'w', **profile_like) as out_ds:
-            out_ds.write(VHI, 1)
-            out_ds.write(VHI_QSCORE, 2)
-
-        # --- IF go_stats=1, Estimate spatial stats ---
-        if go_stats==1:
-            if period_indic=='M': 
-                date_df = pd.to_datetime(full_date[:-1], format='%Y%m')
-                period_df = period_indic
-            elif period_indic=='D1':
-                date_df = pd.to_datetime(full_date[:-2]+'01', format='%Y%m%d')
-                period_df = 'D'
-            elif period_indic=='D2':
-                date_df = pd.to_datetime(full_date[:-2]+'11', format='%Y%m%d')
-                period_df = 'D'
-            elif period_indic=='D3':
-                date_df = pd.to_datetime(full_date[:-2]+'21', format='%Y%m%d')
-                period_df = 'D'
-
-            if go_landcover==1:
-                GeoStats_df, GeoStats_df_NOTrees_NOBuild, GeoStats_df_Trees = geostats.extractGeoStats(VHI, VHI_QSCORE, date_df, mask, maskAREA,
-                                                                                                       area_lut, territory, mask_NOTrees_NOBuild, mask_Trees)
-                GeoStats_df_NOTrees_NOBuild = GeoStats_df_NOTrees_NOBuild.sort_values(by=['LOCATION','DATE'])
-                GeoStats_df_Trees = GeoStats_df_Trees.sort_values(by=['LOCATION','DATE'])
-
-                GeoStats_df_NOTrees_NOBuild.to_csv(
-                    os.path.join(outdir_droughtstats, f'VHI_STATS_{period_df}_NoTrees_NoBuild.csv'),
-                    index = False,
-                    float_format='%.2f',
-                    decimal = '.',
-                    sep = ';',
-                    mode='a',
-                    header = (count_head==0 and stats_ok==0))
-                GeoStats_df_Trees.to_csv(
-                    os.path.join(outdir_droughtstats, f'VHI_STATS_{period_df}_Trees.csv'),
-                    index = False,
-                    float_format='%.2f',
-                    decimal = '.',
-                    sep = ';',
-                    mode='a',
-                    header = (count_head==0 and stats_ok==0))
-                
-                del GeoStats_df_NOTrees_NOBuild, GeoStats_df_Trees
+    # --- COPYING TO DATA_HISTO (own files of the job) ---
+    for f in tqdm(new_vhi):
+        rasters_io.copyfile_Errorscontrol(f, os.path.join(DATA_DROUGHT, folder, os.path.basename(f)))
 
-            else:
-                GeoStats_df, _, _ = geostats.extractGeoStats(VHI, VHI_QSCORE, date_df, mask, maskAREA, area_lut, territory)
-            
-            GeoStats_df = GeoStats_df.sort_values(by=['LOCATION','DATE'])
-
-            GeoStats_df.to_csv(os.path.join(outdir_droughtstats, f'VHI_STATS_{period_df}.csv'),
-                index = False,
-                float_format='%.2f',
-                decimal = '.',
-                sep = ';',
-                mode='a',
-                header = (count_head==0 and stats_ok==0))
-            
-            count_head += 1
-            
-            del GeoStats_df, period_df, date_df
-        
-        del VHI, VHI_QSCORE, tci_f, in_file_name, full_date
+    return GEOSTATS
 
 
 
@@ -763,6 +592,12 @@ def process_GlobalDrought_VHI(CONFIG, OUTDIR_PATHS):
         - NDAYS_MAX_M (month) is set to 30
         - NDAYS_MAX_D (decade) is set to 10
     IF CONFIG['DROUGHT_STATS']=1, spatial statistics are also estimated on all territory and each sub-area.
+    IF CONFIG['NEWDATES_ONLY']=1 (default) in AUTO mode, only new dates are written
+    (all dates are rewritten at year rollover, or if historical indices changed).
+    TCI/VCI/VHI are computed in a single pass, TCI/VCI are only written if CONFIG['WRITE_TCI_VCI']=1 (default).
+    Months/decades are independent jobs, processed by CONFIG['N_WORKERS'] parallel workers (default 1, sequential).
+    IF CONFIG['DATACUBE']=1, LST/NDWI stacks are read from datacubes of indices (synchronized with data_histo GeoTIFF).
+    IF CONFIG['COMPACT_LAND']=1, only pixels with data (on sub-areas if DROUGHT_STATS=1) are computed (land-pixel compaction).
     
     Final products and statistics are saved (updated) into data_histo directory.
     
@@ -780,9 +615,21 @@ def process_GlobalDrought_VHI(CONFIG, OUTDIR_PATHS):
     ANNEX_DIR = os.path.join(CONFIG['ANNEX_DIR'], TERRITORY_str)
     DATA_HISTO = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, '0_INDICES', 'MODIS')
     DATA_DROUGHT = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, '1_INDICATEURS', 'GLOBAL')
+    DATA_CLIMATO = os.path.join(DATA_HISTO, 'CLIMATO')
     MODE = CONFIG['MODE']
     if (CONFIG['DROUGHT_STATS'] is None) or (CONFIG['DROUGHT_STATS']==''): go_stats = 0
     else: go_stats = int(CONFIG['DROUGHT_STATS'])
+    if (CONFIG.get('NEWDATES_ONLY') is None) or (CONFIG['NEWDATES_ONLY']==''): go_newdates = 1
+    else: go_newdates = int(CONFIG['NEWDATES_ONLY'])
+    if (CONFIG.get('WRITE_TCI_VCI') is None) or (CONFIG['WRITE_TCI_VCI']==''): write_tci_vci = 1
+    else: write_tci_vci = int(CONFIG['WRITE_TCI_VCI'])
+    go_datacube = cubes.getDatacube(CONFIG)
+    go_store, go_csv = gstore.getStatsStore(CONFIG)
+    levels = geostats.getLevels(CONFIG)
+    files_new = None
+    mem_budget = blocks.getMemoryBudget(CONFIG)
+    n_workers = blocks.getWorkers(CONFIG)
+    compact = blocks.getCompactLand(CONFIG)
     
     # --- AUTOMATIC/MANUAL/INDICES MODE -> process VHI to corresponding new indices months/decades ---
     if ('AUTO' in MODE) or ('MANUAL' in MODE) or ('INDICES' in MODE):
@@ -798,6 +645,10 @@ def process_GlobalDrought_VHI(CONFIG, OUTDIR_PATHS):
         d_list = [os.path.basename(f).split('_')[3][-5:-4] for f in new_files_d]
         d_str = np.unique(d_list)
 
+        if ('AUTO' in MODE) and go_newdates==1:
+            logging.info('Only new dates will be written (if historical indices are unchanged)')
+            files_new = [os.path.basename(f) for f in new_files_m + new_files_d]
+
     # --- DROUGHT MODE -> compute/update all vhi products from data historic directory ---
     elif 'DROUGHT' in MODE:
 
@@ -823,139 +674,68 @@ def process_GlobalDrought_VHI(CONFIG, OUTDIR_PATHS):
         logging.critical(f'Wrong imput for processing mode : {MODE}')
         raise Exception('Wrong PROCESSING MODE')
 
-    ndwi_like = glob.glob(os.path.join(DATA_HISTO, 'DECADE', f'*NDWI*.tif'))[0]
-    lst_like = glob.glob(os.path.join(DATA_HISTO, 'DECADE', f'*LST*.tif'))[0]
-    with rasterio.open(ndwi_like) as ndwi_ds, \
-        rasterio.open(lst_like) as lst_ds:
-        profile_ndwilike = ndwi_ds.profile
-        profile_lstlike = lst_ds.profile
+    CATALOG = catalog.refreshCatalog(catalog.getCatalog(CONFIG), [os.path.join(DATA_HISTO, 'MONTH'), os.path.join(DATA_HISTO, 'DECADE')])
+    ndwi_like = catalog.selectCatalog(CATALOG, os.path.join(DATA_HISTO, 'DECADE'), product='*NDWI*')[0]
+    lst_like = catalog.selectCatalog(CATALOG, os.path.join(DATA_HISTO, 'DECADE'), product='*LST*')[0]
+    profile_ndwilike = catalog.profileCatalog(CATALOG, ndwi_like)
+    profile_lstlike = catalog.profileCatalog(CATALOG, lst_like)
+    if (profile_lstlike['height']!=profile_ndwilike['height']) or (profile_lstlike['width']!=profile_ndwilike['width']):
+        logging.critical('LST and NDWI indices have different grids : TCI and VCI can not be combined into VHI')
+        raise Exception('Different LST/NDWI grids')
+    del profile_lstlike
+
+    # --- Synchronize datacubes of indices (once, before jobs) ---
+    if go_datacube==1:
+        logging.info('Synchronize datacubes of indices')
+        cubes.syncDatacubes(catalog.selectCatalog(CATALOG))
+
+    # --- Prepare geostats masks (once, before jobs) ---
+    if go_stats==1:
+        go_stats = prepareVHI_GeoStatsMasks(ndwi_like, outdir_droughtstats, ANNEX_DIR, CONFIG['KEY_STATS'])
 
 
-    # ========================================== LOOP OVER MONTHS =================================
-    
+    # ====================================== LIST MONTHS/DECADES JOBS =============================
+
+    JOBS = []
     for month in m_str:
-        logging.info(f'MONTH : {month}')
+        PERIODS = [('M', NDAYS_MAX_M, 'MONTH', 'COMPM')] if go_month==1 else []
+        PERIODS += [(f'D{d}', NDAYS_MAX_D, 'DECADE', f'COMPD{d}') for d in d_str]
+        if go_month!=1: logging.info(f'MONTH : {month} - Month VHI not processed')
 
-        if go_month==1:
-            ndwi_files_m = glob.glob(os.path.join(DATA_HISTO, 'MONTH', f'*NDWI_*{month}_COMPM.tif'))
-            lst_files_m = glob.glob(os.path.join(DATA_HISTO, 'MONTH', f'*LST_*{month}_COMPM.tif'))
+        for period_indic, ndays_max, folder, comp in PERIODS:
+            ndwi_files = catalog.selectCatalog(CATALOG, os.path.join(DATA_HISTO, folder), product='*NDWI', month=month, period=comp)
+            lst_files = catalog.selectCatalog(CATALOG, os.path.join(DATA_HISTO, folder), product='*LST', month=month, period=comp)
 
             # --- MISSING INDICES ---
-            if ndwi_files_m==[] or lst_files_m==[]:
-                logging.warning('NO PRODUCTS -> PASS')
+            if ndwi_files==[] or lst_files==[]:
+                logging.warning(f'MONTH : {month} - PERIOD : {period_indic} - NO PRODUCTS -> PASS')
                 continue
 
             # --- SINGLE YEAR ---
-            elif len(ndwi_files_m)==1 or len(lst_files_m)==1:
-                logging.warning('SINGLE YEAR -> PASS')
+            elif len(ndwi_files)==1 or len(lst_files)==1:
+                logging.warning(f'MONTH : {month} - PERIOD : {period_indic} - SINGLE YEAR -> PASS')
                 continue
-            
-            # --- COMPUTING MONTH TCI and VCI ---
-            extractTCI(lst_files_m, profile_lstlike, NDAYS_MAX_M, outdir_tci, 'M')
-            extractVCI(ndwi_files_m, profile_ndwilike, NDAYS_MAX_M, outdir_vci, 'M')
-            del ndwi_files_m, lst_files_m
-
-            # --- COMPUTING MONTH VHI ---
-            extractVHI(month, 'M', profile_ndwilike, outdir_tci, outdir_vci, outdir_vhi, go_stats, outdir_droughtstats, ANNEX_DIR, CONFIG['TERRITORY'], CONFIG['KEY_STATS'])
-
-            # --- COPYING TO DATA_HISTO ---
-            new_vhi_m = glob.glob(os.path.join(outdir_vhi,f'VHI_*{month}M.tif'))
-            for fm in tqdm(new_vhi_m):
-                copyfile_Errorscontrol(fm, os.path.join(DATA_DROUGHT, 'MONTH', os.path.basename(fm)))
-            del new_vhi_m
-
-
-        else : logging.info('Month VHI not processed')
 
+            JOBS.append((month, period_indic, lst_files, ndwi_files, profile_ndwilike, ndays_max, OUTDIR_PATHS, DATA_CLIMATO, DATA_DROUGHT,
+                         files_new, write_tci_vci, mem_budget, go_stats, CONFIG['TERRITORY'], levels, compact))
+        del PERIODS
 
-    # ========================================== LOOP OVER DECADES =================================
 
-        for d in d_str:
-            logging.info(f'DECADE : {d}')
+    # ================================ PROCESS JOBS (sequential or parallel workers) ================
 
-            ndwi_files_d = glob.glob(os.path.join(DATA_HISTO, 'DECADE', f'*NDWI_*{month}_COMPD{d}.tif'))
-            lst_files_d = glob.glob(os.path.join(DATA_HISTO, 'DECADE', f'*LST_*{month}_COMPD{d}.tif'))
+    RESULTS = blocks.runJobs(processVHI_Period, JOBS, n_workers)
 
-            # --- MISSING INDICES ---
-            if ndwi_files_d==[] or lst_files_d==[]:
-                logging.warning('NO PRODUCTS -> PASS')
-                continue
-                
-            # --- SINGLE YEAR ---
-            elif len(ndwi_files_d)==1 or len(lst_files_d)==1:
-                logging.warning('SINGLE YEAR -> PASS')
-                continue
-            
-            # --- COMPUTING DECADE TCI and VCI ---
-            extractTCI(lst_files_d, profile_lstlike, NDAYS_MAX_D, outdir_tci, f'D{d}')
-            extractVCI(ndwi_files_d, profile_ndwilike, NDAYS_MAX_D, outdir_vci, f'D{d}')
-            del ndwi_files_d, lst_files_d
-
-            # --- COMPUTING DECADE VHI ---
-            extractVHI(month, f'D{d}', profile_ndwilike, outdir_tci, outdir_vci, outdir_vhi, go_stats, outdir_droughtstats, ANNEX_DIR, CONFIG['TERRITORY'], CONFIG['KEY_STATS'])
-
-            # --- COPYING TO DATA_HISTO ---
-            new_vhi_d = glob.glob(os.path.join(outdir_vhi,f'VHI_*{month}D{d}.tif'))
-            for fd in tqdm(new_vhi_d):
-                copyfile_Errorscontrol(fd, os.path.join(DATA_DROUGHT, 'DECADE', os.path.basename(fd)))
-            del new_vhi_d
+    # --- Append geostats in jobs order (deterministic rows, whatever the number of workers) ---
+    for GEOSTATS in RESULTS:
+        appendVHI_GeoStats(GEOSTATS, outdir_droughtstats)
+    del JOBS, RESULTS
     
-
     # --- Copy/Update VHI Geo Statistics to data histo directory ---
     if go_stats==1:
         logging.info('Copy/Update VHI Geo Statistics to data histo directory')
         DATA_STATS = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, '1_INDICATEURS', 'GLOBAL', 'STATS')
-        GEOSTATS_DF = glob.glob(os.path.join(outdir_droughtstats,'VHI_STATS*.csv'))
-
+        GEOSTATS_DF = sorted(glob.glob(os.path.join(outdir_droughtstats,'VHI_STATS*.csv')))
         for f in GEOSTATS_DF:
-            logging.info(f'Dataframe : {os.path.basename(f)}')
-            f_datahisto = os.path.join(DATA_STATS, os.path.basename(f))
-
-            if os.path.exists(f_datahisto):
-                # Update : replace new stats to histo stats
-                df_new = pd.read_csv(f, sep=';')
-                try:
-                    df_new['DATE'] = pd.to_datetime(df_new.DATE, format='%Y-%m-%d')
-                except ValueError:
-                    df_new['DATE'] = pd.to_datetime(df_new.DATE, format='%d/%m/%Y')
-                df_histo = pd.read_csv(f_datahisto, sep=';')
-                try:
-                    df_histo['DATE'] = pd.to_datetime(df_histo.DATE, format='%Y-%m-%d')
-                except ValueError:
-                    df_histo['DATE'] = pd.to_datetime(df_histo.DATE, format='%d/%m/%Y')
-
-                for i in tqdm(range(df_new.shape[0])):
-                    location = df_new['LOCATION'][i]
-                    date = df_new['DATE'][i]
-                    mask_histo = (df_histo['LOCATION']==location) & (df_histo['DATE']==date)
-                    mask_new = (df_new['LOCATION']==location) & (df_new['DATE']==date)
-                    if mask_histo.any():
-                        df_tmp = df_new.loc[mask_new].copy()
-                        df_histo.loc[mask_histo] = df_tmp.values
-                        del df_tmp
-                    else:
-                        df_histo = pd.concat([df_histo, df_new.loc[mask_new]], ignore_index=True)
-                    del mask_histo, mask_new, location, date
-
-                try:
-                    df_histo.to_csv(f_datahisto,
-                                    index = False,
-                                    float_format='%.2f',
-                                    decimal = '.',
-                                    sep = ';')
-                except PermissionError:
-                    os.remove(f_datahisto)
-                    df_histo.to_csv(f_datahisto,
-                                    index = False,
-                                    float_format='%.2f',
-                                    decimal = '.',
-                                    sep = ';')
-
-                del df_histo, df_new
-
-            else:
-                # Copy stats to data histo :
-                shutil.copyfile(f, f_datahisto)
-            del f_datahisto
+            gstore.updateStats(f, DATA_STATS, go_store, go_csv)
                    
 
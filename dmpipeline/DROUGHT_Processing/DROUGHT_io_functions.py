@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+##############################################################################
+
+DROUGHT functions for raster and file I/O shared by the processing chains : reading stacks of files and writing outputs
+behind computations on thread pools (GDAL releases the GIL while reading/decoding and encoding/compressing), with bounded
+in-flight memory, and copies of products to data_histo
+
+##############################################################################
+"""
+
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+
+import logging
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S', level=logging.INFO)
+
+
+READ_THREADS = 4    # default number of reading threads (per process)
+WRITE_THREADS = 2   # default number of write-behind threads (per process, 0 for synchronous writes)
+WRITE_DEPTH = 16    # maximum number of pending writes (arrays handed off to writer threads)
+
+
+
+def readFile_Window(DATAfile, window, DATA, COUNT):
+    """
+    Read one DATA file on a window directly into slices of preallocated cubes (DATA (H, W) float32, COUNT (H, W) uint8) :
+        - DATA (band 1), without intermediate copy if file is float32
+        - COUNT (band 2, number of compositing days), or valid pixels if single band
+    """
+
+    with rasterio.open(DATAfile) as d_ds:
+        if d_ds.dtypes[0]=='float32':
+            d_ds.read(1, window=window, out=DATA)
+        else:
+            DATA[:] = d_ds.read(1, window=window)
+        if d_ds.count==2:
+            COUNT[:] = np.nan_to_num(d_ds.read(2, window=window))
+        elif d_ds.count==1:
+            COUNT[:] = ~np.isnan(DATA)
+
+
+
+def readStack(files, window, DATA, COUNT, n_threads=READ_THREADS):
+    """
+    Read DATA files on a window into preallocated cubes (DATA, COUNT of shape (N, H, W), first axis in order of files),
+    with files opened and decoded concurrently on a pool of n_threads threads (each thread writes its own slices).
+    In-flight memory is bounded by the cubes (plus one COUNT band per thread).
+    """
+
+    if n_threads<=1 or len(files)<=1:
+        for i in range(len(files)):
+            readFile_Window(files[i], window, DATA[i], COUNT[i])
+        return
+
+    with ThreadPoolExecutor(max_workers=min(n_threads, len(files))) as executor:
+        FUTURES = [executor.submit(readFile_Window, files[i], window, DATA[i], COUNT[i]) for i in range(len(files))]
+        for future in FUTURES:
+            future.result()
+
+
+
+def readBands(DATAfile, bands=(1, 2)):
+    """
+    Read bands of a raster file (full grid), as a tuple of arrays (one per band).
+    """
+
+    with rasterio.open(DATAfile) as d_ds:
+        return tuple(d_ds.read(b) for b in bands)
+
+
+
+def prefetchRasters(files, function=readBands, n_threads=READ_THREADS, depth=None):
+    """
+    Iterate over files in order, yielding (file, function(file)), while the next files are read in background threads :
+        - at most depth files (default n_threads) are read ahead of the file being processed (bounded in-flight memory)
+        - errors of reading are raised when the file is reached
+    Used to overlap reading/decoding of the next rasters with the processing of the current one.
+    """
+
+    if depth is None: depth = n_threads
+    if n_threads<=1 or len(files)<=1:
+        for f in files:
+            yield f, function(f)
+        return
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        FUTURES = deque()
+        files_iter = iter(files)
+        for f in files_iter:
+            FUTURES.append((f, executor.submit(function, f)))
+            if len(FUTURES)>=depth:
+                break
+        while FUTURES:
+            f, future = FUTURES.popleft()
+            result = future.result()
+            for f_next in files_iter:
+                FUTURES.append((f_next, executor.submit(function, f_next)))
+                break
+            yield f, result
+            del result
+
+
+
+def openWriter(n_threads=WRITE_THREADS, depth=WRITE_DEPTH):
+    """
+    Open a write-behind writer : windows written into opened datasets (see writeWindow) are handed off to n_threads writer threads,
+    so that computations of next images overlap with encoding/compressing of previous ones :
+        - each dataset is always written by the same thread (writes of a dataset stay ordered, never concurrent)
+        - at most depth writes are pending (the caller waits for the oldest one beyond), bounding memory of handed-off arrays
+    Returns None if n_threads=0 (synchronous writes).
+    Note : closeWriter (completion barrier) must be called before datasets are closed, and before outputs are copied/published.
+    """
+
+    if n_threads<=0:
+        return None
+
+    return {'EXECUTORS': [ThreadPoolExecutor(max_workers=1) for _ in range(n_threads)],
+            'DATASETS': {},
+            'PENDING': deque(),
+            'depth': depth}
+
+
+
+def writeWindow(WRITER, out_ds, ARRAY, band, window=None, FREE=None):
+    """
+    Write an array into a band (window) of an opened dataset : handed off to the writer threads (write-behind),
+    or written immediately if WRITER is None. A handed-off array must not be modified afterwards by the caller.
+    IF FREE (list) is given, the array is appended to it once written, to be reused by the caller (see takeBuffers).
+    """
+
+    if WRITER is None:
+        out_ds.write(ARRAY, band, window=window)
+        if FREE is not None: FREE.append(ARRAY)
+        return
+
+    i = WRITER['DATASETS'].setdefault(id(out_ds), len(WRITER['DATASETS']) % len(WRITER['EXECUTORS']))
+    while len(WRITER['PENDING'])>=WRITER['depth']:
+        WRITER['PENDING'].popleft().result()
+    future = WRITER['EXECUTORS'][i].submit(out_ds.write, ARRAY, band, window=window)
+    if FREE is not None:
+        future.add_done_callback(lambda _: FREE.append(ARRAY))
+    WRITER['PENDING'].append(future)
+
+
+
+def takeBuffers(FREE, allocate):
+    """
+    Output buffers recycled from free lists (FREE, one list per buffer, filled back by writeWindow once arrays are written),
+    or new buffers (allocate(), tuple with one buffer per list) if a list is empty.
+    As at most depth writes are pending (see openWriter), at most depth+1 buffers per list are allocated (a single one if writes are synchronous).
+    """
+
+    if all(FREE):
+        return tuple(BUFFERS.pop() for BUFFERS in FREE)
+
+    return allocate()
+
+
+
+def closeWriter(WRITER):
+    """
+    Completion barrier of a write-behind writer : wait for all pending writes (errors of writing are raised here), and stop threads.
+    """
+
+    if WRITER is None:
+        return
+
+    try:
+        while WRITER['PENDING']:
+            WRITER['PENDING'].popleft().result()
+    finally:
+        for executor in WRITER['EXECUTORS']:
+            executor.shutdown(wait=True)
+
+
+
+def copyfile_Errorscontrol(src, dst):
+    """
+    Procedure to copy files and control in case of permission errors.
+    File is first copied next to dst (temporary file), then renamed (atomic) :
+    parallel workers or readers of data_histo never see a partially copied file.
+    """
+
+    dst_tmp = f'{dst}.{os.getpid()}.tmp'
+    try:
+        shutil.copyfile(src, dst_tmp)
+        os.replace(dst_tmp, dst)
+    except PermissionError:
+        if os.path.exists(dst_tmp): os.remove(dst_tmp)
+        if os.path.exists(dst):
+            logging.warning(f'File already exists: {os.path.basename(src)} is replaced by new version')
+            os.remove(dst)
+            shutil.copyfile(src, dst)
+        else:
+            logging.critical(f'Copy PermissionError : {os.path.basename(src)} impossible to paste')
+            raise Exception('Copy PermissionError : impossible to paste')
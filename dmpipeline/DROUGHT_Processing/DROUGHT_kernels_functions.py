@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+##############################################################################
+
+DROUGHT kernels for per-pixel computations (fused single-pass loops compiled with numba, NumPy fallback) :
+NaN-aware statistics of historical images (climatology), min-max and z-score anomaly indices with their quality scores
+
+##############################################################################
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+import warnings
+warnings.simplefilter(action='ignore', category=RuntimeWarning)
+
+
+
+def jit(function):
+    """
+    Compile a kernel with numba (nopython mode, no GIL, cached on disk) if installed.
+    Without numba, kernels are not called (NumPy fallback of each public function is used instead).
+    """
+
+    if numba is None:
+        return function
+
+    return numba.njit(cache=True, nogil=True)(function)
+
+
+
+@jit
+def kernelNanStats(DATA, COUNT, COUNT_B, MEAN_B, M2_B, MIN_B, MAX_B, QSUM_B):
+    """
+    Single pass over images (N, P) : running count, mean and sum of squared deviations (Welford),
+    min/max of valid values, and sum of compositing counts, per pixel (outputs of size P, initialized here).
+    """
+
+    N, P = DATA.shape
+    for p in range(P):
+        COUNT_B[p] = 0
+        MEAN_B[p] = 0
+        M2_B[p] = 0
+        MIN_B[p] = np.nan
+        MAX_B[p] = np.nan
+        QSUM_B[p] = 0
+
+    for i in range(N):
+        for p in range(P):
+            QSUM_B[p] += COUNT[i, p]
+            x = DATA[i, p]
+            if np.isnan(x):
+                continue
+            COUNT_B[p] += 1
+            delta = x - MEAN_B[p]
+            MEAN_B[p] += delta / COUNT_B[p]
+            M2_B[p] += delta * (x - MEAN_B[p])
+            if not (x >= MIN_B[p]): MIN_B[p] = x
+            if not (x <= MAX_B[p]): MAX_B[p] = x
+
+
+
+@jit
+def kernelIndex(X, COUNT, ndays_max, A, B, QSCORE_histo, method, zero_nan, INDIC, QSCORE):
+    """
+    Single pass over pixels : anomaly index and quality score of one image (X, compositing COUNT) into INDIC, QSCORE :
+        - method 0 (min-max) : (X - A) / (B - A), NaN if A==B      (A=MIN, B=MAX)
+        - method 1 (inverted min-max) : (B - X) / (B - A)           (A=MIN, B=MAX)
+        - method 2 (z-score) : (X - A) / B, NaN if B==0             (A=MEAN, B=STD)
+        - QSCORE = mean(QSCORE_histo, COUNT/ndays_max), 0 if COUNT==0 (or if X is NaN when zero_nan)
+    """
+
+    half = np.float32(2)
+    for p in range(X.size):
+        x = X[p]
+        a = A[p]
+        b = B[p]
+        if method==2:
+            if b == 0: INDIC[p] = np.nan
+            else: INDIC[p] = (x - a) / b
+        elif b == a:
+            INDIC[p] = np.nan
+        elif method==1:
+            INDIC[p] = (b - x) / (b - a)
+        else:
+            INDIC[p] = (x - a) / (b - a)
+
+        q = np.float32(COUNT[p]) / ndays_max
+        if zero_nan: zero = np.isnan(x)
+        else: zero = (q == 0)
+        if zero: QSCORE[p] = 0
+        else: QSCORE[p] = (QSCORE_histo[p] + q) / half
+
+
+
+@jit
+def kernelCombine(A, QA, B, QB, alpha, beta, INDIC, QSCORE):
+    """
+    Single pass over pixels : weighted combination of two indices (alpha*A + beta*B) into INDIC,
+    and mean of their quality scores into QSCORE (0 if one of them is 0).
+    """
+
+    half = np.float32(2)
+    for p in range(A.size):
+        INDIC[p] = alpha * A[p] + beta * B[p]
+        if (QA[p] == 0) or (QB[p] == 0): QSCORE[p] = 0
+        else: QSCORE[p] = (QA[p] + QB[p]) / half
+
+
+
+def nanStats(DATA, COUNT):
+    """
+    Statistics of images to merge into a climatology, along the first axis of DATA/COUNT cubes (N, ...) :
+        - count_b, mean_b, m2_b (number of valid values, mean, sum of squared deviations, float64 ; 0 where no valid value)
+        - min_b, max_b (float32, NaN where no valid value)
+        - qsum_b (sum of compositing counts, float64)
+    With numba, all statistics are computed in a single pass (Welford), instead of one NaN reduction per statistic.
+    """
+
+    shape = DATA.shape[1:]
+
+    if numba is not None:
+        P = int(np.prod(shape))
+        count_b, mean_b, m2_b, qsum_b = [np.empty(P, 'float64') for _ in range(4)]
+        min_b, max_b = [np.empty(P, 'float32') for _ in range(2)]
+        kernelNanStats(np.ascontiguousarray(DATA).reshape(DATA.shape[0], P), np.ascontiguousarray(COUNT).reshape(COUNT.shape[0], P),
+                       count_b, mean_b, m2_b, min_b, max_b, qsum_b)
+        return tuple(ARRAY.reshape(shape) for ARRAY in (count_b, mean_b, m2_b, min_b, max_b, qsum_b))
+
+    count_b = np.sum(~np.isnan(DATA), axis=0).astype('float64')
+    mean_b = np.where(count_b>0, np.nanmean(DATA, axis=0), 0).astype('float64')
+    m2_b = np.where(count_b>0, np.nanvar(DATA, axis=0).astype('float64') * count_b, 0)
+    min_b = np.nanmin(DATA, axis=0)
+    max_b = np.nanmax(DATA, axis=0)
+    qsum_b = np.sum(COUNT, axis=0, dtype='float64')
+
+    return count_b, mean_b, m2_b, min_b, max_b, qsum_b
+
+
+
+def allocateOutputs(shape, OUT=None):
+    """
+    Output buffers (INDIC, QSCORE) of an index : OUT if given (preallocated, reused for each image of a block), new ones otherwise.
+    """
+
+    if OUT is None:
+        return np.empty(shape, 'float32'), np.empty(shape, 'float32')
+
+    return OUT
+
+
+
+def anomalyIndex(X, COUNT, ndays_max, CLIMATO, method='minmax', zero_nan=False, OUT=None):
+    """
+    Anomaly index of one image (X, compositing COUNT) knowing its climatology (CLIMATO), and its quality score :
+        - method 'minmax' : (X - MIN) / (MAX - MIN)
+        - method 'minmax_inv' : (MAX - X) / (MAX - MIN)
+        - method 'zscore' : (X - MEAN) / STD
+        - QSCORE = mean(QSCORE_histo, COUNT/ndays_max), 0 where COUNT is 0 (or where X is NaN if zero_nan)
+    Outputs are written into OUT buffers (INDIC, QSCORE) if given. Returns (INDIC, QSCORE).
+    """
+
+    INDIC, QSCORE = allocateOutputs(X.shape, OUT)
+    if method=='zscore':
+        A, B = CLIMATO['MEAN'], CLIMATO['STD']
+    else:
+        A, B = CLIMATO['MIN'], CLIMATO['MAX']
+
+    if numba is not None:
+        kernelIndex(X.ravel(), COUNT.ravel(), np.float32(ndays_max), A.ravel(), B.ravel(), CLIMATO['QSCORE'].ravel(),
+                    ['minmax', 'minmax_inv', 'zscore'].index(method), zero_nan, INDIC.reshape(-1), QSCORE.reshape(-1))
+        return INDIC, QSCORE
+
+    # --- NumPy fallback (into buffers) ---
+    if method=='zscore':
+        np.subtract(X, A, out=INDIC)
+        np.divide(INDIC, B, out=INDIC)
+        INDIC[B == 0] = np.nan
+    else:
+        if method=='minmax_inv': np.subtract(B, X, out=INDIC)
+        else: np.subtract(X, A, out=INDIC)
+        np.divide(INDIC, B - A, out=INDIC)
+        INDIC[B == A] = np.nan
+
+    np.divide(COUNT, np.float32(ndays_max), out=QSCORE, dtype='float32')
+    zero = np.isnan(X) if zero_nan else (QSCORE == 0)
+    np.add(CLIMATO['QSCORE'], QSCORE, out=QSCORE)
+    np.divide(QSCORE, np.float32(2), out=QSCORE)
+    QSCORE[zero] = 0
+
+    return INDIC, QSCORE
+
+
+
+def combineIndex(A, QA, B, QB, alpha, OUT=None):
+    """
+    Weighted combination of two indices : alpha*A + (1-alpha)*B, and mean of their quality scores (0 if one of them is 0).
+    Outputs are written into OUT buffers (INDIC, QSCORE) if given. Returns (INDIC, QSCORE).
+    """
+
+    INDIC, QSCORE = allocateOutputs(A.shape, OUT)
+
+    if numba is not None:
+        kernelCombine(A.ravel(), QA.ravel(), B.ravel(), QB.ravel(), np.float32(alpha), np.float32(1-alpha),
+                      INDIC.reshape(-1), QSCORE.reshape(-1))
+        return INDIC, QSCORE
+
+    # --- NumPy fallback (into buffers) ---
+    np.multiply(A, np.float32(alpha), out=INDIC)
+    INDIC += np.float32(1-alpha) * B
+    np.add(QA, QB, out=QSCORE)
+    np.divide(QSCORE, np.float32(2), out=QSCORE)
+    QSCORE[(QA == 0) | (QB == 0)] = 0
+
+    return INDIC, QSCORE
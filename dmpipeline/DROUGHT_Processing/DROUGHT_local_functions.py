@@ -15,9 +15,13 @@ import pandas as pd
 import geopandas as gpd
 import rasterio
 import rasterio.mask
-from rasterio.windows import Window
 from rasterio.warp import reproject, Resampling
 from tqdm import tqdm
+import dmpipeline.DROUGHT_Processing.DROUGHT_blocks_functions as blocks
+import dmpipeline.DROUGHT_Processing.DROUGHT_anomaly_functions as anomaly
+import dmpipeline.DROUGHT_Processing.DROUGHT_datacube_functions as cubes
+import dmpipeline.DROUGHT_Processing.DROUGHT_catalog_functions as catalog
+import dmpipeline.DROUGHT_Processing.DROUGHT_io_functions as rasters_io
 
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -50,6 +54,7 @@ def prepare_DATAFolders(CONFIG):
     
     HISTO_DIR = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str)
     TREE_DIR = [os.path.join(HISTO_DIR, '0_INDICES', 'LANDSAT_SENTINEL2', 'DECADE'),
+                os.path.join(HISTO_DIR, '0_INDICES', 'LANDSAT_SENTINEL2', 'CLIMATO'),
                 os.path.join(HISTO_DIR, '1_INDICATEURS', 'LOCAL', 'DECADE')]
     os.umask(0) # used to reset the directories permissions
 
@@ -224,21 +229,22 @@ def auto_processingPERIOD(CONFIG):
     end_D = [10, 20, 31]
     TERRITORY_str = CONFIG['TERRITORY'].replace('"', '').replace(' ', '_').replace('(', '').replace(')', '')
     DATA_HISTO = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, '0_INDICES', 'LANDSAT_SENTINEL2', 'DECADE')
+    CATALOG = catalog.refreshCatalog(catalog.getCatalog(CONFIG), [DATA_HISTO])
     
     # Controls input landsat TILES for filtering (or not) already processed products
     if (CONFIG['TILES_L'] is None) or (CONFIG['TILES_L']==''):
         logging.warning(f'No input landsat tiles : the last historic product will be the earliest detected on any tile !\n -> Fill TILES_L if a specific tile is needed \n')
-        histo_files = glob.glob(os.path.join(DATA_HISTO, '*.tif'))
+        histo_files = catalog.selectCatalog(CATALOG, DATA_HISTO)
 
     else:
         if type(CONFIG['TILES_L']) is list: TILES_L = CONFIG['TILES_L']
         else: TILES_L = CONFIG['TILES_L'].split(',')
 
         if len(TILES_L)==1:
-            histo_files = glob.glob(os.path.join(DATA_HISTO, f'*{TILES_L[0]}*.tif'))
+            histo_files = catalog.selectCatalog(CATALOG, DATA_HISTO, tile=f'*{TILES_L[0]}*')
             logging.info(f'Single input landsat tile {TILES_L[0]} : the last historic product will be detected considering this specific tile !\n')
         else:
-            histo_files = glob.glob(os.path.join(DATA_HISTO, '*.tif'))
+            histo_files = catalog.selectCatalog(CATALOG, DATA_HISTO)
             logging.warning(f'Several input landsat tile {TILES_L} : the last historic product detected will be the earliest on any tile !\n -> Fill TILES_L if a specific tile is needed \n')
 
     # Set new PERIOD END = end of the last full decade (previous one)
@@ -264,7 +270,7 @@ def auto_processingPERIOD(CONFIG):
     
     # IF HISTO PRODUCTS : Set new PERIOD START according to last histo product processed
     if len(histo_files)>0:
-        dates_list = [os.path.basename(f).split('_')[3] for f in histo_files]
+        dates_list = list(CATALOG.loc[CATALOG['path'].isin(histo_files), 'date'])
         dates = np.unique(dates_list)
         dates = pd.to_datetime(dates, format='%Y%m')
         period_start_histo = pd.Series(dates).min()
@@ -273,9 +279,9 @@ def auto_processingPERIOD(CONFIG):
         PERIOD_END_HISTO = period_end_histo.strftime('%Y%m')
 
         if len(TILES_L)==1:
-            list_end_histo =  glob.glob(os.path.join(DATA_HISTO, f'*{TILES_L[0]}_{PERIOD_END_HISTO}*.tif'))
+            list_end_histo = catalog.selectCatalog(CATALOG, DATA_HISTO, tile=f'*{TILES_L[0]}', date=PERIOD_END_HISTO)
         else:
-            list_end_histo =  glob.glob(os.path.join(DATA_HISTO, f'*{PERIOD_END_HISTO}*.tif'))
+            list_end_histo = catalog.selectCatalog(CATALOG, DATA_HISTO, date=PERIOD_END_HISTO)
         D_END_HISTO = list(np.unique([f.split('_')[-1][:-4] for f in list_end_histo]))
         d_number_list = []
         for f in D_END_HISTO:
@@ -332,36 +338,19 @@ def auto_processingPERIOD(CONFIG):
 
 
 
-def copyfile_Errorscontrol(src, dst):
-    """
-    Procedure to copy files and control in case of permission errors.
-    """
-
-    try:
-        shutil.copyfile(src, dst)
-    except PermissionError:
-        if os.path.exists(dst):
-            logging.warning(f'File already exists: {os.path.basename(src)} is replaced by new version')
-            os.remove(dst)
-            shutil.copyfile(src, dst)
-        else:
-            logging.critical(f'Copy PermissionError : {os.path.basename(src)} impossible to paste')
-            raise Exception('Copy PermissionError : impossible to paste')
-
-
-
-def extractProfilesLike_Tiles(data_dir, tiles_list):
+def extractProfilesLike_Tiles(data_dir, tiles_list, CATALOG=None):
     """
     Extract the profiles of historical products in data_dir, for each landsat tile listed in tiles_list
+    (from catalog of data_dir if given, without opening files)
     """
 
     PROFILE_LIKE = {}
+    if CATALOG is None: CATALOG = catalog.refreshCatalog(None, [data_dir])
     
     for tile in tiles_list:
-        file_like = glob.glob(os.path.join(data_dir, f'*{tile}*.tif'))[0]
-        with rasterio.open(file_like) as f_ds:
-            profile_tile = f_ds.profile
-            profile_tile.update(count=2)
+        file_like = catalog.selectCatalog(CATALOG, data_dir, tile=f'*{tile}*')[0]
+        profile_tile = catalog.profileCatalog(CATALOG, file_like)
+        profile_tile.update(count=2)
         
         PROFILE_LIKE[tile] = profile_tile
         del file_like, profile_tile
@@ -486,34 +475,7 @@ def process_ReprojectionClipping_Rasters(in_ds, dst_profile, lgrid_geo, out_path
 
 
 
-def removeCurrentYear_DATAList(DATAfiles):
-    """
-    In list of DATA files, remove file corresponding to the current year.
-    Used here to remove the current ndwi landsat/s2 indices before computing historical mean/std for VAI calculation.
-    """
-
-    curr_year = pd.Timestamp.now().year
-    DATAfiles_histo = []
-    DATAfiles_current = []
-
-    for f in DATAfiles:
-
-        date_str = os.path.basename(f).split('_')[3]
-        try:
-            date_year = pd.to_datetime(date_str, format='%Y%m').year
-        except ValueError:
-            logging.info(f'Extracting date in Data files list : Wrong date format for {date_str}, then not considered')
-            continue
-        if date_year < curr_year:
-            DATAfiles_histo.append(f)
-        else:
-            DATAfiles_current.append(f)
-
-    return DATAfiles_histo, DATAfiles_current
-
-
-
-def extractVAI(files, profile_like, ndays_max, outdir, period_indic=''):
+def extractVAI(files, profile_like, ndays_max, outdir, period_indic='', climato_file=None, files_new=None, mem_budget=None, compact=0):
     """
     Computing Vegetation Anomaly Index from Amri et al.(2011) and Peters et al.(2002):
         - VAI = (NDWIi - NDWImean) / NDWIstd)
@@ -528,96 +490,74 @@ def extractVAI(files, profile_like, ndays_max, outdir, period_indic=''):
     
     Note 2 : NDWI of current year are not included in the computation of historical NDWImean,NDWIstd,QSCORE_histo.
     
-    Note 3 : Rasters are divided into 4 blocks to avoid memory overload
+    Note 3 : Rasters are processed by blocks of rows, fitting into the memory budget (mem_budget in MB), to avoid memory overload,
+             with the generic anomaly engine (see anomaly.computeAnomaly)
+
+    Note 4 : IF climato_file is given, historical NDWImean,NDWIstd,QSCORE_histo are read from this climatology store,
+             which is only updated with the historical NDWI not merged yet.
+
+    Note 5 : IF files_new is given (new NDWI basenames), and the climatology is unchanged,
+             only VAI of these new dates are written (others can not change).
+             Returns the list of VAI files written.
+
+    Note 6 : IF compact=1, only pixels with NDWI data are computed (land-pixel compaction, see blocks.processIndicator_Blocks).
     """
 
-    # Extracting ndwi of current year
-    files_histo, files_current = removeCurrentYear_DATAList(files)
-    N_files = len(files)
-    N_files_histo = len(files_histo)
-
-    # Dividing into 4 blocks
-    W_b1 = int(profile_like['width']/2)
-    H_b1 = int(profile_like['height']/2)
-    W_b2 = int(np.ceil(profile_like['width']/2))
-    H_b2 = int(np.ceil(profile_like['height']/2))
-
-    col_off = [0, W_b1, 0,    W_b1]
-    row_off = [0, 0,    H_b1, H_b1]
-    W = [W_b1, W_b2, W_b1, W_b2]
-    H = [H_b1, H_b1, H_b2, H_b2]
-
-    profile_in = profile_like.copy()
-
-    # --- RASTERS ARE DIVIDED INTO 4 BLOCKS (to avoid memory overload) ---
-    for b in range(4):
-
-        logging.info(f'Block {b+1}/4')
-    
-        # --- COMPUTING HISTORICAL MEAN/STD and QSCORE ---
-        DATA = np.full((H[b],W[b],N_files), np.nan, 'float32')
-        QSCORE_year = np.full_like(DATA, np.nan, 'float32')
-
-        logging.info('Computing historical mean/std and qscore')
-        for i in tqdm(range(N_files_histo)):
-            with rasterio.open(files_histo[i]) as d_ds:
-                DATA[:,:,i] = d_ds.read(1, window=Window(col_off[b], row_off[b], W[b], H[b]))
-                if d_ds.count==2:
-                    COUNT = d_ds.read(2, window=Window(col_off[b], row_off[b], W[b], H[b]))
-                elif d_ds.count==1:
-                    COUNT = ~np.isnan(DATA[:,:,i])
-            QSCORE_year[:,:,i] = COUNT/ndays_max
-            del COUNT
-
-        MEAN_histo = np.nanmean(DATA,axis=2)
-        STD_histo = np.nanstd(DATA,axis=2)
-        QSCORE_histo = np.mean(QSCORE_year[:,:,:i], axis=2)
-
-        # Here adding ndwi of current year
-        for f in files_current:
-            i+=1
-            with rasterio.open(f) as d_ds:
-                DATA[:,:,i] = d_ds.read(1, window=Window(col_off[b], row_off[b], W[b], H[b]))
-                if d_ds.count==2:
-                    COUNT = d_ds.read(2, window=Window(col_off[b], row_off[b], W[b], H[b]))
-                elif d_ds.count==1:
-                    COUNT = ~np.isnan(DATA[:,:,i])
-            QSCORE_year[:,:,i] = COUNT/ndays_max
-            del COUNT
-
-        # --- APPLY VAI EQUATION TO EACH IMAGE ON THE PERIOD ---
-        logging.info('Apply VAI equation to each image on the period')
-        for i in tqdm(range(N_files)):
-
-            #  Compute VAI
-            VAI = (DATA[:,:,i] - MEAN_histo)/STD_histo
-            VAI[(STD_histo == 0)] = np.nan
-            VAI_QSCORE = np.mean(np.stack((QSCORE_histo,QSCORE_year[:,:,i]),axis=2),axis=2)
-            VAI_QSCORE[np.isnan(DATA[:,:,i])==1] = 0
-            
-            # Save file
-            in_file_name = os.path.basename(files[i]).split('.tif')[0]
-            tile = in_file_name.split('_')[2]
-            date = in_file_name.split('_')[3]
-            out_file_name = os.path.join(outdir, f'VAI_{tile}_{date}{period_indic}.tif')
-            if b==0:
-                # Writing rasters (block 1)
-                mode_rio='w'
-            elif b==1:
-                # Updating rasters (blocks 2,3,4)
-                mode_rio='r+'
-                # Remove multiple keys from dictionary (avoid warnings)
-                rem_list = ['blockxsize','blockysize','interleave','compress','tiled']
-                for key in rem_list:
-                    try: profile_in.pop(key)
-                    except KeyError: pass
-            
-            with rasterio.open(out_file_name, mode=mode_rio, **profile_in) as out_ds:
-                out_ds.write(VAI, window=Window(col_off[b], row_off[b], W[b], H[b]), indexes=1)
-                out_ds.write(VAI_QSCORE, window=Window(col_off[b], row_off[b], W[b], H[b]), indexes=2)
-            del VAI, VAI_QSCORE, in_file_name, out_file_name, tile, date
-    
-        del DATA, QSCORE_year, MEAN_histo, STD_histo, QSCORE_histo
+    files_out = anomaly.computeAnomaly(files, 'VAI', profile_like, ndays_max, outdir, period_indic, climato_file, files_new,
+                                       mem_budget, compact)
+
+    return [os.path.join(outdir, anomaly.nameAnomaly(f, 'VAI', period_indic)) for f in files_out]
+
+
+
+def selectNDWI_Decade(CATALOG, data_dir, tile_L, month, d):
+    """
+    Select NDWI files of a landsat tile for month and decade d (0, 1 or 2) in catalog of data_dir :
+    decade composites (COMPDx*), single dates of decade (DAYx*), single dates (DAY) and month composites (COMPM).
+    """
+
+    ndwi_files = []
+    for comp in [f'COMPD{d+1}*', f'DAY{d+1}*', 'DAY', 'COMPM']:
+        ndwi_files += catalog.selectCatalog(CATALOG, data_dir, product='*_NDWI', tile=f'*{tile_L}', month=month, period=comp)
+
+    return ndwi_files
+
+
+
+def processVAI_Tile(tile_L, PERIODS, profile_like, ndays_max, DATA_CLIMATO, DATA_DROUGHT, outdir_vai, files_new=None, mem_budget=None, compact=0):
+    """
+    Processing VAI of one landsat tile for each (month, decade, ndwi files) of PERIODS, and copying new VAI products to data_histo directory.
+    Tiles (or decades of a tile) are independent jobs (own inputs, climatologies and outputs), so that jobs can run in parallel workers.
+    """
+
+    for month, d, ndwi_files in tqdm(PERIODS, desc=f'TILE {tile_L} - DECADES'):
+        logging.info(f'TILE LANDSAT : {tile_L} - MONTH : {month} - DECADE : {d+1}')
+
+        # Here, month vai is not estimated in the local proc chain to improve time processing (can be added if necessary)
+
+        # --- MISSING INDICES ---
+        if ndwi_files==[]:
+            logging.warning('NO PRODUCTS -> PASS')
+            continue
+
+        # --- SINGLE YEAR ---
+        if len(ndwi_files)==1:
+            logging.warning('SINGLE YEAR -> PASS')
+            continue
+
+        # --- COMPUTING DECADE VAI ---
+        new_vai_d = extractVAI(ndwi_files, profile_like, ndays_max, outdir_vai, f'D{d+1}',
+                               os.path.join(DATA_CLIMATO, f'CLIMATO_{tile_L}_NDWI_{month}_D{d+1}.tif'), files_new, mem_budget, compact)
+
+        # --- NO NEW DATES ---
+        if new_vai_d==[]:
+            logging.info('NO NEW DATES -> PASS')
+            continue
+
+        # --- COPYING TO DATA_HISTO (own files of the job, written by this run) ---
+        for fd in tqdm(new_vai_d):
+            rasters_io.copyfile_Errorscontrol(fd, os.path.join(DATA_DROUGHT, 'DECADE', os.path.basename(fd)))
+        del new_vai_d
 
 
 
@@ -632,6 +572,14 @@ def process_LocalDrought_VAI(CONFIG, OUTDIR_PATHS):
     This is the case for MODIS, but not for Landat/S2 (maximum is ~6 per decade).
     This is set in order to permit the comparison of the quality of both indicators (VHI vs VAI)
     
+    IF CONFIG['NEWDATES_ONLY']=1 (default) in AUTO mode, only new dates are written
+    (all dates are rewritten at year rollover, or if historical indices changed).
+    
+    Landsat tiles are independent jobs, processed by CONFIG['N_WORKERS'] parallel workers (default 1, sequential),
+    each with its own memory budget CONFIG['MEM_BUDGET'].
+    IF CONFIG['PARALLEL_DECADES']=1, each decade of each tile is a job (more jobs than tiles, for many workers).
+    IF CONFIG['DATACUBE']=1, NDWI stacks are read from datacubes of indices (synchronized with data_histo GeoTIFF).
+    
     Final products are saved (updated) into date_histo directory.
     
     Note :  vai is given at S2 10m resolution
@@ -646,8 +594,20 @@ def process_LocalDrought_VAI(CONFIG, OUTDIR_PATHS):
     TERRITORY_str = CONFIG['TERRITORY'].replace('"', '').replace(' ', '_').replace('(', '').replace(')', '')
     DATA_HISTO = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, '0_INDICES', 'LANDSAT_SENTINEL2')
     DATA_DROUGHT = os.path.join(CONFIG['DATA_HISTO'], TERRITORY_str, '1_INDICATEURS', 'LOCAL')
+    DATA_CLIMATO = os.path.join(DATA_HISTO, 'CLIMATO')
     LANDSAT_GRID = os.path.join(CONFIG['ANNEX_DIR'], 'Landsat_Grid_World', 'Landsat_Grid_World.shp')
     MODE = CONFIG['MODE']
+    if (CONFIG.get('NEWDATES_ONLY') is None) or (CONFIG['NEWDATES_ONLY']==''): go_newdates = 1
+    else: go_newdates = int(CONFIG['NEWDATES_ONLY'])
+    if (CONFIG.get('PARALLEL_DECADES') is None) or (CONFIG['PARALLEL_DECADES']==''): go_decades = 0
+    else: go_decades = int(CONFIG['PARALLEL_DECADES'])
+    go_datacube = cubes.getDatacube(CONFIG)
+    files_new = None
+    mem_budget = blocks.getMemoryBudget(CONFIG)
+    compact = blocks.getCompactLand(CONFIG)
+    n_workers = blocks.getWorkers(CONFIG)
+    catalog_file = catalog.getCatalog(CONFIG)
+    CATALOG = catalog.refreshCatalog(catalog_file, [os.path.join(DATA_HISTO, 'DECADE')])
     
     # --- AUTOMATIC/MANUAL/INDICES MODE -> process VAI to corresponding new indices months/decades ---
     if ('AUTO' in MODE) or ('MANUAL' in MODE) or ('INDICES' in MODE):
@@ -660,7 +620,7 @@ def process_LocalDrought_VAI(CONFIG, OUTDIR_PATHS):
         m_str = np.unique(m_list)
         tiles_list = [os.path.basename(f).split('_')[2] for f in new_files]
         TILES_L = np.unique(tiles_list)
-        PROFILES_L = extractProfilesLike_Tiles(os.path.join(DATA_HISTO, 'DECADE'), TILES_L)
+        PROFILES_L = extractProfilesLike_Tiles(os.path.join(DATA_HISTO, 'DECADE'), TILES_L, CATALOG)
         GRIDS_L = extractGridGeo(LANDSAT_GRID, os.path.join(DATA_HISTO, 'DECADE'), TILES_L)
         
         # Control that new indices sizes are like histo indices -> if not, reprojection and clipping according to histo profile
@@ -673,14 +633,16 @@ def process_LocalDrought_VAI(CONFIG, OUTDIR_PATHS):
                     or f_ds.profile['width']!=profile_like['width']:
                     process_ReprojectionClipping_Rasters(f_ds, profile_like, lgrid_geo, os.path.join(DATA_HISTO, 'DECADE', os.path.basename(f)))
             del tile_L, profile_like
+
+        if ('AUTO' in MODE) and go_newdates==1:
+            logging.info('Only new dates will be written (if historical indices are unchanged)')
+            files_new = [os.path.basename(f) for f in new_files]
     
     # --- DROUGHT MODE -> compute/update vai products from data historic directory ---
     elif 'DROUGHT' in MODE:
         if (CONFIG['TILES_L'] is None) or (CONFIG['TILES_L']==''):
             logging.info(f'{MODE} MODE : recompute vai products from data historic directory')
-            new_files = glob.glob(os.path.join(DATA_HISTO, 'DECADE', '*.tif'))
-            tiles_list = [os.path.basename(f).split('_')[2] for f in new_files]
-            TILES_L = np.unique(tiles_list)
+            TILES_L = np.unique([tile for tile in CATALOG['tile'] if isinstance(tile, str) and tile!=''])
         else:
             if type(CONFIG['TILES_L']) is list: TILES_L = CONFIG['TILES_L']
             else: TILES_L = CONFIG['TILES_L'].split(',')
@@ -688,9 +650,7 @@ def process_LocalDrought_VAI(CONFIG, OUTDIR_PATHS):
                 logging.info(f'{MODE} MODE : recompute vai products from data historic directory for tiles {TILES_L}')
             else:
                 logging.info(f'{MODE} MODE : recompute vai products from data historic directory')
-                new_files = glob.glob(os.path.join(DATA_HISTO, 'DECADE', '*.tif'))
-                tiles_list = [os.path.basename(f).split('_')[2] for f in new_files]
-                TILES_L = np.unique(tiles_list)
+                TILES_L = np.unique([tile for tile in CATALOG['tile'] if isinstance(tile, str) and tile!=''])
         PERIOD_START = CONFIG['PERIOD_START'].split(',')[0]
         PERIOD_END = CONFIG['PERIOD_END'].split(',')[0]
         if PERIOD_START!='' and PERIOD_END!='':
@@ -703,7 +663,7 @@ def process_LocalDrought_VAI(CONFIG, OUTDIR_PATHS):
         else:
             m_dt = pd.date_range(start='2020-01-01', end='2021-01-01', freq='M')
         m_str = np.unique(m_dt.strftime("%m"))
-        PROFILES_L = extractProfilesLike_Tiles(os.path.join(DATA_HISTO, 'DECADE'), TILES_L)
+        PROFILES_L = extractProfilesLike_Tiles(os.path.join(DATA_HISTO, 'DECADE'), TILES_L, CATALOG)
     
     # --- WRONG MODE ---
     else:
@@ -711,52 +671,29 @@ def process_LocalDrought_VAI(CONFIG, OUTDIR_PATHS):
         raise Exception('Wrong PROCESSING MODE')
     
     
-    # ===================================== LOOP OVER LANDSAT TILES =================================
-
-    for tile_L in tqdm(TILES_L, desc='TILES'):
-        # logging.info(f'TILE LANDSAT : {tile_L}')    
+    # --- Refresh catalog (new indices possibly reprojected into data histo) ---
+    CATALOG = catalog.refreshCatalog(catalog_file, [os.path.join(DATA_HISTO, 'DECADE')])
 
+    # --- Synchronize datacubes of indices (once, before jobs) ---
+    if go_datacube==1:
+        logging.info('Synchronize datacubes of indices')
+        cubes.syncDatacubes(catalog.selectCatalog(CATALOG))
 
-        # ========================================== LOOP OVER MONTHS =================================
-        
-        for month in tqdm(m_str, desc='MONTHS'):
-            # logging.info(f'MONTH : {month}')
-
-            # Here, month vai is not estimated in the local proc chain to improve time processing (can be added if necessary)
-
-
-        # ========================================== LOOP OVER DECADES =================================
 
-            for d in range(3):
-                logging.info(f'DECADE : {d+1}')
+    # ============================== LIST TILES (OR TILES/DECADES) JOBS ===========================
 
-                ndwi_files_d = glob.glob(os.path.join(DATA_HISTO, 'DECADE', f'*{tile_L}_*{month}_NDWI_COMPD{d+1}*.tif'))
-                ndwi_files_dayd = glob.glob(os.path.join(DATA_HISTO, 'DECADE', f'*{tile_L}_*{month}_NDWI_DAY{d+1}*.tif'))
-                ndwi_files_day = glob.glob(os.path.join(DATA_HISTO, 'DECADE', f'*{tile_L}_*{month}_NDWI_DAY.tif'))
-                ndwi_files_m = glob.glob(os.path.join(DATA_HISTO, 'DECADE', f'*{tile_L}_*{month}_NDWI_COMPM.tif'))
-                
-                ndwi_files = ndwi_files_d + ndwi_files_dayd + ndwi_files_day + ndwi_files_m
-
-                # --- MISSING INDICES ---
-                if ndwi_files==[]:
-                    logging.warning('NO PRODUCTS -> PASS')
-                    del ndwi_files_d, ndwi_files_dayd, ndwi_files_day, ndwi_files_m, ndwi_files
-                    continue
-
-                # --- SINGLE YEAR ---
-                if len(ndwi_files)==1:
-                    logging.warning('SINGLE YEAR -> PASS')
-                    del ndwi_files_d, ndwi_files_dayd, ndwi_files_day, ndwi_files_m, ndwi_files
-                    continue
+    JOBS = []
+    PERIODS = []
+    for tile_L in TILES_L:
+        PERIODS = [(month, d, selectNDWI_Decade(CATALOG, os.path.join(DATA_HISTO, 'DECADE'), tile_L, month, d)) for month in m_str for d in range(3)]
+        if go_decades==1:
+            JOBS += [(tile_L, [period], PROFILES_L[tile_L], NDAYS_MAX_D, DATA_CLIMATO, DATA_DROUGHT, outdir_vai, files_new, mem_budget, compact)
+                     for period in PERIODS]
+        else:
+            JOBS += [(tile_L, PERIODS, PROFILES_L[tile_L], NDAYS_MAX_D, DATA_CLIMATO, DATA_DROUGHT, outdir_vai, files_new, mem_budget, compact)]
 
-                # --- COMPUTING DECADE VAI ---
-                extractVAI(ndwi_files, PROFILES_L[tile_L], NDAYS_MAX_D, outdir_vai, f'D{d+1}')
-                del ndwi_files_d, ndwi_files_dayd, ndwi_files_day, ndwi_files_m, ndwi_files
 
-                # --- COPYING TO DATA_HISTO ---
-                new_vai_d = glob.glob(os.path.join(outdir_vai,f'VAI_*{tile_L}_*{month}D{d+1}.tif'))
-                for fd in tqdm(new_vai_d):
-                    copyfile_Errorscontrol(fd, os.path.join(DATA_DROUGHT, 'DECADE', os.path.basename(fd)))
-                del new_vai_d
- 
+    # ================================ PROCESS JOBS (sequential or parallel workers) ================
 
+    blocks.runJobs(processVAI_Tile, JOBS, n_workers)
+    del PERIODS, JOBS
@@ -8,19 +8,37 @@ GEOSTATS functions for processing spatial statistics of drought indicators
 """
 
 import os
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 import rasterio
 from rasterio import features
 import rasterio.mask
-from rasterio.warp import reproject, Resampling, aligned_target
+from rasterio.warp import Resampling, aligned_target
+from rasterio.vrt import WarpedVRT
 from zipfile import BadZipFile, ZipFile
 
 import logging
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S', level=logging.INFO)
 
 
+MASKS_CACHE_SIZE = 8
+MASKS_CACHE = OrderedDict()
+
+
+def getLevels(CONFIG):
+    """
+    Read coarser levels of sub-areas from CONFIG['LEVELS_STATS'] (default None, single level) :
+    comma-separated fields of the areas shapefile (kept in look-up table), e.g. LEVELS_STATS='commune,province'.
+    """
+
+    if (CONFIG.get('LEVELS_STATS') is None) or (CONFIG['LEVELS_STATS']==''):
+        return None
+
+    return [level.strip() for level in CONFIG['LEVELS_STATS'].replace("'", '').replace('"', '').split(',') if level.strip()!='']
+
+
 
 def extractAreasMask(ref_rast, areas_shp, areas_key=None):
     """
@@ -30,6 +48,7 @@ def extractAreasMask(ref_rast, areas_shp, areas_key=None):
         - a key identifying areas name in input shp (default 'nom')
     Note :  mask pixels are filled with the ObjectId values of the shapefile geometries
             A look-up table (dataframe) is generated to associate any ObjectId to the corresponding geometry (name)
+            Mask dtype is the smallest integer type holding all ObjectIds (int8 up to 127 areas, int16 or int32 beyond)
     """
 
     if (areas_key is None) or (areas_key=='') : areas_key='nom'
@@ -53,13 +72,19 @@ def extractAreasMask(ref_rast, areas_shp, areas_key=None):
             logging.critical(f'Wrong areas column name in input geometry shp : missing key {areas_key}')
             raise Exception(('Wrong areas column name in input geometry'))
         
+        id_max = int(mskarea_gdf['OBJECTID'].max()) if len(mskarea_gdf)>0 else 0
+        if id_max <= np.iinfo(np.int8).max: dtype_out = rasterio.int8
+        elif id_max <= np.iinfo(np.int16).max: dtype_out = rasterio.int16
+        else: dtype_out = rasterio.int32
+
         maskarea_data = features.rasterize(
             [(mskarea_gdf['geometry'][i],int(mskarea_gdf['OBJECTID'][i])) for i in range(len(mskarea_gdf))],
             out_shape=d_ds.shape,
-            transform=d_ds.profile['transform'])
+            transform=d_ds.profile['transform'],
+            dtype=(rasterio.uint8 if dtype_out==rasterio.int8 else dtype_out))
         
         profile_out = d_ds.profile
-        profile_out.update(dtype=rasterio.int8, nodata=0)
+        profile_out.update(dtype=dtype_out, nodata=0)
         if profile_out['count']>1:
             profile_out.update(count=1)
             
@@ -73,12 +98,14 @@ def extractAreasMask(ref_rast, areas_shp, areas_key=None):
 
 
 
-def extractLandCoverMask(ref_rast, landcover_rast, classlist2mask):
+def reprojectLandCover(ref_rast, landcover_rast, cache_file=None):
     """
-    Extract landcover mask according to :
-        - a reference raster grid (target output grid)
-        - a landcover raster (any .tif landcover product)
-        - a classlist containing pixel values (correspond to those in landcover) to mask
+    Reproject landcover classes on a reference raster grid (target output grid), with nearest resampling :
+        - landcover is read through a warped VRT : only source blocks covering the reference extent are read,
+          chunk by chunk (a fine-resolution landcover does not have to fit in memory)
+        - IF cache_file is given, reprojected classes are stored in it (GeoTIFF), and read again for the same
+          landcover file (name, size, modification time) and target grid
+    Pixels outside landcover extent are 0 (landcover nodata is not applied, as classes are masked afterwards).
     """
     
     zip_in = 0
@@ -89,26 +116,56 @@ def extractLandCoverMask(ref_rast, landcover_rast, classlist2mask):
         with ZipFile(zf_path) as zf:
             ref_rast = zf.open(tf_path)
 
-    with rasterio.open(landcover_rast) as landc_ds, \
-        rasterio.open(ref_rast, GEOREF_SOURCES='INTERNAL') as d_ds:
-        src_LANDC = landc_ds.read(1)
-        src_profile = landc_ds.profile
+    with rasterio.open(ref_rast, GEOREF_SOURCES='INTERNAL') as d_ds:
         dst_profile = d_ds.profile
-        dst_LANDC = np.zeros((dst_profile['height'],dst_profile['width']), src_LANDC.dtype)
-
     if zip_in==1: ref_rast.close()
 
-    reproject(src_LANDC,
-              dst_LANDC,
-              src_transform=src_profile['transform'],
-              src_crs=src_profile['crs'],
-              dst_transform=dst_profile['transform'],
-              dst_crs=dst_profile['crs'],
-              resampling=Resampling.nearest)
+    landc_stat = os.stat(landcover_rast)
+    signature = (f'{os.path.basename(landcover_rast)};{landc_stat.st_size};{int(landc_stat.st_mtime)};'
+                 f'{dst_profile["crs"]};{list(dst_profile["transform"])[:6]};{dst_profile["height"]};{dst_profile["width"]}')
+
+    # --- Reprojected classes already cached for landcover and grid ---
+    if (cache_file is not None) and os.path.exists(cache_file):
+        with rasterio.open(cache_file) as c_ds:
+            if c_ds.tags().get('SIGNATURE')==signature:
+                return c_ds.read(1), dst_profile
+
+    with rasterio.open(landcover_rast) as landc_ds:
+        with WarpedVRT(landc_ds,
+                       crs=dst_profile['crs'],
+                       transform=dst_profile['transform'],
+                       width=dst_profile['width'],
+                       height=dst_profile['height'],
+                       resampling=Resampling.nearest,
+                       src_nodata=None,
+                       nodata=0) as vrt_ds:
+            dst_LANDC = vrt_ds.read(1)
+
+    if cache_file is not None:
+        cache_profile = dst_profile.copy()
+        cache_profile.update(count=1, dtype=dst_LANDC.dtype, nodata=None, compress='deflate')
+        with rasterio.open(f'{cache_file}.{os.getpid()}.tmp', 'w', **dict(cache_profile, driver='GTiff')) as c_ds:
+            c_ds.write(dst_LANDC, 1)
+            c_ds.update_tags(SIGNATURE=signature)
+        os.replace(f'{cache_file}.{os.getpid()}.tmp', cache_file)
+
+    return dst_LANDC, dst_profile
+
+
+
+def extractLandCoverMask(ref_rast, landcover_rast, classlist2mask, cache_file=None):
+    """
+    Extract landcover mask according to :
+        - a reference raster grid (target output grid)
+        - a landcover raster (any .tif landcover product)
+        - a classlist containing pixel values (correspond to those in landcover) to mask
+    Note : landcover classes are reprojected once per landcover and grid if cache_file is given (see reprojectLandCover)
+    """
+
+    dst_LANDC, dst_profile = reprojectLandCover(ref_rast, landcover_rast, cache_file)
     
     masklandcover_data = np.ones(dst_LANDC.shape)
-    for class_val in classlist2mask:
-        masklandcover_data[(dst_LANDC==class_val)] = 0
+    masklandcover_data[np.isin(dst_LANDC, classlist2mask)] = 0
     
     profile_out = dst_profile
     profile_out.update(dtype=rasterio.int8, nodata=0)
@@ -149,7 +206,8 @@ def prepareGeoStatsMasks(file_like, file_areas, outdir_masks, suffix=None, file_
     if (file_landcover is not None) and (file_landcover != []):
         if suffix is None: mask_filename = 'mask_Areas_NOTrees_NOBuild.tif'
         else: mask_filename = f'mask_Areas_NOTrees_NOBuild_{suffix}.tif'
-        mask_NOTrees_NOBuild, profile_out = extractLandCoverMask(file_like, file_landcover, [2,7])
+        landcover_cache = os.path.join(outdir_masks, 'Landcover_Classes.tif' if suffix is None else f'Landcover_Classes_{suffix}.tif')
+        mask_NOTrees_NOBuild, profile_out = extractLandCoverMask(file_like, file_landcover, [2,7], landcover_cache)
         mask_NOTrees_NOBuild = (maskAREA!=0) & (mask_NOTrees_NOBuild==1)
         out_mask_filename = os.path.join(outdir_masks, mask_filename)
         with rasterio.open(out_mask_filename,'w',**profile_out) as out_ds:
@@ -159,15 +217,317 @@ def prepareGeoStatsMasks(file_like, file_areas, outdir_masks, suffix=None, file_
         # --- Generate mask keeping only Dense Vegetation (_Trees) ---
         if suffix is None: mask_filename = 'mask_Areas_Trees.tif'
         else: mask_filename = f'mask_Areas_Trees_{suffix}.tif'
-        mask_Trees, profile_out = extractLandCoverMask(file_like, file_landcover, [0,1,3,4,5,6,7,8,9,10])
+        mask_Trees, profile_out = extractLandCoverMask(file_like, file_landcover, [0,1,3,4,5,6,7,8,9,10], landcover_cache)
         out_mask_filename = os.path.join(outdir_masks, mask_filename)
         with rasterio.open(out_mask_filename,'w',**profile_out) as out_ds:
             out_ds.write(mask_Trees,1)
         del mask_filename, out_mask_filename
+    else:
+        mask_NOTrees_NOBuild, mask_Trees = None, None
+
+    # --- Generate sparse index of (sub)areas pixels (for all masks) ---
+    INDEX = extractAreasIndex(maskAREA, None, mask_NOTrees_NOBuild, mask_Trees)
+    writeAreasIndex(INDEX, os.path.join(outdir_masks, pathAreasIndex(suffix)))
+
+
+
+def pathAreasIndex(suffix=None):
+    """
+    Name of the sparse index of (sub)areas pixels, stored alongside masks : mask_Areas.npz (or mask_Areas_<suffix>.npz).
+    """
 
+    if suffix is None: return 'mask_Areas.npz'
+    else: return f'mask_Areas_{suffix}.npz'
 
 
-def extractGeoStats(data, qscore, date, mask, maskAREA, area_df, territory, mask_NOTrees_NOBuild=None, mask_Trees=None):
+
+def extractAreasIndex(maskAREA, mask=None, mask_NOTrees_NOBuild=None, mask_Trees=None):
+    """
+    Sparse index (CSR-like) of (sub)areas pixels, for each landcover variant ('' any landcover, '_NoTrees_NoBuild', '_Trees') :
+        - PIXELS<variant> : flat offsets of sub-areas pixels, sorted by area label (pixel value of maskAREA)
+        - INDPTR<variant> : pixels of label i are PIXELS[INDPTR[i]:INDPTR[i+1]] (land-pixel counts of areas are np.diff(INDPTR))
+        - TERRITORY<variant> : flat offsets of territory pixels (mask, default maskAREA!=0)
+    and SHAPE of masks. Reductions on areas are then gathers on a few pixels instead of full-raster comparisons.
+    """
+
+    labels = maskAREA.ravel().astype(np.intp)
+    n_labels = max(int(labels.max()), 0) + 1
+    in_areas = (labels > 0)
+    dtype = np.int32 if labels.size < 2**31 else np.int64
+    if mask is None: mask = in_areas
+
+    VARIANTS = [('', mask, in_areas)]
+    if mask_NOTrees_NOBuild is not None:
+        VARIANTS.append(('_NoTrees_NoBuild', mask_NOTrees_NOBuild, in_areas & (mask_NOTrees_NOBuild.ravel()==1)))
+    if mask_Trees is not None:
+        VARIANTS.append(('_Trees', mask_Trees, in_areas & (mask_Trees.ravel()==1)))
+
+    INDEX = {'SHAPE': np.array(maskAREA.shape)}
+    for variant, mask_t, mask_a in VARIANTS:
+        PIXELS = np.flatnonzero(mask_a)
+        LABELS = labels[PIXELS]
+        INDEX[f'PIXELS{variant}'] = PIXELS[np.argsort(LABELS, kind='stable')].astype(dtype)
+        INDEX[f'INDPTR{variant}'] = np.r_[0, np.cumsum(np.bincount(LABELS, minlength=n_labels))].astype(dtype)
+        INDEX[f'TERRITORY{variant}'] = np.flatnonzero(np.ravel(mask_t)==1).astype(dtype)
+        del PIXELS, LABELS
+
+    return INDEX
+
+
+
+def writeAreasIndex(INDEX, index_file):
+    """
+    Write the sparse index of (sub)areas pixels (npz, atomic replace).
+    """
+
+    with open(f'{index_file}.{os.getpid()}.tmp', 'wb') as f:
+        np.savez_compressed(f, **INDEX)
+    os.replace(f'{index_file}.{os.getpid()}.tmp', index_file)
+
+
+
+def readAreasIndex(mask_dir, suffix=None):
+    """
+    Read the sparse index of (sub)areas pixels stored alongside masks of mask_dir.
+    IF missing or older than masks (e.g. masks prepared by a previous version), it is generated from masks and stored.
+    """
+
+    if suffix is None: MASKS = ['mask_Areas.tif', 'mask_Areas_NOTrees_NOBuild.tif', 'mask_Areas_Trees.tif']
+    else: MASKS = [f'mask_Areas_{suffix}.tif', f'mask_Areas_NOTrees_NOBuild_{suffix}.tif', f'mask_Areas_Trees_{suffix}.tif']
+    MASKS = [os.path.join(mask_dir, m) for m in MASKS]
+    index_file = os.path.join(mask_dir, pathAreasIndex(suffix))
+
+    if os.path.exists(index_file) and all(os.path.getmtime(index_file)>=os.path.getmtime(m) for m in MASKS if os.path.exists(m)):
+        with np.load(index_file) as f_index:
+            return dict(f_index)
+
+    logging.info(f'Generate sparse index of areas pixels : {os.path.basename(index_file)}')
+    MASKS_DATA = []
+    for m in MASKS:
+        if os.path.exists(m):
+            with rasterio.open(m) as m_ds:
+                MASKS_DATA.append(m_ds.read(1))
+        else:
+            MASKS_DATA.append(None)
+    INDEX = extractAreasIndex(MASKS_DATA[0], None, MASKS_DATA[1], MASKS_DATA[2])
+    writeAreasIndex(INDEX, index_file)
+
+    return INDEX
+
+
+
+def pixelsArea(INDEX, objectid, variant=''):
+    """
+    Flat offsets of the pixels of one sub-area (OBJECTID) in the sparse index (empty if no pixels).
+    """
+
+    INDPTR = INDEX[f'INDPTR{variant}']
+    if (objectid < 0) or (objectid >= INDPTR.size-1):
+        return INDEX[f'PIXELS{variant}'][:0]
+
+    return INDEX[f'PIXELS{variant}'][INDPTR[objectid]:INDPTR[objectid+1]]
+
+
+
+def readGeoStatsMasks(mask_dir, suffix=None):
+    """
+    Read the sparse index of areas pixels (see readAreasIndex) and the look-up table of a masks directory, through a cache :
+        - masks are loaded once per process (run), then shared by all dates/periods processed
+        - cache key is the masks directory and the signature (size, modification time) of masks and look-up table,
+          so masks prepared again (other grid, shapefile or landcover) are reloaded
+        - least recently used entries are dropped beyond MASKS_CACHE_SIZE
+    Returns (INDEX, area_lut) : index arrays are read-only, and area_lut must not be modified.
+    """
+
+    if suffix is None: FILES = ['mask_Areas.tif', 'mask_Areas_NOTrees_NOBuild.tif', 'mask_Areas_Trees.tif', 'ID_Name_Areas-lookup.csv']
+    else: FILES = [f'mask_Areas_{suffix}.tif', f'mask_Areas_NOTrees_NOBuild_{suffix}.tif', f'mask_Areas_Trees_{suffix}.tif', f'ID_Name_Areas-lookup_{suffix}.csv']
+    SIGNATURE = []
+    for f in FILES:
+        if os.path.exists(os.path.join(mask_dir, f)):
+            f_stat = os.stat(os.path.join(mask_dir, f))
+            SIGNATURE.append((f, f_stat.st_size, f_stat.st_mtime_ns))
+    key = (os.path.abspath(mask_dir), suffix, tuple(SIGNATURE))
+
+    if key in MASKS_CACHE:
+        MASKS_CACHE.move_to_end(key)
+        return MASKS_CACHE[key]
+
+    INDEX = readAreasIndex(mask_dir, suffix)
+    for ARRAY in INDEX.values():
+        ARRAY.flags.writeable = False
+    area_lut = pd.read_csv(os.path.join(mask_dir, FILES[-1]), sep=';')
+
+    MASKS_CACHE[key] = (INDEX, area_lut)
+    if len(MASKS_CACHE) > MASKS_CACHE_SIZE:
+        MASKS_CACHE.popitem(last=False)
+
+    return INDEX, area_lut
+
+
+
+def landmaskAreas(mask_dir, suffix=None):
+    """
+    Boolean land mask (territory pixels, inside sub-areas) on the grid of the masks of a directory, from the cached sparse index.
+    Used to restrict per-pixel indicators computations to land pixels (see blocks.processIndicator_Blocks).
+    """
+
+    INDEX, _ = readGeoStatsMasks(mask_dir, suffix)
+    LAND = np.zeros(int(np.prod(INDEX['SHAPE'])), bool)
+    LAND[INDEX['TERRITORY']] = True
+
+    return LAND.reshape(tuple(INDEX['SHAPE']))
+
+
+
+def zonalStats(data, qscore, labels, n_labels):
+    """
+    Sufficient statistics of data per label, in one pass of grouping (bincount, and sort for min/max) :
+        - data, qscore : values of the selected pixels (1D)
+        - labels : labels of the selected pixels (1D, integers from 0 to n_labels-1)
+    Returns a dictionary of arrays (n_labels) : NPIX (number of pixels), COUNT (number of valid data),
+    SUM, M2 (sum of squared deviations from the label mean), MIN, MAX (of valid data)
+    and QSUM (sum of qscore, NaN if any qscore is NaN).
+    M2 is accumulated around the label mean (second pass on grouped data), instead of a sum of squares,
+    to avoid the cancellation of SUMSQ/COUNT - MEAN**2 when the spread is small compared to the mean.
+    """
+
+    data = data.astype('float64')
+    valid = ~np.isnan(data)
+    labels_v = labels[valid]
+    data_v = data[valid]
+
+    STATS = {'NPIX': np.bincount(labels, minlength=n_labels),
+             'COUNT': np.bincount(labels_v, minlength=n_labels),
+             'SUM': np.bincount(labels_v, weights=data_v, minlength=n_labels),
+             'MIN': np.full(n_labels, np.nan),
+             'MAX': np.full(n_labels, np.nan),
+             'QSUM': np.bincount(labels, weights=qscore.astype('float64'), minlength=n_labels)}
+
+    # --- Sum of squared deviations : second pass around the mean of each label ---
+    with np.errstate(invalid='ignore', divide='ignore'):
+        MEAN = STATS['SUM'] / STATS['COUNT']
+    STATS['M2'] = np.bincount(labels_v, weights=(data_v - MEAN[labels_v])**2, minlength=n_labels)
+    del MEAN
+
+    # --- Min/Max : reduce sorted data between label boundaries ---
+    if labels_v.size>0:
+        order = np.argsort(labels_v, kind='stable')
+        labels_s = labels_v[order]
+        data_s = data_v[order]
+        I_START = np.flatnonzero(np.r_[True, labels_s[1:]!=labels_s[:-1]])
+        STATS['MIN'][labels_s[I_START]] = np.minimum.reduceat(data_s, I_START)
+        STATS['MAX'][labels_s[I_START]] = np.maximum.reduceat(data_s, I_START)
+        del order, labels_s, data_s, I_START
+
+    return STATS
+
+
+
+def zonalStats_Frame(STATS, LOCATIONS, date):
+    """
+    Dataframe of spatial statistics (MEAN, MIN, MAX, STD, QSCORE) from sufficient statistics (see zonalStats).
+    """
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        MEAN = STATS['SUM'] / STATS['COUNT']
+        STD = np.sqrt(STATS['M2'] / STATS['COUNT'])
+        QSCORE = STATS['QSUM'] / STATS['NPIX']
+
+    return pd.DataFrame({'LOCATION': LOCATIONS, 'DATE': date, 'MEAN': MEAN, 'MIN': STATS['MIN'],
+                         'MAX': STATS['MAX'], 'STD': STD, 'QSCORE': QSCORE})
+
+
+
+def rollupStats(STATS, area_df, level):
+    """
+    Sufficient statistics of a coarser level of areas, rolled up from the statistics of sub-areas (see zonalStats),
+    without reading rasters again :
+        - STATS : statistics of sub-areas, aligned on rows of the look-up table (area_df)
+        - level : column of area_df giving the coarser area of each sub-area (sub-areas without value are ignored)
+    Counts and sums are added, min/max are reduced, and sums of squared deviations are merged
+    with the parallel formula of Chan et al. (M2 = sum(M2_i) + sum(COUNT_i * (MEAN_i - MEAN)**2)).
+    Returns (statistics, names of coarser areas).
+    """
+
+    if level not in area_df.columns:
+        logging.critical(f'Wrong level of areas : missing field {level} in look-up table (areas shapefile)')
+        raise Exception('Wrong level of areas')
+
+    mask_l = area_df[level].notna().to_numpy()
+    NAMES, I_LEVEL = np.unique(area_df[level].to_numpy()[mask_l].astype(str), return_inverse=True)
+    n_levels = len(NAMES)
+
+    STATS_l = {key: np.bincount(I_LEVEL, weights=STATS[key][mask_l], minlength=n_levels) for key in ['NPIX','COUNT','SUM','M2','QSUM']}
+
+    # --- Merge of squared deviations (Chan et al.) ---
+    COUNT = STATS['COUNT'][mask_l]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        MEAN = STATS['SUM'][mask_l] / COUNT
+        MEAN_l = STATS_l['SUM'] / STATS_l['COUNT']
+    DELTA2 = np.where(COUNT>0, COUNT * (MEAN - MEAN_l[I_LEVEL])**2, 0)
+    STATS_l['M2'] += np.bincount(I_LEVEL, weights=DELTA2, minlength=n_levels)
+    del COUNT, MEAN, MEAN_l, DELTA2
+
+    STATS_l['MIN'] = np.full(n_levels, np.inf)
+    STATS_l['MAX'] = np.full(n_levels, -np.inf)
+    np.fmin.at(STATS_l['MIN'], I_LEVEL, STATS['MIN'][mask_l])
+    np.fmax.at(STATS_l['MAX'], I_LEVEL, STATS['MAX'][mask_l])
+    STATS_l['MIN'][STATS_l['COUNT']==0] = np.nan
+    STATS_l['MAX'][STATS_l['COUNT']==0] = np.nan
+
+    return STATS_l, NAMES
+
+
+
+def extractZonalStats(data, qscore, date, area_df, territory, INDEX, levels=None):
+    """
+    Spatial statistics on the entire Territory and on every Sub-Areas, for all landcover variants at once (single dataframe).
+    Column VARIANT gives the landcover variant of rows ('' any landcover, '_NoTrees_NoBuild', '_Trees'),
+    rows are ordered by variant, territory first then sub-areas (in look-up table order, empty sub-areas are skipped).
+    Pixels are gathered from the sparse index of areas (see extractAreasIndex), and each variant is processed
+    with one grouping of pixels (see zonalStats), instead of one mask per sub-area.
+    IF levels are given (columns of area_df, e.g. ['commune','province']), statistics of coarser areas are rolled up
+    from sub-areas statistics (see rollupStats), and added after sub-areas rows, level by level
+    (names already used by sub-areas are suffixed with the level, e.g. 'Sud (province)').
+    """
+
+    data = data.ravel()
+    qscore = qscore.ravel()
+    ID = area_df['OBJECTID'].to_numpy().astype(np.intp)
+
+    GEOSTATS = []
+    for variant in ['', '_NoTrees_NoBuild', '_Trees']:
+        if f'PIXELS{variant}' not in INDEX:
+            continue
+
+        # --- Statistics over TERRITORY ---
+        TERRITORY = INDEX[f'TERRITORY{variant}']
+        STATS = zonalStats(data[TERRITORY], qscore[TERRITORY], np.zeros(TERRITORY.size, np.intp), 1)
+        GEOSTATS.append(zonalStats_Frame(STATS, [territory], date).assign(VARIANT=variant))
+
+        # --- Statistics over SUB-AREAS ---
+        PIXELS = INDEX[f'PIXELS{variant}']
+        NPIX = np.diff(INDEX[f'INDPTR{variant}'])
+        n_labels = max(NPIX.size, int(ID.max(initial=0)) + 1)
+        STATS = zonalStats(data[PIXELS], qscore[PIXELS], np.repeat(np.arange(NPIX.size), NPIX), n_labels)
+        STATS = {key: STATS[key][ID] for key in STATS}
+        GeoStats_a = zonalStats_Frame(STATS, area_df['nom'].to_numpy(), date).assign(VARIANT=variant)
+        GEOSTATS.append(GeoStats_a.loc[STATS['NPIX']>0])
+
+        # --- Statistics over COARSER LEVELS (rolled up from SUB-AREAS) ---
+        for level in (levels or []):
+            STATS_l, NAMES = rollupStats(STATS, area_df, level)
+            NAMES = [f'{name} ({level})' if name in set(area_df['nom'].astype(str)) else name for name in NAMES]
+            GeoStats_l = zonalStats_Frame(STATS_l, NAMES, date).assign(VARIANT=variant)
+            GEOSTATS.append(GeoStats_l.loc[STATS_l['NPIX']>0])
+            del STATS_l, NAMES, GeoStats_l
+        del TERRITORY, PIXELS, NPIX, STATS, GeoStats_a
+
+    return pd.concat(GEOSTATS, ignore_index=True)
+
+
+
+def extractGeoStats(data, qscore, date, mask, maskAREA, area_df, territory, mask_NOTrees_NOBuild=None, mask_Trees=None, INDEX=None, levels=None):
     '''
     Spatial statistics are estimated on the entire Territory and on every Sub-Areas (predefined in input masks).
     Statistics are min, max and std of indices.
@@ -180,97 +540,20 @@ def extractGeoStats(data, qscore, date, mask, maskAREA, area_df, territory, mask
     Note : (sub)-areas on which to compute drought statistics are defined in spatial masks (.tif)
            The pixels of spatial masks are filled with specific values that are associated to areas names in the input look-up table (area_df)
            Masks and look-pu table are generated from 
+           Statistics of all areas and variants are computed at once (see extractZonalStats)
+           IF INDEX is given (sparse index of areas pixels, see readAreasIndex), input masks are not used
+           IF levels are given (look-up table fields), coarser areas are added (rolled up from sub-areas)
     '''
     
-    GeoStats_df = pd.DataFrame(columns=['LOCATION','DATE','MEAN','MIN','MAX','STD','QSCORE'])
-    GeoStats_df_NOTrees_NOBuild = GeoStats_df.copy()
-    GeoStats_df_Trees = GeoStats_df.copy()
-
-    # --- Statistics over TERRITORY ---
-    data_mean = np.nanmean(data[mask==1])
-    data_min = np.nanmin(data[mask==1])
-    data_max = np.nanmax(data[mask==1])
-    data_std = np.nanstd(data[mask==1])
-    data_qscore = np.mean(qscore[mask==1])
-    d = {'LOCATION':territory,'DATE':date,'MEAN':data_mean,'MIN':data_min,
-            'MAX':data_max,'STD':data_std,'QSCORE':data_qscore}
-    GeoStats_df = pd.concat([GeoStats_df, pd.DataFrame([d])], ignore_index=True)
-    del data_mean,data_min,data_max,data_std,data_qscore,d
-    
-    if mask_NOTrees_NOBuild is not None:
-        data_mean = np.nanmean(data[mask_NOTrees_NOBuild==1])
-        data_min = np.nanmin(data[mask_NOTrees_NOBuild==1])
-        data_max = np.nanmax(data[mask_NOTrees_NOBuild==1])
-        data_std = np.nanstd(data[mask_NOTrees_NOBuild==1])
-        data_qscore = np.mean(qscore[mask_NOTrees_NOBuild==1])
-        d = {'LOCATION':territory,'DATE':date,'MEAN':data_mean,'MIN':data_min,
-                'MAX':data_max,'STD':data_std,'QSCORE':data_qscore}
-        GeoStats_df_NOTrees_NOBuild = pd.concat([GeoStats_df_NOTrees_NOBuild, pd.DataFrame([d])], ignore_index=True)
-        del data_mean,data_min,data_max,data_std,data_qscore,d
-    
-    if mask_Trees is not None:
-        data_mean = np.nanmean(data[mask_Trees==1])
-        data_min = np.nanmin(data[mask_Trees==1])
-        data_max = np.nanmax(data[mask_Trees==1])
-        data_std = np.nanstd(data[mask_Trees==1])
-        data_qscore = np.mean(qscore[mask_Trees==1])
-        d = {'LOCATION':territory,'DATE':date,'MEAN':data_mean,'MIN':data_min,
-                'MAX':data_max,'STD':data_std,'QSCORE':data_qscore}
-        GeoStats_df_Trees = pd.concat([GeoStats_df_Trees, pd.DataFrame([d])], ignore_index=True)
-        del data_mean,data_min,data_max,data_std,data_qscore,d
-    
-    # --- Statistics over SUB-AREAS ---
-    for a in area_df['nom']:
-        
-        ind_a = area_df.loc[area_df['nom']==a, 'OBJECTID']
-        mask_a = (maskAREA == ind_a.values[0])
-        Nb_ALLDATA_a = np.sum(mask_a)
-        
-        # If no pixels on commune: go to next iteration
-        if Nb_ALLDATA_a==0:
-            continue
-        
-        if Nb_ALLDATA_a!=0:
-            data_mean_a = np.nanmean(data[mask_a==1])
-            data_min_a = np.nanmin(data[mask_a==1])
-            data_max_a = np.nanmax(data[mask_a==1])
-            data_std_a = np.nanstd(data[mask_a==1])
-            data_qscore_a = np.mean(qscore[mask_a==1])
-            d_a = {'LOCATION':a,'DATE':date,'MEAN':data_mean_a,'MIN':data_min_a,
-                    'MAX':data_max_a,'STD':data_std_a,'QSCORE':data_qscore_a}
-            GeoStats_df = pd.concat([GeoStats_df, pd.DataFrame([d_a])], ignore_index=True)
-            del data_mean_a,data_min_a,data_max_a,data_std_a,data_qscore_a,d_a
-        
-        if mask_NOTrees_NOBuild is not None:
-            mask_a_NOTrees_NOBuild = (mask_a==1) & (mask_NOTrees_NOBuild==1)
-            Nb_ALLDATA_a_NOTrees_NOBuild = np.sum(mask_a_NOTrees_NOBuild)
-
-            if Nb_ALLDATA_a_NOTrees_NOBuild!=0:                   
-                data_mean_a = np.nanmean(data[mask_a_NOTrees_NOBuild==1])
-                data_min_a = np.nanmin(data[mask_a_NOTrees_NOBuild==1])
-                data_max_a = np.nanmax(data[mask_a_NOTrees_NOBuild==1])
-                data_std_a = np.nanstd(data[mask_a_NOTrees_NOBuild==1])
-                data_qscore_a = np.mean(qscore[mask_a_NOTrees_NOBuild==1])
-                d_a = {'LOCATION':a,'DATE':date,'MEAN':data_mean_a,'MIN':data_min_a,
-                        'MAX':data_max_a,'STD':data_std_a,'QSCORE':data_qscore_a}
-                GeoStats_df_NOTrees_NOBuild = pd.concat([GeoStats_df_NOTrees_NOBuild, pd.DataFrame([d_a])], ignore_index=True)
-                del data_mean_a,data_min_a,data_max_a,data_std_a,data_qscore_a,d_a
-        
-        if mask_Trees is not None:
-            mask_a_Trees = (mask_a==1) & (mask_Trees==1)
-            Nb_ALLDATA_a_Trees = np.sum(mask_a_Trees)
-
-            if Nb_ALLDATA_a_Trees!=0:                   
-                data_mean_a = np.nanmean(data[mask_a_Trees==1])
-                data_min_a = np.nanmin(data[mask_a_Trees==1])
-                data_max_a = np.nanmax(data[mask_a_Trees==1])
-                data_std_a = np.nanstd(data[mask_a_Trees==1])
-                data_qscore_a = np.mean(qscore[mask_a_Trees==1])
-                d_a = {'LOCATION':a,'DATE':date,'MEAN':data_mean_a,'MIN':data_min_a,
-                        'MAX':data_max_a,'STD':data_std_a,'QSCORE':data_qscore_a}
-                GeoStats_df_Trees = pd.concat([GeoStats_df_Trees, pd.DataFrame([d_a])], ignore_index=True)
-                del data_mean_a,data_min_a,data_max_a,data_std_a,data_qscore_a,d_a
-        
+    if INDEX is None:
+        INDEX = extractAreasIndex(maskAREA, mask, mask_NOTrees_NOBuild, mask_Trees)
+    GeoStats_all = extractZonalStats(data, qscore, date, area_df, territory, INDEX, levels)
+    COLUMNS = ['LOCATION','DATE','MEAN','MIN','MAX','STD','QSCORE']
+
+    GeoStats_df, GeoStats_df_NOTrees_NOBuild, GeoStats_df_Trees = [
+        GeoStats_all.loc[GeoStats_all['VARIANT']==variant, COLUMNS].reset_index(drop=True)
+        for variant in ['', '_NoTrees_NoBuild', '_Trees']]
+
     return GeoStats_df, GeoStats_df_NOTrees_NOBuild, GeoStats_df_Trees
 
 
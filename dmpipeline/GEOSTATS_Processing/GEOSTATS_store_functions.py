@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+##############################################################################
+
+GEOSTATS functions for storing spatial statistics of drought indicators (keyed upsert, columnar store, csv export)
+
+##############################################################################
+"""
+
+import os
+import shutil
+import glob
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+import logging
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S', level=logging.INFO)
+
+
+STATS_KEYS = ['LOCATION', 'DATE']
+STATS_STORE_FOLDER = 'STORE'
+
+
+
+def getStatsStore(CONFIG):
+    """
+    Read stats store options :
+        - CONFIG['STATS_STORE'] (default 0) : if 1, stats of data_histo are kept in a columnar store (parquet, one partition per year)
+        - CONFIG['STATS_CSV'] (default 1) : if 1, csv files of data_histo are exported from the store at each update
+    Returns (go_store, go_csv) ; without store, csv files of data_histo are always updated.
+    """
+
+    if (CONFIG.get('STATS_STORE') is None) or (CONFIG['STATS_STORE']==''): go_store = 0
+    else: go_store = int(CONFIG['STATS_STORE'])
+    if (CONFIG.get('STATS_CSV') is None) or (CONFIG['STATS_CSV']==''): go_csv = 1
+    else: go_csv = int(CONFIG['STATS_CSV'])
+    if go_store==1 and pyarrow is None:
+        logging.critical('Stats store option needs pyarrow package (not installed)')
+        raise Exception('Missing pyarrow package')
+    if go_store==0: go_csv = 1
+
+    return go_store, go_csv
+
+
+
+def readStats_CSV(stats_csv, columns=None):
+    """
+    Read a stats csv file (only columns if given), with DATE column parsed as datetime.
+    """
+
+    df = pd.read_csv(stats_csv, sep=';', usecols=columns)
+    try:
+        df['DATE'] = pd.to_datetime(df.DATE, format='%Y-%m-%d')
+    except ValueError:
+        try:
+            df['DATE'] = pd.to_datetime(df.DATE, format='%d/%m/%Y')
+        except ValueError:
+            df['DATE'] = pd.to_datetime(df.DATE, format='ISO8601')
+
+    return df
+
+
+
+def writeStats_CSV(df, stats_csv):
+    """
+    Write a stats dataframe into csv file (format of data_histo stats).
+    """
+
+    try:
+        df.to_csv(stats_csv,
+                  index = False,
+                  float_format='%.2f',
+                  decimal = '.',
+                  sep = ';')
+    except PermissionError:
+        os.remove(stats_csv)
+        df.to_csv(stats_csv,
+                  index = False,
+                  float_format='%.2f',
+                  decimal = '.',
+                  sep = ';')
+
+
+
+def upsertStats(df_histo, df_new, keys=STATS_KEYS):
+    """
+    Upsert new stats into histo stats, in one vectorized merge on keys (LOCATION, DATE) :
+        - rows of histo with a key of new stats are replaced (at their place)
+        - rows of new stats with a new key are appended at the end (in their order)
+    If a key is repeated in new stats, its last row is kept.
+    """
+
+    df_new = df_new.drop_duplicates(subset=keys, keep='last').reset_index(drop=True)
+    df_histo = df_histo.reset_index(drop=True)
+    KEYS_histo = pd.MultiIndex.from_frame(df_histo[keys])
+    KEYS_new = pd.MultiIndex.from_frame(df_new[keys])
+
+    # --- Replace existing keys ---
+    I_NEW = KEYS_new.get_indexer(KEYS_histo)
+    mask_up = I_NEW>=0
+    columns = [c for c in df_histo.columns if c in df_new.columns]
+    if mask_up.any():
+        for c in columns:
+            df_histo.loc[mask_up, c] = df_new[c].to_numpy()[I_NEW[mask_up]]
+
+    # --- Append new keys ---
+    mask_add = ~KEYS_new.isin(KEYS_histo)
+    df_histo = pd.concat([df_histo, df_new.loc[mask_add]], ignore_index=True)
+    logging.info(f'{mask_up.sum()} stats row(s) updated, {mask_add.sum()} added')
+
+    return df_histo
+
+
+
+def pathStore(data_stats, name):
+    """
+    Path of the columnar store of a stats dataframe of data_histo (one store per csv file, i.e. per product, period and variant) :
+        - <data_stats>/VHI_STATS_M_NoTrees_NoBuild.csv -> <data_stats>/STORE/VHI_STATS_M_NoTrees_NoBuild/YEAR=YYYY/part.parquet
+    """
+
+    return os.path.join(data_stats, STATS_STORE_FOLDER, name.split('.csv')[0])
+
+
+
+def readStats_Store(store_dir, columns=None, years=None):
+    """
+    Read stats from a columnar store : only partitions of years (all if None) and columns (all if None) are read.
+    """
+
+    YEARS = sorted(int(os.path.basename(p).split('=')[1]) for p in glob.glob(os.path.join(store_dir, 'YEAR=*')))
+    if years is not None:
+        YEARS = [y for y in YEARS if y in set(years)]
+    DF = [pd.read_parquet(os.path.join(store_dir, f'YEAR={y}', 'part.parquet'), columns=columns) for y in YEARS]
+    if DF==[]:
+        return pd.DataFrame(columns=columns)
+
+    return pd.concat(DF, ignore_index=True)
+
+
+
+def upsertStats_Store(store_dir, df_new):
+    """
+    Upsert new stats into a columnar store : only partitions of years of new stats are read and rewritten (atomic replace).
+    """
+
+    YEARS = df_new['DATE'].dt.year
+    for y in sorted(YEARS.unique()):
+        part_dir = os.path.join(store_dir, f'YEAR={y}')
+        part_file = os.path.join(part_dir, 'part.parquet')
+        os.makedirs(part_dir, exist_ok=True)
+        if os.path.exists(part_file):
+            df_part = upsertStats(pd.read_parquet(part_file), df_new.loc[YEARS==y])
+        else:
+            df_part = df_new.loc[YEARS==y].reset_index(drop=True)
+        df_part.to_parquet(f'{part_file}.{os.getpid()}.tmp', index=False)
+        os.replace(f'{part_file}.{os.getpid()}.tmp', part_file)
+        del part_dir, part_file, df_part
+
+
+
+def updateStats(stats_csv, data_stats, go_store=0, go_csv=1):
+    """
+    Copy/Update a stats csv file of the run folder into data_histo directory (keyed upsert on LOCATION, DATE) :
+        - without store, the csv file of data_histo is updated (or copied if missing)
+        - with store (go_store=1), the store is updated (initialized from csv file of data_histo if missing),
+          and the csv file of data_histo is exported from the store if go_csv=1
+    """
+
+    name = os.path.basename(stats_csv)
+    f_datahisto = os.path.join(data_stats, name)
+    logging.info(f'Dataframe : {name}')
+
+    if go_store==1:
+        store_dir = pathStore(data_stats, name)
+        if (not os.path.exists(store_dir)) and os.path.exists(f_datahisto):
+            logging.info(f'Initialize stats store from {name}')
+            upsertStats_Store(store_dir, readStats_CSV(f_datahisto))
+        upsertStats_Store(store_dir, readStats_CSV(stats_csv))
+        if go_csv==1:
+            writeStats_CSV(readStats_Store(store_dir), f_datahisto)
+
+    elif os.path.exists(f_datahisto):
+        # Update : replace new stats to histo stats
+        writeStats_CSV(upsertStats(readStats_CSV(f_datahisto), readStats_CSV(stats_csv)), f_datahisto)
+
+    else:
+        # Copy stats to data histo :
+        shutil.copyfile(stats_csv, f_datahisto)
+
+
+
+def readStats(data_stats, name, columns=None, years=None):
+    """
+    Read stats of data_histo (only columns and years if given) : from columnar store if it exists, from csv file otherwise.
+    """
+
+    store_dir = pathStore(data_stats, name)
+    if os.path.isdir(store_dir) and (pyarrow is not None):
+        return readStats_Store(store_dir, columns, years)
+
+    df = readStats_CSV(os.path.join(data_stats, name), columns)
+    if years is not None:
+        df = df.loc[df['DATE'].dt.year.isin(years)].reset_index(drop=True)
+
+    return df
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of ALERT data access functions (incremental, resumable ftp synchronization)
+"""
+
+import os
+import pytest
+import dmpipeline.ALERT_Processing.ALERT_data_access as access
+
+
+REMOTE = {'20240101/SWI_20240101.zip': b'a'*1000,
+          '20240102/SWI_20240102.zip': b'b'*1000}
+MODIFY = '20240103120000'
+
+
+
+class FakeFTP():
+    """
+    Fake ftp connection on REMOTE files (MLSD listing, RETR with REST), failing once in the middle of the transfer of fail_file.
+    """
+
+    def __init__(self, fail_file=None):
+        self.fail_file = fail_file
+        self.RESTS = []
+        self.cwd_path = ''
+
+    def cwd(self, path):
+        self.cwd_path = path
+
+    def mlsd(self, path='', facts=[]):
+        if path=='':
+            for d in sorted(set(rel.split('/')[0] for rel in REMOTE)):
+                yield d, {'type': 'dir', 'modify': MODIFY}
+        for rel, data in REMOTE.items():
+            if rel.split('/')[0]==path:
+                yield rel.split('/')[1], {'type': 'file', 'size': str(len(data)), 'modify': MODIFY}
+
+    def retrbinary(self, cmd, callback, rest=None):
+        rel = cmd.split()[1]
+        self.RESTS.append((rel, rest))
+        data = REMOTE[rel][rest or 0:]
+        if rel==self.fail_file:
+            self.fail_file = None
+            callback(data[:len(data)//2])
+            raise OSError('Connection lost')
+        callback(data)
+
+    def quit(self):
+        pass
+
+
+
+def test_syncFTP_StateOutsideLocal(tmp_path, monkeypatch):
+    """
+    Manifest and partial downloads are kept in the state directory (sibling of local directory) : local directory only holds
+    complete products, and an interrupted transfer is resumed at next synchronization.
+    """
+
+    local_dir = os.path.join(tmp_path, '0_RAW')
+    FTP = FakeFTP(fail_file='20240102/SWI_20240102.zip')
+    monkeypatch.setattr(access, 'connectFTP', lambda credentials: FTP)
+
+    # --- First synchronization : transfer of the second file is interrupted ---
+    done = access.syncFTP({}, local_dir, depth=1, immutable=1, n_threads=1)
+    assert done==['20240101/SWI_20240101.zip']
+    LOCAL = sorted(os.path.relpath(os.path.join(d, f), local_dir).replace(os.sep, '/') for d, _, F in os.walk(local_dir) for f in F)
+    assert LOCAL==['20240101/SWI_20240101.zip']
+    state_dir = access.stateDirectory(local_dir)
+    assert os.path.dirname(state_dir)==str(tmp_path)
+    assert os.path.exists(os.path.join(state_dir, access.FTP_MANIFEST))
+    assert os.path.getsize(os.path.join(state_dir, '20240102', f'SWI_20240102.zip{access.FTP_PART}'))==500
+
+    # --- Second synchronization : transfer is resumed ---
+    done = access.syncFTP({}, local_dir, depth=1, immutable=1, n_threads=1)
+    assert done==['20240102/SWI_20240102.zip']
+    assert FTP.RESTS[-1]==('20240102/SWI_20240102.zip', 500)
+    with open(os.path.join(local_dir, '20240102', 'SWI_20240102.zip'), 'rb') as f:
+        assert f.read()==REMOTE['20240102/SWI_20240102.zip']
+    assert not os.path.exists(os.path.join(state_dir, '20240102', f'SWI_20240102.zip{access.FTP_PART}'))
+
+
+
+def test_downloadFile_IncompleteSize(tmp_path):
+    """
+    A download whose size differs from remote size is not moved to local directory.
+    """
+
+    local_file = os.path.join(tmp_path, 'SWI_20240101.zip')
+    part_file = os.path.join(tmp_path, 'state', f'SWI_20240101.zip{access.FTP_PART}')
+    os.makedirs(os.path.dirname(part_file))
+
+    with pytest.raises(Exception, match='Incomplete download'):
+        access.downloadFile(FakeFTP(), '20240101/SWI_20240101.zip', local_file, part_file, 2000, MODIFY)
+    assert not os.path.exists(local_file)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of DROUGHT local functions (VAI processing chain)
+"""
+
+import os
+import dmpipeline.DROUGHT_Processing.DROUGHT_local_functions as local
+
+
+
+def test_process_LocalDrought_VAI_NoTile(tmp_path):
+    """
+    Without any landsat tile to process (no indices in data_histo), no job is run and no error is raised.
+    """
+
+    DATA_HISTO = os.path.join(tmp_path, 'histo')
+    os.makedirs(os.path.join(DATA_HISTO, 'T', '0_INDICES', 'LANDSAT_SENTINEL2', 'DECADE'))
+    os.makedirs(os.path.join(DATA_HISTO, 'T', '1_INDICATEURS', 'LOCAL', 'DECADE'))
+    OUTDIR_PATHS = [os.path.join(tmp_path, 'run', o) for o in ['comp', 'compdecade', 'compmonth', 'compstats', 'vai', 'postproc', 'stats']]
+    for outdir in OUTDIR_PATHS:
+        os.makedirs(outdir)
+    CONFIG = {'TERRITORY': 'T', 'DATA_HISTO': DATA_HISTO, 'ANNEX_DIR': os.path.join(tmp_path, 'annex'), 'MODE': 'DROUGHT',
+              'TILES_L': '', 'PERIOD_START': '2019-01-01', 'PERIOD_END': '2019-01-31', 'N_WORKERS': '2'}
+
+    local.process_LocalDrought_VAI(CONFIG, OUTDIR_PATHS)
+
+    assert os.listdir(os.path.join(DATA_HISTO, 'T', '1_INDICATEURS', 'LOCAL', 'DECADE'))==[]
+    assert os.listdir(OUTDIR_PATHS[4])==[]